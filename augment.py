@@ -0,0 +1,100 @@
+import tensorflow as tf
+
+
+class BatchAugmenter:
+    """Augmentations of already batched tensors, called inside the train step so they run on the device as a few
+    masks and gathers per batch instead of per example py_functions in the input pipeline.
+
+    Works on pointwise batches (input_ids, frames, ...) and pair batches (input_ids_1, ..., input_ids_2, ...):
+    frame dropout and frame order jitter within the first num_frames frames, title token replacement, and for
+    pairs swapping side 1 and side 2 of whole examples. mask_tokens is the MLM masking of the pretraining and
+    uniter mlm trainers, their data helpers return unmasked titles.
+    """
+
+    def __init__(self, args, tokenizer):
+        self.frame_dropout = args.aug_frame_dropout
+        self.frame_jitter = args.aug_frame_jitter
+        self.token_mask = args.aug_token_mask
+        self.swap_sides = args.aug_swap_sides
+        self.mlm_probability = args.mlm_probability
+        self.mask_token_id = tokenizer.mask_token_id
+        self.vocab_size = len(tokenizer)
+        # what the tokenizer's special_tokens_mask marks in a padded title
+        self.special_ids = tf.constant([tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id],
+                                       tf.int32)
+
+    @property
+    def active(self):
+        return bool(self.frame_dropout or self.frame_jitter or self.token_mask or self.swap_sides)
+
+    def __call__(self, batch):
+        batch = dict(batch)
+        sides = ('_1', '_2') if 'input_ids_1' in batch else ('',)
+        for side in sides:
+            if self.frame_dropout or self.frame_jitter:
+                batch[f'frames{side}'], batch[f'num_frames{side}'] = self.augment_frames(
+                    batch[f'frames{side}'], batch[f'num_frames{side}'])
+            if self.token_mask:
+                batch[f'input_ids{side}'], _ = self.mask_tokens(batch[f'input_ids{side}'], self.token_mask)
+        if self.swap_sides and len(sides) == 2:
+            batch = self.swap(batch)
+        return batch
+
+    def mask_batch(self, batch):
+        """The batch with mlm masked input_ids and their mask_labels, per side for pair batches. Call it on the
+        clean batch, before __call__, so the labels are the original tokens and not --aug-token-mask ones."""
+        batch = dict(batch)
+        for side in ('_1', '_2') if 'input_ids_1' in batch else ('',):
+            batch[f'input_ids{side}'], batch[f'mask_labels{side}'] = self.mask_tokens(batch[f'input_ids{side}'])
+        return batch
+
+    def mask_tokens(self, input_ids, probability=None):
+        """Masked inputs and labels for masked language modeling: of a probability share of the non special tokens
+        80% become [MASK], 10% a random token and 10% stay. Labels are -100 except at the chosen tokens."""
+        if probability is None:
+            probability = self.mlm_probability
+        shape = tf.shape(input_ids)
+        special = tf.reduce_any(tf.equal(input_ids[..., None], self.special_ids), axis=-1)
+        masked = (tf.random.uniform(shape) < probability) & ~special
+        labels = tf.where(masked, input_ids, -100)
+        replaced = (tf.random.uniform(shape) < 0.8) & masked
+        randomized = (tf.random.uniform(shape) < 0.5) & masked & ~replaced
+        random_words = tf.random.uniform(shape, maxval=self.vocab_size, dtype=input_ids.dtype)
+        input_ids = tf.where(replaced, tf.cast(self.mask_token_id, input_ids.dtype), input_ids)
+        input_ids = tf.where(randomized, random_words, input_ids)
+        return input_ids, labels
+
+    def augment_frames(self, frames, num_frames):
+        """Drop every valid frame with probability frame_dropout (the first one is always kept) and move frames up
+        to frame_jitter positions; the kept frames are gathered to the front and num_frames ([batch, 1]) is
+        their count, so the models' frame masks follow. The slots after them repeat the last kept frame, the
+        padding the parsers use, so the frame mean of the mix models (over all slots) sees the dropout too.
+        The jitter only matters to models that use the frame order (the uniter families), NeXtVLAD and the
+        frame mean do not."""
+        shape = tf.shape(frames)
+        positions = tf.cast(tf.range(shape[1]), tf.float32)[None]
+        valid = positions < tf.cast(num_frames, tf.float32)
+        if self.frame_dropout:
+            valid &= (tf.random.uniform(shape[:2]) >= self.frame_dropout) | (positions == 0)
+        order_key = positions
+        if self.frame_jitter:
+            order_key += tf.random.uniform(shape[:2], -self.frame_jitter, self.frame_jitter)
+        # the dropped and padding frames after all kept ones
+        order_key = tf.where(valid, order_key, order_key + 4. * tf.cast(shape[1], tf.float32) + 2. * self.frame_jitter)
+        order = tf.argsort(order_key, axis=1, stable=True)
+        frames = tf.gather(frames, order, batch_dims=1)
+        num_frames = tf.reduce_sum(tf.cast(valid, num_frames.dtype), axis=1, keepdims=True)
+        last = tf.gather(frames, tf.maximum(num_frames[:, 0] - 1, 0), batch_dims=1)
+        padding = positions >= tf.cast(num_frames, tf.float32)
+        frames = tf.where(padding[..., None], last[:, None], frames)
+        return frames, num_frames
+
+    def swap(self, batch):
+        """Exchange every <field>_1 with <field>_2 in a swap_sides share of the examples."""
+        swapped = tf.random.uniform([tf.shape(batch['sim'])[0]]) < self.swap_sides
+        for name in [name[:-2] for name in batch if name.endswith('_1') and name[:-2] + '_2' in batch]:
+            value_1, value_2 = batch[f'{name}_1'], batch[f'{name}_2']
+            where = tf.reshape(swapped, [-1] + [1] * (len(value_1.shape) - 1))
+            batch[f'{name}_1'] = tf.where(where, value_2, value_1)
+            batch[f'{name}_2'] = tf.where(where, value_1, value_2)
+        return batch
@@ -0,0 +1,81 @@
+import argparse
+import time
+
+import tensorflow as tf
+from transformers.models.bert.configuration_bert import BertConfig
+
+from bert import TFBertSelfAttention
+
+parser = argparse.ArgumentParser(description="Time TFBertSelfAttention against the unfused three-projection version")
+parser.add_argument('--seq-lengths', type=str, default='32,64', help='title only and title + frames (Uniter)')
+parser.add_argument('--batch-size', default=128, type=int)
+parser.add_argument('--steps', default=50, type=int)
+parser.add_argument('--warmup-steps', default=5, type=int)
+
+
+def split_qkv(layer):
+    """Three (kernel, bias) variables holding the query / key / value columns of the fused projection."""
+    size = layer.all_head_size
+    return [(tf.Variable(layer.qkv_kernel[:, i * size:(i + 1) * size]),
+             tf.Variable(layer.qkv_bias[i * size:(i + 1) * size])) for i in range(3)]
+
+
+def unfused_attention(layer, projections, hidden_states, attention_mask):
+    """TFBertSelfAttention.call before the fused QKV projection, with its three Dense projections on the same
+    weights."""
+    batch_size = tf.shape(hidden_states)[0]
+
+    def transpose_for_scores(tensor):
+        tensor = tf.reshape(tensor, (batch_size, -1, layer.num_attention_heads, layer.attention_head_size))
+        return tf.transpose(tensor, perm=[0, 2, 1, 3])
+
+    query_layer, key_layer, value_layer = [transpose_for_scores(tf.einsum("bsd,de->bse", hidden_states, kernel) + bias)
+                                           for kernel, bias in projections]
+    attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True) / layer.sqrt_att_head_size
+    attention_probs = tf.nn.softmax(attention_scores + attention_mask, axis=-1)
+    attention_output = tf.transpose(tf.matmul(attention_probs, value_layer), perm=[0, 2, 1, 3])
+    return tf.reshape(attention_output, (batch_size, -1, layer.all_head_size))
+
+
+def time_fn(fn, inputs, steps, warmup_steps):
+    for _ in range(warmup_steps):
+        output = fn(*inputs)
+    output.numpy()
+    start = time.perf_counter()
+    for _ in range(steps):
+        output = fn(*inputs)
+    output.numpy()
+    return (time.perf_counter() - start) / steps * 1000, output
+
+
+def main():
+    args = parser.parse_args()
+    config = BertConfig()
+    fused = TFBertSelfAttention(config, name="self")
+    xla = TFBertSelfAttention(BertConfig(xla_attention=True), name="self")
+
+    print('| seq len | unfused (ms) | fused (ms) | fused + xla (ms) | max abs diff |')
+    print('|---|---|---|---|---|')
+    for seq_len in map(int, args.seq_lengths.split(',')):
+        hidden_states = tf.random.normal([args.batch_size, seq_len, config.hidden_size])
+        # last quarter of every sequence is padding
+        mask = tf.sequence_mask(tf.fill([args.batch_size], seq_len * 3 // 4), seq_len, dtype=tf.float32)
+        attention_mask = (1. - mask[:, None, None, :]) * -10000.
+        inputs = (hidden_states, attention_mask)
+        fused(hidden_states, attention_mask, None, False)
+        xla(hidden_states, attention_mask, None, False)
+        xla.set_weights(fused.get_weights())
+        projections = split_qkv(fused)
+
+        unfused_ms, expected = time_fn(tf.function(lambda h, m: unfused_attention(fused, projections, h, m)), inputs,
+                                       args.steps, args.warmup_steps)
+        fused_ms, output = time_fn(tf.function(lambda h, m: fused(h, m, None, False)[0]), inputs,
+                                   args.steps, args.warmup_steps)
+        xla_ms, _ = time_fn(tf.function(lambda h, m: xla(h, m, None, False)[0]), inputs,
+                            args.steps, args.warmup_steps)
+        diff = tf.reduce_max(tf.abs(output - expected)).numpy()
+        print(f'| {seq_len} | {unfused_ms:.2f} | {fused_ms:.2f} | {xla_ms:.2f} | {diff:.2e} |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import importlib
+import json
+import subprocess
+import sys
+import time
+
+from cqrconfig import parser
+
+parser.add_argument('--data-helper', type=str, default='data_helper', help='data_helper & data_helper_roformer')
+parser.add_argument('--worker-counts', type=str, default='0,1,2,4,8', help='0 runs the pipeline in the trainer')
+parser.add_argument('--warmup-batches', default=20, type=int, help='not timed, covers the worker start up')
+parser.add_argument('--benchmark-batches', default=200, type=int)
+parser.add_argument('--single', default=-1, type=int, help='internal, measures one worker count')
+
+
+def measure(args):
+    """Batches per second of the train dataset with args.data_service_workers local workers."""
+    train_dataset, _ = importlib.import_module(args.data_helper).create_datasets(args)
+    iterator = iter(train_dataset)
+    for _ in range(args.warmup_batches):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(args.benchmark_batches):
+        next(iterator)
+    return args.benchmark_batches / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    if args.single >= 0:
+        # one count per process, the workers must register the parse functions in the same order as the trainer
+        args.data_service_workers = args.single
+        print(json.dumps({'workers': args.single, 'batches_per_s': measure(args)}))
+        return
+
+    print(f'{args.train_record_pattern}, batch size {args.batch_size}, {args.benchmark_batches} batches')
+    print('| workers | batches / s | videos / s | speedup |')
+    print('|---|---|---|---|')
+    baseline = None
+    for count in map(int, args.worker_counts.split(',')):
+        output = subprocess.run([sys.executable, __file__] + sys.argv[1:] + ['--single', str(count)],
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        rate = json.loads(output.strip().splitlines()[-1])['batches_per_s']
+        baseline = baseline or rate
+        name = count or 'in trainer'
+        print(f'| {name} | {rate:.2f} | {rate * args.batch_size:.0f} | {rate / baseline:.2f}x |')
+
+
+if __name__ == '__main__':
+    main()
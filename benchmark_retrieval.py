@@ -0,0 +1,46 @@
+import argparse
+import time
+
+import numpy as np
+
+from retrieval import EmbeddingIndex
+
+parser = argparse.ArgumentParser(description="QPS of retrieval.EmbeddingIndex on random embeddings")
+parser.add_argument('--num-embeddings', default=1000000, type=int)
+parser.add_argument('--dim', default=256, type=int)
+parser.add_argument('--num-queries', default=4096, type=int)
+parser.add_argument('--top-k', default=20, type=int)
+parser.add_argument('--block-sizes', type=str, default='16384,65536')
+parser.add_argument('--num-threads', type=str, default='1,4,0', help='0 means one per core')
+parser.add_argument('--check-queries', default=16, type=int, help='queries checked against a full argsort')
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    embeddings = np.empty([args.num_embeddings, args.dim], dtype=np.float16)
+    for i in range(0, args.num_embeddings, 100000):
+        embeddings[i:i + 100000] = rng.standard_normal([min(100000, args.num_embeddings - i), args.dim])
+    queries = rng.standard_normal([args.num_queries, args.dim]).astype(np.float32)
+    vids = np.arange(args.num_embeddings).astype(str)
+
+    print(f'{args.num_embeddings} x {args.dim} float16, {args.num_queries} queries, top {args.top_k}')
+    print('| block size | threads | QPS | ms / query | exact |')
+    print('|---|---|---|---|---|')
+    for block_size in map(int, args.block_sizes.split(',')):
+        for num_threads in map(int, args.num_threads.split(',')):
+            index = EmbeddingIndex(vids, embeddings, block_size=block_size, num_threads=num_threads)
+            index.search(queries[:64], args.top_k)
+            start = time.perf_counter()
+            _, indices = index.search(queries, args.top_k)
+            elapsed = time.perf_counter() - start
+
+            check = queries[:args.check_queries] / np.linalg.norm(queries[:args.check_queries], axis=1, keepdims=True)
+            expected = np.argsort(-(check @ index.embeddings.astype(np.float32).T), axis=1)[:, :args.top_k]
+            exact = all(set(a) == set(b) for a, b in zip(indices[:args.check_queries], expected))
+            print(f'| {block_size} | {num_threads or "all"} | {args.num_queries / elapsed:.0f} | '
+                  f'{elapsed / args.num_queries * 1000:.3f} | {exact} |')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 from typing import Dict, Optional, Tuple, Union
+import functools
 import tensorflow as tf
 import numpy as np
 import math
+from tensorflow.python.training.saving import saveable_object
+from tensorflow.python.training.tracking import base as trackable
+from tensorflow.python.training.tracking import data_structures
+from tensorflow.python.training.tracking import tracking
 
 from modeling_tf import TFPreTrainedModel
 
@@ -149,8 +154,33 @@ class TFBertPreTrainedModel(TFPreTrainedModel):
     base_model_prefix = "bert"
 
 
+class ColumnSliceSaveable(saveable_object.SaveableObject):
+    """Saves and restores columns [start, stop) of variable as a tensor of their own."""
+
+    def __init__(self, column_slice, name):
+        variable, start, stop = column_slice.variable, column_slice.start, column_slice.stop
+        self.variable, self.start, self.stop = variable, start, stop
+        spec = saveable_object.SaveSpec(lambda: variable[..., start:stop], "", name, dtype=variable.dtype,
+                                        device=variable.device)
+        # the slices of one variable are separate saveables, so the slice and not the variable identifies it
+        super().__init__(column_slice, [spec], name)
+
+    def restore(self, restored_tensors, restored_shapes):
+        return self.variable[..., self.start:self.stop].assign(restored_tensors[0])
+
+
+class ColumnSlice(trackable.Trackable):
+    """Checkpoint view of columns [start, stop) of a fused variable, under the name of the unfused weight."""
+
+    def __init__(self, variable, start, stop):
+        self.variable, self.start, self.stop = variable, start, stop
+
+    def _gather_saveables_for_checkpoint(self):
+        return {trackable.VARIABLE_VALUE_KEY: functools.partial(ColumnSliceSaveable, self)}
+
+
 class TFBertSelfAttention(tf.keras.layers.Layer):
-    def __init__(self, config: BertConfig, **kwargs):
+    def __init__(self, config: BertConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
         if config.hidden_size % config.num_attention_heads != 0:
@@ -159,28 +189,36 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
                 f"of attention heads ({config.num_attention_heads})"
             )
 
-        self.num_attention_heads = config.num_attention_heads
+        # heads listed in config.pruned_heads (written by prune_backbone.py) are not built
+        pruned_heads = getattr(config, "pruned_heads", {}).get(layer_idx, [])
+        self.num_attention_heads = config.num_attention_heads - len(pruned_heads)
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
         self.sqrt_att_head_size = math.sqrt(self.attention_head_size)
-
-        self.query = tf.keras.layers.Dense(
-            units=self.all_head_size, kernel_initializer=get_initializer(config.initializer_range), name="query"
-        )
-        self.key = tf.keras.layers.Dense(
-            units=self.all_head_size, kernel_initializer=get_initializer(config.initializer_range), name="key"
-        )
-        self.value = tf.keras.layers.Dense(
-            units=self.all_head_size, kernel_initializer=get_initializer(config.initializer_range), name="value"
-        )
+        self.initializer_range = config.initializer_range
         self.dropout = tf.keras.layers.Dropout(rate=config.attention_probs_dropout_prob)
+        # the attention core (everything after the projection) as one XLA cluster
+        self.attend = tf.function(self._attend, experimental_compile=True) if getattr(config, "xla_attention", False) else self._attend
 
-    def transpose_for_scores(self, tensor: tf.Tensor, batch_size: int) -> tf.Tensor:
-        # Reshape from [batch_size, seq_length, all_head_size] to [batch_size, seq_length, num_attention_heads, attention_head_size]
-        tensor = tf.reshape(tensor=tensor, shape=(batch_size, -1, self.num_attention_heads, self.attention_head_size))
-
-        # Transpose the tensor from [batch_size, seq_length, num_attention_heads, attention_head_size] to [batch_size, num_attention_heads, seq_length, attention_head_size]
-        return tf.transpose(tensor, perm=[0, 2, 1, 3])
+    def build(self, input_shape: tf.TensorShape):
+        # one [hidden, 3 * all_head] kernel (query | key | value columns) and bias. They are not checkpointed
+        # themselves: the query / key / value views below save and restore their columns under the names of the
+        # former Dense layers, so tf.train checkpoints keep their format; modeling_tf.load_tf_weights
+        # concatenates the query / key / value weights of pretrained h5 files
+        with tf.name_scope("qkv"):
+            qkv_kernel = tf.Variable(
+                get_initializer(self.initializer_range)([input_shape[-1], 3 * self.all_head_size]), name="kernel"
+            )
+            qkv_bias = tf.Variable(tf.zeros([3 * self.all_head_size]), name="bias")
+        self.qkv_kernel = data_structures.NoDependency(qkv_kernel)
+        self.qkv_bias = data_structures.NoDependency(qkv_bias)
+        for i, name in enumerate(("query", "key", "value")):
+            view = tracking.AutoTrackable()
+            view.kernel = ColumnSlice(qkv_kernel, i * self.all_head_size, (i + 1) * self.all_head_size)
+            view.bias = ColumnSlice(qkv_bias, i * self.all_head_size, (i + 1) * self.all_head_size)
+            # restores deferred on this layer (a checkpoint restored before the first call) land here
+            self._track_trackable(view, name=name)
+        super().build(input_shape)
 
     def call(
         self,
@@ -191,13 +229,26 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
         training: bool = False,
     ) -> Tuple[tf.Tensor]:
         batch_size = shape_list(hidden_states)[0]
-        mixed_query_layer = self.query(inputs=hidden_states)
-        mixed_key_layer = self.key(inputs=hidden_states)
-        mixed_value_layer = self.value(inputs=hidden_states)
-        query_layer = self.transpose_for_scores(mixed_query_layer, batch_size)
-        key_layer = self.transpose_for_scores(mixed_key_layer, batch_size)
-        value_layer = self.transpose_for_scores(mixed_value_layer, batch_size)
+        # one [batch_size * seq_len, hidden] x [hidden, 3 * all_head_size] matmul for query, key and value
+        mixed_qkv_layer = tf.matmul(tf.reshape(hidden_states, (-1, shape_list(hidden_states)[-1])), self.qkv_kernel)
+        mixed_qkv_layer = tf.reshape(
+            mixed_qkv_layer + self.qkv_bias, (batch_size, -1, 3, self.num_attention_heads, self.attention_head_size)
+        )
+        # a single transpose to (3, batch_size, num_heads, seq_len, head_size) for all three
+        query_layer, key_layer, value_layer = tf.unstack(tf.transpose(mixed_qkv_layer, perm=[2, 0, 3, 1, 4]))
 
+        attention_output, attention_probs = self.attend(
+            query_layer, key_layer, value_layer, attention_mask, head_mask, training
+        )
+
+        # (batch_size, seq_len_q, all_head_size)
+        attention_output = tf.transpose(attention_output, perm=[0, 2, 1, 3])
+        attention_output = tf.reshape(tensor=attention_output, shape=(batch_size, -1, self.all_head_size))
+        outputs = (attention_output, attention_probs) if output_attentions else (attention_output,)
+
+        return outputs
+
+    def _attend(self, query_layer, key_layer, value_layer, attention_mask, head_mask, training):
         # Take the dot product between "query" and "key" to get the raw attention scores.
         # (batch size, num_heads, seq_len_q, seq_len_k)
         attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
@@ -219,14 +270,9 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
         if head_mask is not None:
             attention_probs = tf.multiply(attention_probs, head_mask)
 
+        # (batch size, num_heads, seq_len_q, head_size)
         attention_output = tf.matmul(attention_probs, value_layer)
-        attention_output = tf.transpose(attention_output, perm=[0, 2, 1, 3])
-
-        # (batch_size, seq_len_q, all_head_size)
-        attention_output = tf.reshape(tensor=attention_output, shape=(batch_size, -1, self.all_head_size))
-        outputs = (attention_output, attention_probs) if output_attentions else (attention_output,)
-
-        return outputs
+        return attention_output, attention_probs
 
 
 class TFBertSelfOutput(tf.keras.layers.Layer):
@@ -248,10 +294,10 @@ class TFBertSelfOutput(tf.keras.layers.Layer):
 
 
 class TFBertAttention(tf.keras.layers.Layer):
-    def __init__(self, config: BertConfig, **kwargs):
+    def __init__(self, config: BertConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
-        self.self_attention = TFBertSelfAttention(config, name="self")
+        self.self_attention = TFBertSelfAttention(config, layer_idx=layer_idx, name="self")
         self.dense_output = TFBertSelfOutput(config, name="output")
 
     def prune_heads(self, heads):
@@ -319,10 +365,10 @@ class TFBertOutput(tf.keras.layers.Layer):
 
 
 class TFBertLayer(tf.keras.layers.Layer):
-    def __init__(self, config: BertConfig, **kwargs):
+    def __init__(self, config: BertConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
-        self.attention = TFBertAttention(config, name="attention")
+        self.attention = TFBertAttention(config, layer_idx=layer_idx, name="attention")
         self.intermediate = TFBertIntermediate(config, name="intermediate")
         self.bert_output = TFBertOutput(config, name="output")
 
@@ -431,7 +477,18 @@ class TFBertEncoder(tf.keras.layers.Layer):
     def __init__(self, config: BertConfig, **kwargs):
         super().__init__(**kwargs)
 
-        self.layer = [TFBertLayer(config, name=f"layer_._{i}") for i in range(config.num_hidden_layers)]
+        self.layer = [TFBertLayer(config, layer_idx=i, name=f"layer_._{i}") for i in range(config.num_hidden_layers)]
+        # inference depth, 0 runs every layer; set through util.set_inference_depth
+        self.num_layers_infer = 0
+        # residual heads mapping the output of layer i + 1 towards the last layer, zero-initialized so that
+        # an untrained head is plain truncation; trained by calibrate_depth.py
+        self.exit_heads = None
+        if getattr(config, "early_exit_heads", False):
+            self.exit_heads = [
+                tf.keras.layers.Dense(config.hidden_size, kernel_initializer="zeros", name=f"exit_head_._{i}")
+                for i in range(config.num_hidden_layers - 1)
+            ]
+        self.distill_exit_heads = False
 
     def call(
         self,
@@ -446,7 +503,15 @@ class TFBertEncoder(tf.keras.layers.Layer):
         all_hidden_states = () if output_hidden_states else None
         all_attentions = () if output_attentions else None
 
-        for i, layer_module in enumerate(self.layer):
+        num_layers = len(self.layer)
+        if self.num_layers_infer and not training:
+            num_layers = min(self.num_layers_infer, num_layers)
+        distill = self.distill_exit_heads and self.exit_heads is not None and num_layers == len(self.layer)
+        exits = []
+
+        for i, layer_module in enumerate(self.layer[:num_layers]):
+            if distill and i > 0:
+                exits.append(hidden_states)
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -462,6 +527,15 @@ class TFBertEncoder(tf.keras.layers.Layer):
             if output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
 
+        if distill:
+            # every head learns to predict the (frozen) last layer from its exit
+            target = tf.stop_gradient(hidden_states)
+            for i, exit_states in enumerate(exits):
+                exit_states = tf.stop_gradient(exit_states)
+                self.add_loss(tf.reduce_mean(tf.square(exit_states + self.exit_heads[i](exit_states) - target)))
+        elif self.exit_heads is not None and num_layers < len(self.layer):
+            hidden_states = hidden_states + self.exit_heads[num_layers - 1](hidden_states)
+
         # Add last layer
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
@@ -0,0 +1,126 @@
+import importlib
+import json
+import logging
+import os
+import time
+from pprint import pprint
+
+import numpy as np
+import tensorflow as tf
+from scipy.stats import spearmanr
+
+from config_pair import parser
+from util import backbone_encoder, resolve_ckpt, set_inference_depth, set_threading, require_full_frames
+
+parser.add_argument('--family', type=str, default='uniter', help='mix & mix_roformer & uniter & uniter_roformer')
+parser.add_argument('--depths', type=str, default='', help='comma separated depths to report, empty means all')
+parser.add_argument('--report-file', type=str, default='', help='defaults to <ckpt dir>/depth_report.md')
+
+# model module, model class and pair data helper of every family (the ASL variants share the model classes)
+FAMILIES = {'mix': ('model_pair_mix', 'MultiModal_mix', 'data_helper_pair'),
+            'mix_roformer': ('model_pair_mix_roformer', 'MultiModal_mix', 'data_helper_pair_roformer'),
+            'uniter': ('model_pair_uniter', 'MultiModal_Uniter', 'data_helper_pair'),
+            'uniter_roformer': ('model_pair_uniter', 'MultiModal_Uniter_roformer', 'data_helper_pair_roformer')}
+
+
+def train_exit_heads(args, model, encoder, train_dataset):
+    """Distill every exit head towards the last layer on the train split, the backbone stays frozen."""
+    optimizer = tf.keras.optimizers.Adam(args.exit_head_lr)
+    encoder.distill_exit_heads = True
+
+    @tf.function
+    def distill_step(inputs):
+        with tf.GradientTape() as tape:
+            model(inputs, training=False)
+            loss = tf.add_n(model.losses)
+        variables = [v for head in encoder.exit_heads for v in head.trainable_variables]
+        optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+        return loss
+
+    for step, batch in enumerate(train_dataset.take(args.exit_head_steps), start=1):
+        loss = distill_step(batch)
+        if step % args.print_freq == 0:
+            logging.info(f'exit heads step {step}: distill loss {loss.numpy():.6f}')
+    encoder.distill_exit_heads = False
+
+
+def evaluate(model, val_dataset):
+    """Val spearman and mean milliseconds per batch (first batches excluded as warm-up)."""
+
+    @tf.function
+    def val_step(inputs):
+        outputs = model(inputs, training=False)
+        final_embedding_1 = tf.math.l2_normalize(outputs[0], axis=1)
+        final_embedding_2 = tf.math.l2_normalize(outputs[1], axis=1)
+        return tf.reduce_sum(final_embedding_1 * final_embedding_2, axis=1)
+
+    sims, label_sims, times = [], [], []
+    for batch in val_dataset:
+        start = time.perf_counter()
+        sim = val_step(batch).numpy()
+        times.append(time.perf_counter() - start)
+        sims.append(sim)
+        label_sims.append(batch['sim'].numpy())
+    spearman = spearmanr(np.concatenate(sims), np.concatenate(label_sims))[0]
+    return spearman, np.mean(times[2:] or times) * 1000
+
+
+def write_report(rows, report_file):
+    full_ms = rows[-1]['ms_per_batch']
+    lines = ['| layers | exit head | spearman | ms / batch | speedup |', '|---|---|---|---|---|']
+    for r in rows:
+        lines.append(f"| {r['num_layers']} | {'yes' if r['exit_head'] else 'no'} | {r['spearman']:.4f} | "
+                     f"{r['ms_per_batch']:.1f} | {full_ms / r['ms_per_batch']:.2f}x |")
+    with open(report_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.splitext(report_file)[0] + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    print('\n'.join(lines))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    set_threading(args)
+    pprint(vars(args))
+
+    module_name, class_name, data_helper_name = FAMILIES[args.family]
+    MultiModal = getattr(importlib.import_module(module_name), class_name)
+    require_full_frames(args, MultiModal)
+    create_datasets = importlib.import_module(data_helper_name).create_datasets
+    train_dataset, val_dataset = create_datasets(args)
+
+    model = MultiModal(args)
+    checkpoint = tf.train.Checkpoint(model=model)
+    ckpt_file = resolve_ckpt(args.ckpt_file)
+    checkpoint.restore(ckpt_file).expect_partial()
+    logging.info(f'Restored from {ckpt_file}')
+    model(next(iter(val_dataset)), training=False)
+
+    encoder = backbone_encoder(model.bert)
+    num_hidden_layers = model.bert.config.num_hidden_layers
+    exit_heads = getattr(encoder, 'exit_heads', None) is not None
+    if args.early_exit_heads and not exit_heads:
+        logging.warning(f'{args.family} uses the stock transformers encoder, reporting plain truncation only')
+    if exit_heads:
+        train_exit_heads(args, model, encoder, train_dataset)
+        exit_ckpt = checkpoint.write(os.path.join(os.path.dirname(ckpt_file), 'ckpt-exit-heads'))
+        logging.info(f'Saved checkpoint with exit heads to {exit_ckpt}')
+
+    depths = [int(d) for d in args.depths.split(',')] if args.depths else list(range(1, num_hidden_layers + 1))
+    rows = []
+    for num_layers in sorted(set(depths + [num_hidden_layers])):
+        set_inference_depth(model.bert, num_layers)
+        spearman, ms_per_batch = evaluate(model, val_dataset)
+        rows.append({'num_layers': num_layers, 'exit_head': exit_heads and num_layers < num_hidden_layers,
+                     'spearman': float(spearman), 'ms_per_batch': float(ms_per_batch)})
+        logging.info(f'{num_layers} layers: spearmanr {spearman:.4f}, {ms_per_batch:.1f} ms / batch')
+
+    report_file = args.report_file or os.path.join(os.path.dirname(ckpt_file), 'depth_report.md')
+    write_report(rows, report_file)
+
+
+if __name__ == '__main__':
+    main()
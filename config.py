@@ -3,6 +3,7 @@ import argparse
 parser = argparse.ArgumentParser(description="QQ Browser video embedding challenge")
 
 parser.add_argument('--dropout', type=float, default=0.2, help='dropout ratio')
+parser.add_argument('--seed', type=int, default=2021, help='seed for file order, shuffling and init')
 parser.add_argument('--multi-label-file', type=str, default='data/tag_list.txt', help='supervised tag list')
 
 # ========================= Dataset Configs ==========================
@@ -16,6 +17,16 @@ parser.add_argument('--output-zip', type=str, default='result_ftpair.zip')
 parser.add_argument('--batch-size', default=224, type=int)
 parser.add_argument('--val-batch-size', default=32, type=int)
 parser.add_argument('--test-batch-size', default=32, type=int)
+parser.add_argument('--bucket-boundaries', type=str, default='',
+                    help='e.g. 24,40,56, batch by title length + num frames and pad each batch to its bucket, empty is off')
+parser.add_argument('--cycle-length', default=8, type=int, help='record files read interleaved, fixed for exact replay')
+parser.add_argument('--block-length', default=1, type=int, help='consecutive records taken from each file')
+parser.add_argument('--num-shards', default=1, type=int, help='split the records into this many shards, e.g. one per worker')
+parser.add_argument('--shard-index', default=0, type=int, help='shard read by this process')
+parser.add_argument('--dataset-cache-dir', type=str, default='',
+                    help='cache parsed val / test records here, keyed by the parsing config, empty is off')
+parser.add_argument('--hard-negative-dir', type=str, default='', help='see cqrconfig.py')
+parser.add_argument('--data-service-address', type=str, default='', help='see cqrconfig.py')
 
 # ========================= Monitor Configs ==========================
 parser.add_argument('--print-freq', default=100, type=int, help='print frequency')
@@ -35,6 +46,13 @@ parser.add_argument('--warmup-steps', default=1000, type=int)
 parser.add_argument('--minimum-lr', default=0., type=float, help='minimum learning rate')
 parser.add_argument('--lr', default=0.0005, type=float, help='initial learning rate')
 
+# ========================= Augmentation Configs ==========================
+parser.add_argument('--mlm-probability', default=0.15, type=float, help='share of title tokens the mlm trainers mask')
+parser.add_argument('--aug-frame-dropout', default=0., type=float, help='drop each train frame with this probability')
+parser.add_argument('--aug-frame-jitter', default=0., type=float, help='move train frames up to this many positions')
+parser.add_argument('--aug-token-mask', default=0., type=float, help='replace this share of train title tokens')
+parser.add_argument('--aug-swap-sides', default=0., type=float, help='swap the two videos of this share of train pairs')
+
 # ==================== Vision Modal Configs =======================
 parser.add_argument('--frame-embedding-size', type=int, default=1536)
 parser.add_argument('--max-frames', type=int, default=32)
@@ -3,6 +3,7 @@ import argparse
 parser = argparse.ArgumentParser(description="QQ Browser video embedding challenge")
 
 parser.add_argument('--dropout', type=float, default=0.2, help='dropout ratio')
+parser.add_argument('--seed', type=int, default=2021, help='seed for file order, shuffling and init')
 parser.add_argument('--multi-label-file', type=str, default='data/tag_list.txt', help='supervised tag list')
 
 # ========================= Dataset Configs ==========================
@@ -13,21 +14,50 @@ parser.add_argument('--test-a-file', type=str, default='data/test_a/test_a.tfrec
 parser.add_argument('--test-b-file', type=str, default='data/test_b/test_b.tfrecords')
 parser.add_argument('--output-json', type=str, default='result.json')
 parser.add_argument('--output-zip', type=str, default='result_pair.zip')
+parser.add_argument('--output-npz', type=str, default='', help='also write vids + float16 embedding matrix, see retrieval.py')
+parser.add_argument('--embedding-store', type=str, default='', help='append-only store of this checkpoint, only new vids are encoded')
+parser.add_argument('--store-max-segments', type=int, default=8, help='compact the store beyond this many segments')
 parser.add_argument('--batch-size', default=112, type=int)
 parser.add_argument('--val-batch-size', default=32, type=int)
 parser.add_argument('--test-batch-size', default=32, type=int)
+parser.add_argument('--bucket-boundaries', type=str, default='',
+                    help='e.g. 24,40,56, batch by title length + num frames and pad each batch to its bucket, empty is off')
+parser.add_argument('--cycle-length', default=8, type=int, help='record files read interleaved, fixed for exact replay')
+parser.add_argument('--block-length', default=1, type=int, help='consecutive records taken from each file')
+parser.add_argument('--num-shards', default=1, type=int, help='split the records into this many shards, e.g. one per worker')
+parser.add_argument('--shard-index', default=0, type=int, help='shard read by this process')
+parser.add_argument('--dataset-cache-dir', type=str, default='',
+                    help='cache parsed val / test records here, keyed by the parsing config, empty is off')
+parser.add_argument('--pair-table-dir', type=str, default='',
+                    help='build pair batches from a per-video table (pair_table.py) instead of the fold records, empty is off')
+parser.add_argument('--pair-video-pattern', type=str, default='data/pairwise/pairwise.tfrecords', help='videos of the table')
+parser.add_argument('--pair-table-mmap', default=1, type=int, help='memory map the frames of the table instead of loading them')
+parser.add_argument('--fold', default=0, type=int, help='val fold of label.tsv with --pair-table-dir, 0 is 0-5999val')
+parser.add_argument('--fold-size', default=6000, type=int)
+parser.add_argument('--fold-seed', default=42, type=int, help='seed write_tfrecord.py shuffled label.tsv with')
+parser.add_argument('--extra-pair-files', type=str, default='', help='comma separated id_1 id_2 sim tsv files added to the train pairs')
 
 # ========================= Monitor Configs ==========================
 parser.add_argument('--print-freq', default=200, type=int, help='print frequency')
 parser.add_argument('--eval-freq', default=1000, type=int, help='evaluation step frequency')
+parser.add_argument('--min-eval-freq', default=250, type=int, help='eval frequency once spearman stops climbing')
+parser.add_argument('--eval-tighten-delta', default=0.005, type=float, help='spearman gain below which eval gets denser')
+parser.add_argument('--early-stop-patience', default=0, type=int, help='stop after this many steps without a new best, 0 is off')
+parser.add_argument('--profile-steps', type=str, default='', help='a:b, time and trace steps a to b, empty is off')
+
+# ========================= Runtime Configs ==========================
+parser.add_argument('--intra-op-threads', default=0, type=int, help='threads used inside one op, 0 lets TF decide')
+parser.add_argument('--inter-op-threads', default=0, type=int, help='ops run concurrently, 0 lets TF decide')
 
 # ======================== SavedModel Configs =========================
-parser.add_argument('--resume-training', default=0, type=int, help='resume training from checkpoints')
+parser.add_argument('--resume-training', default=0, type=int, help='resume training from <savedmodel-path>/train_state')
+parser.add_argument('--save-state-freq', default=1000, type=int, help='steps between resumable training states')
 parser.add_argument('--savedmodel-path', type=str, default='save/ft_pair_kl')
 parser.add_argument('--pretrain_model_dir', type=str, default='save/pair_1')
 parser.add_argument('--kl-weight', default=0.2, type=float, help='weight of KL loss')
 parser.add_argument('--ckpt-file', type=str, default='save/ft_pair_20e_tag/ckpt-11240')
-parser.add_argument('--max-to-keep', default=1, type=int, help='the number of checkpoints to keep')
+parser.add_argument('--max-to-keep', default=1, type=int, help='the number of best checkpoints (by spearman) to keep')
+parser.add_argument('--save-min-spearman', default=-1.0, type=float, help='never save checkpoints scoring below this')
 parser.add_argument('--start-epoch', default=0, type=int, help='manual epoch number (useful on restarts)')
 
 # ========================= Learning Configs ==========================
@@ -37,6 +67,13 @@ parser.add_argument('--warmup-steps', default=1000, type=int)
 parser.add_argument('--minimum-lr', default=0., type=float, help='minimum learning rate')
 parser.add_argument('--lr', default=0.0005, type=float, help='initial learning rate')
 
+# ========================= Augmentation Configs ==========================
+parser.add_argument('--mlm-probability', default=0.15, type=float, help='share of title tokens the mlm trainers mask')
+parser.add_argument('--aug-frame-dropout', default=0., type=float, help='drop each train frame with this probability')
+parser.add_argument('--aug-frame-jitter', default=0., type=float, help='move train frames up to this many positions')
+parser.add_argument('--aug-token-mask', default=0., type=float, help='replace this share of train title tokens')
+parser.add_argument('--aug-swap-sides', default=0., type=float, help='swap the two videos of this share of train pairs')
+
 # ==================== Vision Modal Configs =======================
 parser.add_argument('--agg-model', type=str, default='nextvlad')
 parser.add_argument('--frame-embedding-size', type=int, default=1536)
@@ -52,7 +89,19 @@ parser.add_argument('--bert-seq-length', type=int, default=32)
 parser.add_argument('--bert-lr', type=float, default=3e-5)
 parser.add_argument('--bert-total-steps', type=int, default=40000)
 parser.add_argument('--bert-warmup-steps', type=int, default=2000)
+parser.add_argument('--bert-cache-size', type=int, default=0, help='LRU entries of cached title embeddings in inference_pair_b.py, 0 is off')
+parser.add_argument('--xla-attention', type=int, default=0, help='jit compile the attention core of the Uniter BERT layers')
+parser.add_argument('--early-exit-heads', type=int, default=0, help='add residual exit heads to the Uniter encoders')
+parser.add_argument('--prune-spec', type=str, default='', help='prune_spec.json of a checkpoint exported by prune_backbone.py')
+parser.add_argument('--num-layers-infer', type=int, default=0, help='transformer layers run at inference, 0 is all')
+parser.add_argument('--exit-head-steps', type=int, default=2000, help='distillation steps of the exit heads')
+parser.add_argument('--exit-head-lr', type=float, default=1e-3)
+parser.add_argument('--freeze-layers', type=int, default=0,
+                    help='freeze the embeddings and bottom N BERT layers and train from their cached output '
+                         '(train_pair_mix(_asl) and train_pair_uniter_tag(_asl))')
+parser.add_argument('--hidden-cache-dir', type=str, default='', help='float16 cache of the frozen layers, defaults to <savedmodel path>/hidden_cache')
 
 # ====================== Fusion Configs ===========================
 parser.add_argument('--hidden-size', type=int, default=256, help='NO MORE THAN 256')
-parser.add_argument('--uniter-pooling', type=str, default='cls', help='cls & mean & max')
+parser.add_argument('--matryoshka-dims', type=str, default='', help='e.g. 64,128, also train these embedding prefixes with the pair loss')
+parser.add_argument('--uniter-pooling', type=str, default='cls', help='cls & mean & max & masked_mean (ignores padding, use it with --bucket-boundaries)')
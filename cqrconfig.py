@@ -3,6 +3,7 @@ import argparse
 parser = argparse.ArgumentParser(description="QQ Browser video embedding challenge")
 
 parser.add_argument('--dropout', type=float, default=0.2, help='dropout ratio')
+parser.add_argument('--seed', type=int, default=2021, help='seed for file order, shuffling and init')
 parser.add_argument('--multi-label-file', type=str, default='data/tag_list.txt', help='supervised tag list')
 
 # ========================= Dataset Configs ==========================
@@ -16,6 +17,25 @@ parser.add_argument('--output-zip', type=str, default='result_pair.zip')
 parser.add_argument('--batch-size', default=224, type=int)
 parser.add_argument('--val-batch-size', default=32, type=int)
 parser.add_argument('--test-batch-size', default=32, type=int)
+parser.add_argument('--bucket-boundaries', type=str, default='',
+                    help='e.g. 24,40,56, batch by title length + num frames and pad each batch to its bucket, empty is off')
+parser.add_argument('--cycle-length', default=8, type=int, help='record files read interleaved, fixed for exact replay')
+parser.add_argument('--block-length', default=1, type=int, help='consecutive records taken from each file')
+parser.add_argument('--num-shards', default=1, type=int, help='split the records into this many shards, e.g. one per worker')
+parser.add_argument('--shard-index', default=0, type=int, help='shard read by this process')
+parser.add_argument('--dataset-cache-dir', type=str, default='',
+                    help='cache parsed val / test records here, keyed by the parsing config, empty is off')
+parser.add_argument('--data-service-workers', default=0, type=int,
+                    help='run the train input pipeline in this many local tf.data service worker processes, 0 is off')
+parser.add_argument('--data-service-address', type=str, default='', help='grpc://host:port of a running dispatcher')
+parser.add_argument('--data-service-port', default=0, type=int, help='port of the local dispatcher, 0 picks a free one')
+parser.add_argument('--hard-negative-dir', type=str, default='',
+                    help='batch the train videos in groups of nearest neighbours mined by mine_hard_negatives.py, empty is off')
+parser.add_argument('--hard-negative-refresh-steps', default=0, type=int, help='steps between re-mining in the background, 0 is off')
+parser.add_argument('--hard-negative-gpus', type=str, default='', help='CUDA_VISIBLE_DEVICES of the miner, empty mines on CPU')
+parser.add_argument('--hard-negative-group-size', default=4, type=int, help='neighbours batched together')
+parser.add_argument('--num-hard-negatives', default=20, type=int, help='neighbours kept per video in hard_negatives.json')
+parser.add_argument('--hard-negative-skip-top', default=2, type=int, help='nearest neighbours skipped as likely duplicates')
 
 # ========================= Monitor Configs ==========================
 parser.add_argument('--print-freq', default=100, type=int, help='print frequency')
@@ -23,6 +43,7 @@ parser.add_argument('--eval-freq', default=1000, type=int, help='evaluation step
 
 # ======================== SavedModel Configs =========================
 parser.add_argument('--resume-training', default=0, type=int, help='resume training from checkpoints')
+parser.add_argument('--save-state-freq', default=1000, type=int, help='steps between resumable training states')
 parser.add_argument('--savedmodel-path', type=str, default='save/pair_mlm')
 parser.add_argument('--ckpt-file', type=str, default='save/diao/ckpt-40000')
 parser.add_argument('--max-to-keep', default=10, type=int, help='the number of checkpoints to keep')
@@ -35,6 +56,13 @@ parser.add_argument('--warmup-steps', default=1000, type=int)
 parser.add_argument('--minimum-lr', default=0., type=float, help='minimum learning rate')
 parser.add_argument('--lr', default=0.0005, type=float, help='initial learning rate')
 
+# ========================= Augmentation Configs ==========================
+parser.add_argument('--mlm-probability', default=0.15, type=float, help='share of title tokens the mlm trainers mask')
+parser.add_argument('--aug-frame-dropout', default=0., type=float, help='drop each train frame with this probability')
+parser.add_argument('--aug-frame-jitter', default=0., type=float, help='move train frames up to this many positions')
+parser.add_argument('--aug-token-mask', default=0., type=float, help='replace this share of train title tokens')
+parser.add_argument('--aug-swap-sides', default=0., type=float, help='swap the two videos of this share of train pairs')
+
 # ==================== Vision Modal Configs =======================
 parser.add_argument('--frame-embedding-size', type=int, default=1536)
 parser.add_argument('--max-frames', type=int, default=32)
@@ -49,7 +77,11 @@ parser.add_argument('--bert-seq-length', type=int, default=32)
 parser.add_argument('--bert-lr', type=float, default=3e-5)
 parser.add_argument('--bert-total-steps', type=int, default=60000)
 parser.add_argument('--bert-warmup-steps', type=int, default=2000)
+parser.add_argument('--bert-cache-size', type=int, default=0, help='LRU entries of cached title embeddings at inference, 0 is off')
+parser.add_argument('--xla-attention', type=int, default=0, help='jit compile the attention core of the Uniter BERT layers')
+parser.add_argument('--early-exit-heads', type=int, default=0, help='add residual exit heads to the Uniter encoders')
+parser.add_argument('--prune-spec', type=str, default='', help='prune_spec.json of a checkpoint exported by prune_backbone.py')
 
 # ====================== Fusion Configs ===========================
 parser.add_argument('--hidden-size', type=int, default=256, help='NO MORE THAN 256')
-parser.add_argument('--uniter-pooling', type=str, default='cls', help='cls & mean & max')
+parser.add_argument('--uniter-pooling', type=str, default='cls', help='cls & mean & max & masked_mean (ignores padding, use it with --bucket-boundaries)')
@@ -1,12 +1,98 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.keras.models import Model
 from transformers import TFBertModel, create_optimizer
 from transformers.models.bert.modeling_tf_bert import TFBertMLMHead
 from bert import TFBertModel_MM, shape_list
 from roformer import TFRoFormerModel_MM, TFRoFormerMLMHead
+from util import prune_spec_kwargs
 # from layers.transformer_layer import TransformerEncoder
 
 
+class TitleEmbeddingCache:
+    """LRU cache of the pooled BERT output of text-only BERT branches, keyed by a hash of (token ids, mask).
+
+    Outside training the pooled output is a pure function of the title, so repeated and templated titles
+    are encoded once; a batch only sends its (deduplicated) misses through BERT. For eager inference only
+    (inference_pair_b.py): training and tf.function calls, validation included, and max_size 0 go straight
+    to BERT. Entries do not record the weights they came from, call reset(ckpt_file) after every restore.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.checkpoint = None
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def reset(self, checkpoint=None):
+        self.checkpoint = checkpoint
+        self.entries.clear()
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, bert, input_ids, mask, training=False):
+        if training or not self.max_size or not tf.executing_eagerly():
+            return bert([input_ids, mask])[1]
+        keys = [hashlib.blake2b(ids.tobytes() + m.tobytes(), digest_size=16).digest()
+                for ids, m in zip(input_ids.numpy(), mask.numpy())]
+        found, missed = {}, {}
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+            elif key not in missed:
+                missed[key] = i
+        self.hits += len(keys) - len(missed)
+        self.misses += len(missed)
+        if missed:
+            rows = list(missed.values())
+            outputs = bert([tf.gather(input_ids, rows), tf.gather(mask, rows)])[1].numpy()
+            for key, output in zip(missed, outputs):
+                found[key] = output
+                self.entries[key] = output
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return tf.convert_to_tensor(np.stack([found[key] for key in keys]))
+
+
+def packed_frames(nextvlad, image_embeddings, num_frames):
+    """expand_dense / attention / cluster_dense1 of a NeXtVLAD layer on the valid frames of the batch only,
+    scattered back to [batch, num_segments, ...]. Padded frames are zeroed in the masked path, so they all
+    equal one zero frame that is computed once; batch norm still counts it once per padded slot, the output
+    is the same as running every slot."""
+    _, num_segments, _ = image_embeddings.shape
+    valid = tf.sequence_mask(tf.reshape(num_frames, [-1]), maxlen=num_segments)
+    indices = tf.where(valid)
+    num_valid = tf.shape(indices)[0]
+    num_padded = tf.size(valid) - num_valid
+
+    frames = tf.boolean_mask(image_embeddings, valid)
+    frames = tf.concat([frames, tf.zeros([1, nextvlad.feature_size], frames.dtype)], 0)  # last row is the zero frame
+    inputs = nextvlad.expand_dense(frames)
+    attention = nextvlad.attention_dense(inputs)
+    activation = nextvlad.cluster_dense1(inputs)
+    activation = tf.concat([activation[:-1], tf.repeat(activation[-1:], num_padded, axis=0)], 0)
+    activation = nextvlad.activation_bn(activation) # modify bn
+
+    def scatter(values, padding):
+        shape = tf.concat([tf.shape(valid, out_type=tf.int64), tf.shape(values, out_type=tf.int64)[1:]], 0)
+        return tf.where(tf.expand_dims(valid, -1), tf.scatter_nd(indices, values, shape), padding)
+
+    # without padded slots activation[-1:] is a valid frame, but then no slot takes the padding
+    return (scatter(inputs[:num_valid], inputs[-1:]), scatter(attention[:num_valid], attention[-1:]),
+            scatter(activation[:num_valid], activation[-1:]))
+
+
+def masked_mean(sequence_output, text_mask, frames_mask):
+    """Mean of the uniter outputs over the title tokens and frames the masks keep, padding left out (--uniter-pooling
+    masked_mean)."""
+    valid_mask = tf.concat([tf.cast(text_mask, tf.int32), frames_mask], 1)
+    valid_mask = tf.expand_dims(tf.cast(valid_mask, tf.float32), axis=2)
+    return tf.reduce_sum(sequence_output * valid_mask, 1) / tf.reduce_sum(valid_mask, 1)
+
+
 class NeXtVLAD(tf.keras.layers.Layer):
     def __init__(self, feature_size, cluster_size, output_size=1024, expansion=2, groups=8, dropout=0.2):
         super().__init__()
@@ -37,17 +123,15 @@ class NeXtVLAD(tf.keras.layers.Layer):
         image_embeddings, mask = inputs
         _, num_segments, _ = image_embeddings.shape
         if mask is not None:  # in case num of images is less than num_segments
-            images_mask = tf.sequence_mask(mask, maxlen=num_segments)
-            images_mask = tf.cast(tf.expand_dims(images_mask, -1), tf.float32)
-            image_embeddings = tf.multiply(image_embeddings, images_mask)
-        inputs = self.expand_dense(image_embeddings)
-        attention = self.attention_dense(inputs)
+            inputs, attention, activation = packed_frames(self, image_embeddings, mask)
+        else:
+            inputs = self.expand_dense(image_embeddings)
+            attention = self.attention_dense(inputs)
+            reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
+            activation = self.cluster_dense1(reshaped_input)
+            activation = self.activation_bn(activation) # modify bn
 
         attention = tf.reshape(attention, [-1, num_segments * self.groups, 1])
-        reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
-
-        activation = self.cluster_dense1(reshaped_input)
-        activation = self.activation_bn(activation) # modify bn
         activation = tf.reshape(activation, [-1, num_segments * self.groups, self.cluster_size])
         activation = tf.nn.softmax(activation, axis=-1)  # shape: batch_size * (max_frame*groups) * cluster_size
         activation = tf.multiply(activation, attention)  # shape: batch_size * (max_frame*groups) * cluster_size
@@ -213,7 +297,7 @@ class ConcatDenseSE(tf.keras.layers.Layer):
 class MultiModal(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextvlad = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
         self.fusion = ConcatDenseSE(config.hidden_size, config.se_ratio)
@@ -257,9 +341,10 @@ class MultiModal(Model):
 
 
 class MultiModal_soft(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.softdbof = SoftDBoF(config.frame_embedding_size,config.vlad_cluster_size,
                                 dropout=config.dropout,output_size=config.vlad_hidden_size)
         self.fusion = ConcatDenseSE(config.hidden_size, config.se_ratio)
@@ -304,7 +389,7 @@ class MultiModal_soft(Model):
 class MultiModal_nextsoft(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextsoftdbof = NextSoftDBoF(config.frame_embedding_size,config.vlad_cluster_size,
                                 dropout=config.dropout,output_size=config.vlad_hidden_size,groups=config.vlad_groups)
         self.fusion = ConcatDenseSE(config.hidden_size, config.se_ratio)
@@ -350,7 +435,7 @@ class MultiModal_nextsoft(Model):
 class MultiModal_mlm(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         # mlm head
         bert_config = self.bert.config
         self.mlm = TFBertMLMHead(bert_config, input_embeddings=self.bert.bert.embeddings, name="mlm___cls")
@@ -415,9 +500,12 @@ class MultiModal_mlm(Model):
 
 
 class Uniter(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir, xla_attention=config.xla_attention,
+                                                  early_exit_heads=config.early_exit_heads,
+                                                  **prune_spec_kwargs(config))
         tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -473,6 +561,8 @@ class Uniter(Model):
             bert_embedding = sequence_output[:,0]
         elif self.pooling == 'mean':
             bert_embedding = tf.reduce_mean(sequence_output, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding = masked_mean(sequence_output, inputs['mask'], images_mask)
         elif self.pooling == 'max':
             text_mask = 1-tf.cast(inputs['mask'], tf.int32)
             neg_mask = tf.concat([text_mask, 1-images_mask], 1)
@@ -512,7 +602,9 @@ class Uniter(Model):
 class Uniter_vlad(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir, xla_attention=config.xla_attention,
+                                                  early_exit_heads=config.early_exit_heads,
+                                                  **prune_spec_kwargs(config))
         tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -598,9 +690,11 @@ class Uniter_vlad(Model):
 
 
 class Uniter_roformer(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFRoFormerModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFRoFormerModel_MM.from_pretrained(config.bert_dir, early_exit_heads=config.early_exit_heads,
+                                                       **prune_spec_kwargs(config))
         tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -656,6 +750,8 @@ class Uniter_roformer(Model):
             bert_embedding = sequence_output[:,0]
         elif self.pooling == 'mean':
             bert_embedding = tf.reduce_mean(sequence_output, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding = masked_mean(sequence_output, inputs['mask'], images_mask)
         elif self.pooling == 'max':
             text_mask = 1-tf.cast(inputs['mask'], tf.int32)
             neg_mask = tf.concat([text_mask, 1-images_mask], 1)
@@ -3,7 +3,8 @@ from tensorflow.python.keras.models import Model
 from transformers import TFBertModel, create_optimizer
 from transformers.models.bert.modeling_tf_bert import TFBertMLMHead
 # from layers.transformer_layer import TransformerEncoder
-from cqrmodel import NextSoftDBoF
+from cqrmodel import NextSoftDBoF, TitleEmbeddingCache, packed_frames
+from util import prune_spec_kwargs
 
 
 class NeXtVLAD(tf.keras.layers.Layer):
@@ -36,17 +37,15 @@ class NeXtVLAD(tf.keras.layers.Layer):
         image_embeddings, mask = inputs
         _, num_segments, _ = image_embeddings.shape
         if mask is not None:  # in case num of images is less than num_segments
-            images_mask = tf.sequence_mask(mask, maxlen=num_segments)
-            images_mask = tf.cast(tf.expand_dims(images_mask, -1), tf.float32)
-            image_embeddings = tf.multiply(image_embeddings, images_mask)
-        inputs = self.expand_dense(image_embeddings)
-        attention = self.attention_dense(inputs)
+            inputs, attention, activation = packed_frames(self, image_embeddings, mask)
+        else:
+            inputs = self.expand_dense(image_embeddings)
+            attention = self.attention_dense(inputs)
+            reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
+            activation = self.cluster_dense1(reshaped_input)
+            activation = self.activation_bn(activation) # modify bn
 
         attention = tf.reshape(attention, [-1, num_segments * self.groups, 1])
-        reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
-
-        activation = self.cluster_dense1(reshaped_input)
-        activation = self.activation_bn(activation) # modify bn
         activation = tf.reshape(activation, [-1, num_segments * self.groups, self.cluster_size])
         activation = tf.nn.softmax(activation, axis=-1)  # shape: batch_size * (max_frame*groups) * cluster_size
         activation = tf.multiply(activation, attention)  # shape: batch_size * (max_frame*groups) * cluster_size
@@ -103,7 +102,8 @@ class ConcatDenseSE(tf.keras.layers.Layer):
 class MultiModal_mix(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
+        self.bert_cache = TitleEmbeddingCache(config.bert_cache_size)
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -137,7 +137,7 @@ class MultiModal_mix(Model):
         self.bert_variables, self.num_bert, self.normal_variables, self.all_variables = None, None, None, None
 
     def call(self, inputs, **kwargs):
-        bert_embedding = self.bert([inputs['input_ids'], inputs['mask']])[1]
+        bert_embedding = self.bert_cache(self.bert, inputs['input_ids'], inputs['mask'], kwargs.get('training'))
         bert_embedding = self.bert_map(bert_embedding)
         frame_num = tf.reshape(inputs['num_frames'], [-1])
         # frt_mean
@@ -211,7 +211,7 @@ class MultiModal_mix(Model):
 class MultiModal_mix5(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -344,7 +344,7 @@ class MultiModal_mix5(Model):
 class MultiModal_mix2(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
         self.nextvlad_2 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
@@ -417,7 +417,7 @@ class MultiModal_mix2(Model):
 class MultiModal_mlm(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         # mlm head
         bert_config = self.bert.config
         self.mlm = TFBertMLMHead(bert_config, input_embeddings=self.bert.bert.embeddings, name="mlm___cls")
@@ -484,7 +484,7 @@ class MultiModal_mlm(Model):
 class MultiModal_nextsoft_mix(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextsoftdbof_1 = NextSoftDBoF(config.frame_embedding_size,config.vlad_cluster_size,
                                 dropout=config.dropout,output_size=config.vlad_hidden_size,groups=config.vlad_groups)
         self.fusion_1 = ConcatDenseSE(config.hidden_size, config.se_ratio)
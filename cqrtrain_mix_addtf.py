@@ -8,7 +8,7 @@ from cqrconfig import parser
 from data_helper import create_datasets
 from cqrmetrics import Recorder
 from cqrmodel_mix_addtf import MultiModal_mix_addtf as MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, require_full_frames
 
 def ASLoss(y,x):
     y = tf.cast(y, tf.float32)
@@ -61,6 +61,7 @@ def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
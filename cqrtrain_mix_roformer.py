@@ -8,7 +8,7 @@ from cqrconfig import parser
 from data_helper_roformer import create_datasets
 from cqrmetrics import Recorder
 from cqrmodel_mix_roformer import MultiModal_mix as MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, set_seed, TrainState, HardNegativeRefresher, require_full_frames
 from cqrtrain_mix_asl import ASLoss
 
 def contrastive_loss(projections_1, projections_2):
@@ -42,6 +42,7 @@ def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
@@ -98,13 +99,17 @@ def train(args):
         return vids, mix_embedding
 
     # 6. training
-    for epoch in range(args.start_epoch, args.epochs):
-        for train_batch in train_dataset:
+    hard_negatives = HardNegativeRefresher(args, 'mix_roformer', model)
+    train_state = TrainState(args, model, checkpoint.step, train_dataset)
+    for epoch in train_state.epochs(args.epochs):
+        for train_batch in train_state.iterator:
             checkpoint.step.assign_add(1)
             step = checkpoint.step.numpy()
             if step > args.total_steps:
                 break
             train_step(train_batch)
+            train_state.maybe_save(step)
+            hard_negatives.maybe_refresh(step)
             if step % args.print_freq == 0:
                 train_recorder.log(epoch, step)
                 train_recorder.reset()
@@ -125,6 +130,7 @@ def train(args):
                 # 9. save checkpoints
                 if spearmanr > 0.45:
                     checkpoint_manager.save(checkpoint_number=step)
+    hard_negatives.close()
 
 
 def main():
@@ -132,6 +138,7 @@ def main():
                         format='%(asctime)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
     args = parser.parse_args()
+    set_seed(args)
 
     if not os.path.exists(args.savedmodel_path):
         os.makedirs(args.savedmodel_path)
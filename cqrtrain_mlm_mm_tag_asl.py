@@ -4,11 +4,13 @@ from pprint import pprint
 
 import tensorflow as tf
 from tensorflow import keras
+from transformers import BertTokenizer
+from augment import BatchAugmenter
 from cqrconfig import parser
 from data_helper_mlm import create_datasets
 from cqrmetrics import Recorder_3
 from cqrmodel import Uniter as MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, set_seed, TrainState, require_full_frames
 from cqrtrain_mix_asl import ASLoss
 
 def contrastive_loss(projections_1, projections_2):
@@ -70,7 +72,10 @@ def compute_loss(labels, logits):
 def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
+    # mlm masking and the --aug-* augmentation run on the batches in the steps
+    augmenter = BatchAugmenter(args, BertTokenizer.from_pretrained(args.bert_dir))
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
@@ -87,6 +92,7 @@ def train(args):
     # 5. define train and valid step function
     @tf.function
     def train_step(inputs):
+        inputs = augmenter(augmenter.mask_batch(inputs))
         labels = inputs['labels']
         with tf.GradientTape() as tape:
             predictions, bert_embedding, prediction_scores_mlm = model(inputs, training=True)
@@ -100,6 +106,7 @@ def train(args):
 
     @tf.function
     def val_step(inputs):
+        inputs = augmenter.mask_batch(inputs)
         vids = inputs['vid']
         labels = inputs['labels']
         predictions, bert_embedding, prediction_scores_mlm = model(inputs, training=False)
@@ -111,13 +118,15 @@ def train(args):
         return vids, bert_embedding
 
     # 6. training
-    for epoch in range(args.start_epoch, args.epochs):
-        for train_batch in train_dataset:
+    train_state = TrainState(args, model, checkpoint.step, train_dataset)
+    for epoch in train_state.epochs(args.epochs):
+        for train_batch in train_state.iterator:
             checkpoint.step.assign_add(1)
             step = checkpoint.step.numpy()
             if step > args.total_steps:
                 break
             train_step(train_batch)
+            train_state.maybe_save(step)
             if step % args.print_freq == 0:
                 train_recorder.log(epoch, step)
                 train_recorder.reset()
@@ -145,6 +154,7 @@ def main():
                         format='%(asctime)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
     args = parser.parse_args()
+    set_seed(args)
 
     if not os.path.exists(args.savedmodel_path):
         os.makedirs(args.savedmodel_path)
@@ -8,7 +8,7 @@ from cqrconfig import parser
 from tag_data_helper import create_datasets
 from cqrmetrics_simcse import Recorder
 from cqrmodel import MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, require_full_frames
 
 def contrastive_loss(projections_1, projections_2):
         # InfoNCE loss (information noise-contrastive estimation)
@@ -41,6 +41,7 @@ def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
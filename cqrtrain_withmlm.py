@@ -4,11 +4,13 @@ from pprint import pprint
 
 import tensorflow as tf
 from tensorflow import keras
+from transformers import BertTokenizer
+from augment import BatchAugmenter
 from cqrconfig import parser
 from data_helper_mlm import create_datasets
 from cqrmetrics import Recorder_3
 from cqrmodel import MultiModal_mlm as MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, require_full_frames
 
 def contrastive_loss(projections_1, projections_2):
     # InfoNCE loss (information noise-contrastive estimation)
@@ -69,7 +71,10 @@ def compute_loss(labels, logits):
 def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
+    # mlm masking and the --aug-* augmentation run on the batches in the steps
+    augmenter = BatchAugmenter(args, BertTokenizer.from_pretrained(args.bert_dir))
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
@@ -86,6 +91,7 @@ def train(args):
     # 5. define train and valid step function
     @tf.function
     def train_step(inputs):
+        inputs = augmenter(augmenter.mask_batch(inputs))
         labels = inputs['labels']
         with tf.GradientTape() as tape:
             predictions, _, vision_embedding, bert_embedding, prediction_scores_mlm = model(inputs, training=True)
@@ -99,6 +105,7 @@ def train(args):
 
     @tf.function
     def val_step(inputs):
+        inputs = augmenter.mask_batch(inputs)
         vids = inputs['vid']
         labels = inputs['labels']
         predictions, embeddings, vision_embedding, bert_embedding, prediction_scores_mlm = model(inputs, training=False)
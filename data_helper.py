@@ -4,9 +4,9 @@ import logging
 import numpy as np
 import tensorflow as tf
 from sklearn.preprocessing import MultiLabelBinarizer
-from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from transformers import BertTokenizer
 from config import parser
+from util import build_dataset, hard_negative_records, start_data_service
 
 
 class FeatureParser:
@@ -91,31 +91,37 @@ class FeatureParser:
         return {'input_ids': input_ids, 'mask': mask, 'frames': frames, 'num_frames': num_frames,
                 'vid': features['id'], 'labels': labels}#, 'category_id_1': category_id_1, 'category_id_2': category_id_2}
 
-    def create_dataset(self, files, training, batch_size):
-        if training:
-            np.random.shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE)
+    def create_dataset(self, files, training, batch_size, skip_vids=None, cache=False):
         feature_map = {'id': tf.io.FixedLenFeature([], tf.string),
                        'title': tf.io.FixedLenFeature([], tf.string),
                        'frame_feature': tf.io.VarLenFeature(tf.string),
                        'tag_id': tf.io.VarLenFeature(tf.int64)}
                     #    'category_id': tf.io.FixedLenFeature([], tf.int64)}
-        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
-        if training:
-            dataset = dataset.shuffle(buffer_size=batch_size * 8)
-        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
-        dataset = dataset.batch(batch_size, drop_remainder=training)
-        dataset = dataset.prefetch(buffer_size=AUTOTUNE)
-        return dataset
+        # every tf.data service worker runs the whole pipeline, see util.build_dataset
+        distributed = training and self.args.data_service_address
+        records, record_filter = None, None
+        if training and self.args.hard_negative_dir:
+            records = hard_negative_records(self.args.hard_negative_dir, None if distributed else self.args.seed,
+                                            self.args.num_shards, self.args.shard_index)
+        if skip_vids is not None and len(skip_vids):
+            # e.g. videos already in an embedding_store.EmbeddingStore, dropped before the costly parsing
+            skip_table = tf.lookup.StaticHashTable(
+                tf.lookup.KeyValueTensorInitializer(tf.constant(list(skip_vids)), tf.ones([len(skip_vids)], tf.int32)), 0)
+            record_filter = lambda x: tf.equal(skip_table.lookup(x['id']), 0)
+        return build_dataset(self.args, files, feature_map, self.parse, training, batch_size, batch_size * 8,
+                             bucket_lengths=(self.max_bert_length, self.max_frames), records=records,
+                             record_filter=record_filter, distributed=distributed, cache=cache)
 
 
 def create_datasets(args):
+    if args.data_service_workers:
+        start_data_service(args, 'data_helper')
     train_files = glob.glob(args.train_record_pattern)
     val_files = glob.glob(args.val_record_pattern)
 
     parser = FeatureParser(args)
     train_dataset = parser.create_dataset(train_files, training=True, batch_size=args.batch_size)
-    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size)
+    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size, cache=True)
 
     return train_dataset, val_dataset
 
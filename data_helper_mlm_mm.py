@@ -4,9 +4,9 @@ import logging
 import numpy as np
 import tensorflow as tf
 from sklearn.preprocessing import MultiLabelBinarizer
-from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from transformers import BertTokenizer
 from config import parser
+from util import build_dataset
 
 
 class FeatureParser:
@@ -27,54 +27,19 @@ class FeatureParser:
         self.mlb = MultiLabelBinarizer()
         self.mlb.fit([self.selected_tags])
 
-    def mask_tokens(self, inputs, mlm_probability, tokenizer, special_tokens_mask):
-        """
-        Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
-        """
-        labels = np.copy(inputs)
-        # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
-        probability_matrix = np.random.random_sample(labels.shape)
-        special_tokens_mask = special_tokens_mask.astype(np.bool_)
-
-        probability_matrix[special_tokens_mask] = 0.0
-        masked_indices = probability_matrix > (1 - mlm_probability)
-        labels[~masked_indices] = -100  # We only compute loss on masked tokens
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (np.random.random_sample(labels.shape) < 0.8) & masked_indices
-        inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
-
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = (np.random.random_sample(labels.shape) < 0.5) & masked_indices & ~indices_replaced
-        random_words = np.random.randint(low=0, high=len(tokenizer), size=np.count_nonzero(indices_random), dtype=np.int64)
-        inputs[indices_random] = random_words
-
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-        return inputs, labels
-
     def _encode(self, title):
-        mlm_probability = 0.15
         title = title.numpy().decode(encoding='utf-8')
-        encoded_inputs = self.tokenizer(title, max_length=self.max_bert_length, padding='max_length', truncation=True, return_special_tokens_mask=True)
-        example = self.tokenizer.pad(encoded_inputs, return_tensors="np", pad_to_multiple_of=None)
-        special_tokens_mask = example.pop("special_tokens_mask", None)
-        example["input_ids"], example["labels"] = self.mask_tokens(
-            example["input_ids"], mlm_probability, self.tokenizer, special_tokens_mask=special_tokens_mask)
-        if self.tokenizer.pad_token_id is not None:
-            example["labels"][example["labels"] == self.tokenizer.pad_token_id] = -100
-        example = {key: tf.convert_to_tensor(arr) for key, arr in example.items()}
-
-        input_ids = tf.cast(example['input_ids'], tf.int32)
-        mask = tf.cast(example['attention_mask'], tf.int32)
-        mask_labels = tf.cast(example['labels'], tf.int32)
-        return input_ids, mask, mask_labels
+        encoded_inputs = self.tokenizer(title, max_length=self.max_bert_length, padding='max_length', truncation=True)
+        input_ids = encoded_inputs['input_ids']
+        mask = encoded_inputs['attention_mask']
+        return input_ids, mask
 
     def _parse_title(self, title):
-        input_ids, mask, mask_labels = tf.py_function(self._encode, [title], [tf.int32, tf.int32, tf.int32])
+        # masked for mlm in the train step, augment.BatchAugmenter.mask_tokens
+        input_ids, mask = tf.py_function(self._encode, [title], [tf.int32, tf.int32])
         input_ids.set_shape([self.max_bert_length])
         mask.set_shape([self.max_bert_length])
-        mask_labels.set_shape([self.max_bert_length])
-        return input_ids, mask, mask_labels
+        return input_ids, mask
 
     def _sample(self, frames):
         frames = frames.numpy()
@@ -120,29 +85,20 @@ class FeatureParser:
         return id_1, id_2
 
     def parse(self, features):
-        input_ids, mask, mask_labels = self._parse_title(features['title'])
+        input_ids, mask = self._parse_title(features['title'])
         frames, num_frames = self._parse_frames(features['frame_feature'])
         labels = self._parse_labels(features['tag_id'])
         # category_id_1, category_id_2 = tf.py_function(self._parse_category, [features['category_id']], [tf.int8, tf.int8])
         return {'input_ids': input_ids, 'mask': mask, 'frames': frames, 'num_frames': num_frames,
-                'vid': features['id'], 'labels': labels, 'mask_labels': mask_labels}#, 'category_id_1': category_id_1, 'category_id_2': category_id_2}
+                'vid': features['id'], 'labels': labels}#, 'category_id_1': category_id_1, 'category_id_2': category_id_2}
 
-    def create_dataset(self, files, training, batch_size):
-        if training:
-            np.random.shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE)
+    def create_dataset(self, files, training, batch_size, cache=False):
         feature_map = {'id': tf.io.FixedLenFeature([], tf.string),
                        'title': tf.io.FixedLenFeature([], tf.string),
                        'frame_feature': tf.io.VarLenFeature(tf.string),
                        'tag_id': tf.io.VarLenFeature(tf.int64)}
                     #    'category_id': tf.io.FixedLenFeature([], tf.int64)}
-        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
-        if training:
-            dataset = dataset.shuffle(buffer_size=batch_size * 8)
-        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
-        dataset = dataset.batch(batch_size, drop_remainder=training)
-        dataset = dataset.prefetch(buffer_size=AUTOTUNE)
-        return dataset
+        return build_dataset(self.args, files, feature_map, self.parse, training, batch_size, batch_size * 8, cache=cache)
 
 
 def create_datasets(args):
@@ -151,7 +107,7 @@ def create_datasets(args):
 
     parser = FeatureParser(args)
     train_dataset = parser.create_dataset(train_files, training=True, batch_size=args.batch_size)
-    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size)
+    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size, cache=True)
 
     return train_dataset, val_dataset
 
@@ -4,9 +4,9 @@ import logging
 import numpy as np
 import tensorflow as tf
 from sklearn.preprocessing import MultiLabelBinarizer
-from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from transformers import BertTokenizer
 from config_pair import parser
+from util import build_dataset
 
 
 class FeatureParser:
@@ -27,53 +27,19 @@ class FeatureParser:
         self.mlb = MultiLabelBinarizer()
         self.mlb.fit([self.selected_tags])
 
-    def mask_tokens(self, inputs, mlm_probability, tokenizer, special_tokens_mask):
-        """
-        Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
-        """
-        labels = np.copy(inputs)
-        # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
-        probability_matrix = np.random.random_sample(labels.shape)
-        special_tokens_mask = special_tokens_mask.astype(np.bool_)
-
-        probability_matrix[special_tokens_mask] = 0.0
-        masked_indices = probability_matrix > (1 - mlm_probability)
-        labels[~masked_indices] = -100  # We only compute loss on masked tokens
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (np.random.random_sample(labels.shape) < 0.8) & masked_indices
-        inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
-
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = (np.random.random_sample(labels.shape) < 0.5) & masked_indices & ~indices_replaced
-        random_words = np.random.randint(low=0, high=len(tokenizer), size=np.count_nonzero(indices_random), dtype=np.int64)
-        inputs[indices_random] = random_words
-
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-        return inputs, labels
-        
     def _encode(self, title):
-        mlm_probability = 0.15
         title = title.numpy().decode(encoding='utf-8')
-        encoded_inputs = self.tokenizer(title, max_length=self.max_bert_length, padding='max_length', truncation=True, return_special_tokens_mask=True)
-        example = self.tokenizer.pad(encoded_inputs, return_tensors="np", pad_to_multiple_of=None)
-        special_tokens_mask = example.pop("special_tokens_mask", None)
-        example["input_ids"], example["labels"] = self.mask_tokens(
-            example["input_ids"], mlm_probability, self.tokenizer, special_tokens_mask=special_tokens_mask)
-        if self.tokenizer.pad_token_id is not None:
-            example["labels"][example["labels"] == self.tokenizer.pad_token_id] = -100
-        example = {key: tf.convert_to_tensor(arr) for key, arr in example.items()}
-
-        input_ids = tf.cast(example['input_ids'], tf.int32)
-        mask = tf.cast(example['attention_mask'], tf.int32)
-        mask_labels = tf.cast(example['labels'], tf.int32)
-        return input_ids, mask, mask_labels
+        encoded_inputs = self.tokenizer(title, max_length=self.max_bert_length, padding='max_length', truncation=True)
+        input_ids = encoded_inputs['input_ids']
+        mask = encoded_inputs['attention_mask']
+        return input_ids, mask
 
     def _parse_title(self, title):
-        input_ids, mask, mask_labels = tf.py_function(self._encode, [title], [tf.int32, tf.int32, tf.int32])
+        # masked for mlm in the train step, augment.BatchAugmenter.mask_tokens
+        input_ids, mask = tf.py_function(self._encode, [title], [tf.int32, tf.int32])
         input_ids.set_shape([self.max_bert_length])
         mask.set_shape([self.max_bert_length])
-        return input_ids, mask, mask_labels
+        return input_ids, mask
 
     def _sample(self, frames):
         frames = frames.numpy()
@@ -111,8 +77,8 @@ class FeatureParser:
         return labels
 
     def parse(self, features):
-        input_ids_1, mask_1, mask_labels_1 = self._parse_title(features['title_1'])
-        input_ids_2, mask_2, mask_labels_2 = self._parse_title(features['title_2'])
+        input_ids_1, mask_1 = self._parse_title(features['title_1'])
+        input_ids_2, mask_2 = self._parse_title(features['title_2'])
         frames_1, num_frames_1 = self._parse_frames(features['frame_feature_1'])
         frames_2, num_frames_2 = self._parse_frames(features['frame_feature_2'])
         labels_1 = self._parse_labels(features['tag_id_1'])
@@ -121,12 +87,9 @@ class FeatureParser:
         return {'input_ids_1': input_ids_1, 'mask_1': mask_1, 'frames_1': frames_1, 'num_frames_1': num_frames_1,
                 'vid_1': features['id_1'], 'labels_1': labels_1, 'input_ids_2': input_ids_2, 'mask_2': mask_2, 
                 'frames_2': frames_2, 'num_frames_2': num_frames_2,'vid_2': features['id_2'], 'labels_2': labels_2,
-                'sim': features['sim'], 'mask_labels_1': mask_labels_1, 'mask_labels_2': mask_labels_2}
+                'sim': features['sim']}
 
-    def create_dataset(self, files, training, batch_size):
-        if training:
-            np.random.shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE)
+    def create_dataset(self, files, training, batch_size, cache=False):
         feature_map = {'id_1': tf.io.FixedLenFeature([], tf.string),
                        'title_1': tf.io.FixedLenFeature([], tf.string),
                        'frame_feature_1': tf.io.VarLenFeature(tf.string),
@@ -137,13 +100,7 @@ class FeatureParser:
                        'tag_id_2': tf.io.VarLenFeature(tf.int64),
                        'sim': tf.io.FixedLenFeature([], tf.float32)
                        }
-        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
-        if training:
-            dataset = dataset.shuffle(buffer_size=batch_size * 10)
-        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
-        dataset = dataset.batch(batch_size, drop_remainder=training)
-        dataset = dataset.prefetch(buffer_size=AUTOTUNE)
-        return dataset
+        return build_dataset(self.args, files, feature_map, self.parse, training, batch_size, batch_size * 10, cache=cache)
 
 
 def create_datasets(args):
@@ -152,7 +109,7 @@ def create_datasets(args):
     print(train_files)
     parser = FeatureParser(args)
     train_dataset = parser.create_dataset(train_files, training=True, batch_size=args.batch_size)
-    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size)
+    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size, cache=True)
 
     return train_dataset, val_dataset
 
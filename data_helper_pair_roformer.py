@@ -7,6 +7,8 @@ from sklearn.preprocessing import MultiLabelBinarizer
 from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from transformers import RoFormerTokenizer
 from config_pair import parser
+from util import build_dataset
+from pair_table import create_table_datasets
 
 
 class FeatureParser:
@@ -88,10 +90,25 @@ class FeatureParser:
                 'frames_2': frames_2, 'num_frames_2': num_frames_2,'vid_2': features['id_2'], 'labels_2': labels_2,
                 'sim': features['sim']}
 
-    def create_dataset(self, files, training, batch_size):
-        if training:
-            np.random.shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE)
+    def _parse_video(self, features):
+        input_ids, mask = self._parse_title(features['title'])
+        frames, num_frames = self._parse_frames(features['frame_feature'])
+        labels = self._parse_labels(features['tag_id'])
+        return {'vid': features['id'], 'input_ids': input_ids, 'mask': mask, 'frames': frames,
+                'num_frames': num_frames, 'labels': labels}
+
+    def create_video_dataset(self, files, batch_size):
+        """Every video of pointwise records (e.g. pairwise.tfrecords) parsed once, to build pair_table.VideoTable."""
+        dataset = tf.data.TFRecordDataset(files)
+        feature_map = {'id': tf.io.FixedLenFeature([], tf.string),
+                       'title': tf.io.FixedLenFeature([], tf.string),
+                       'frame_feature': tf.io.VarLenFeature(tf.string),
+                       'tag_id': tf.io.VarLenFeature(tf.int64)}
+        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
+        dataset = dataset.map(self._parse_video, num_parallel_calls=AUTOTUNE)
+        return dataset.batch(batch_size).prefetch(buffer_size=AUTOTUNE)
+
+    def create_dataset(self, files, training, batch_size, cache=False):
         feature_map = {'id_1': tf.io.FixedLenFeature([], tf.string),
                        'title_1': tf.io.FixedLenFeature([], tf.string),
                        'frame_feature_1': tf.io.VarLenFeature(tf.string),
@@ -102,22 +119,19 @@ class FeatureParser:
                        'tag_id_2': tf.io.VarLenFeature(tf.int64),
                        'sim': tf.io.FixedLenFeature([], tf.float32)
                        }
-        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
-        if training:
-            dataset = dataset.shuffle(buffer_size=batch_size * 10)
-        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
-        dataset = dataset.batch(batch_size, drop_remainder=training)
-        dataset = dataset.prefetch(buffer_size=AUTOTUNE)
-        return dataset
+        return build_dataset(self.args, files, feature_map, self.parse, training, batch_size, batch_size * 10,
+                             bucket_lengths=(self.max_bert_length, self.max_frames), cache=cache)
 
 
 def create_datasets(args):
+    parser = FeatureParser(args)
+    if args.pair_table_dir:
+        return create_table_datasets(args, parser)
     train_files = glob.glob(args.train_record_pattern)
     val_files = glob.glob(args.val_record_pattern)
     print(train_files)
-    parser = FeatureParser(args)
     train_dataset = parser.create_dataset(train_files, training=True, batch_size=args.batch_size)
-    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size)
+    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size, cache=True)
 
     return train_dataset, val_dataset
 
@@ -0,0 +1,37 @@
+import importlib
+import logging
+
+import tensorflow as tf
+
+from cqrconfig import parser
+
+parser.add_argument('--data-helper', type=str, default='data_helper', help='data_helper & data_helper_roformer')
+parser.add_argument('--worker-port', type=int, default=0, help='0 picks a free one')
+parser.add_argument('--worker-address', type=str, default='',
+                    help='host:port the dispatcher reaches this worker at, needed on other hosts')
+
+
+def main():
+    """A tf.data service worker for the pretraining input pipeline.
+
+    The parse stages are py_functions, which a worker can only run if it registered the same functions under the
+    same tokens. So the worker first builds the datasets from the same flags as the trainer (the token order
+    follows the build order), then serves the pipelines the dispatcher hands it. Start it with the training
+    flags plus --data-service-address of the dispatcher; util.start_data_service does that for local workers.
+    """
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    # flags of the launching script beyond cqrconfig (e.g. benchmark_data_service.py) do not matter here
+    args, _ = parser.parse_known_args()
+    dispatcher_address = args.data_service_address.split('://')[-1]
+    args.data_service_workers, args.data_service_address = 0, ''
+    importlib.import_module(args.data_helper).create_datasets(args)
+    worker = tf.data.experimental.service.WorkerServer(args.worker_port, dispatcher_address,
+                                                       worker_address=args.worker_address or None)
+    logging.info(f'tf.data service worker serving {dispatcher_address}')
+    worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from retrieval import l2_normalize, load_embeddings
+
+parser = argparse.ArgumentParser(description="Cluster near-duplicate videos by a cosine similarity threshold")
+parser.add_argument('--embedding-file', type=str, default='result.json', help='.npz or .json, see retrieval.py')
+parser.add_argument('--threshold', type=float, default=0.95, help='pairs at or above this cosine are duplicates')
+parser.add_argument('--block-size', type=int, default=8192, help='rows per query / database block')
+parser.add_argument('--num-workers', type=int, default=0, help='processes sharing the query blocks, 0 is one per core')
+parser.add_argument('--output-file', type=str, default='clusters.tsv', help='vid \\t cluster (vid of its first member)')
+parser.add_argument('--report-file', type=str, default='clusters_report.json')
+
+
+class UnionFind:
+    """Disjoint sets over rows 0..n-1 with path halving and union by size."""
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.size = np.ones(n, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def union_edges(self, rows_1, rows_2):
+        for a, b in zip(rows_1.tolist(), rows_2.tolist()):
+            self.union(a, b)
+
+    def roots(self):
+        # pointer jumping, vectorized over all rows
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+
+def block_edges(args):
+    """Duplicate pairs of one query block against itself and every later block, reduced to a spanning forest
+    (member, root) of the rows involved, so what a worker returns is bounded by the rows it touched."""
+    matrix_file, start, block_size, threshold = args
+    embeddings = np.load(matrix_file, mmap_mode='r')
+    queries = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+    rows_1, rows_2 = [], []
+    for db_start in range(start, len(embeddings), block_size):
+        scores = queries @ np.asarray(embeddings[db_start:db_start + block_size], dtype=np.float32).T
+        if db_start == start:
+            # each pair once, and not a row with itself
+            scores[np.tri(*scores.shape, dtype=bool)] = -np.inf
+        hits_1, hits_2 = np.nonzero(scores >= threshold)
+        rows_1.append(hits_1 + start)
+        rows_2.append(hits_2 + db_start)
+    rows_1, rows_2 = np.concatenate(rows_1), np.concatenate(rows_2)
+    if not len(rows_1):
+        return rows_1, rows_2
+    touched, local = np.unique(np.concatenate([rows_1, rows_2]), return_inverse=True)
+    forest = UnionFind(len(touched))
+    forest.union_edges(local[:len(rows_1)], local[len(rows_1):])
+    roots = forest.roots()
+    members = np.nonzero(roots != np.arange(len(touched)))[0]
+    return touched[members], touched[roots[members]]
+
+
+def main():
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    vids, embeddings = load_embeddings(args.embedding_file)
+    print(f'{len(vids)} embeddings of dim {embeddings.shape[1]}, threshold {args.threshold}')
+
+    # normalized once to a float16 .npy every worker maps read-only, so memory per worker is one block pair
+    matrix_file = os.path.splitext(args.output_file)[0] + '.normalized.npy'
+    matrix = np.lib.format.open_memmap(matrix_file, 'w+', np.float16, embeddings.shape)
+    for start in range(0, len(embeddings), args.block_size):
+        matrix[start:start + args.block_size] = l2_normalize(embeddings[start:start + args.block_size])
+    matrix.flush()
+    del matrix, embeddings
+
+    clusters = UnionFind(len(vids))
+    tasks = [(matrix_file, start, args.block_size, args.threshold) for start in range(0, len(vids), args.block_size)]
+    num_edges = 0
+    with Pool(args.num_workers or os.cpu_count()) as pool:
+        # the first blocks are scored against the most later blocks, unordered results keep every worker busy
+        for done, (rows_1, rows_2) in enumerate(pool.imap_unordered(block_edges, tasks), start=1):
+            clusters.union_edges(rows_1, rows_2)
+            num_edges += len(rows_1)
+            if done % 10 == 0 or done == len(tasks):
+                print(f'{done}/{len(tasks)} query blocks, {time.perf_counter() - start_time:.0f}s')
+    os.remove(matrix_file)
+
+    roots = clusters.roots()
+    # a cluster is named by the vid of its smallest row
+    first_row = np.full(len(vids), len(vids), dtype=np.int64)
+    np.minimum.at(first_row, roots, np.arange(len(vids)))
+    with open(args.output_file, 'w') as f:
+        for vid, root in zip(vids, roots):
+            f.write(f'{vid}\t{vids[first_row[root]]}\n')
+
+    sizes = np.bincount(roots, minlength=len(vids))
+    sizes = sizes[sizes > 0]
+    report = {'videos': len(vids), 'threshold': args.threshold, 'clusters': int(len(sizes)),
+              'duplicate_clusters': int((sizes > 1).sum()), 'duplicate_videos': int(sizes[sizes > 1].sum()),
+              'largest_cluster': int(sizes.max()), 'forest_edges': num_edges,
+              'seconds': round(time.perf_counter() - start_time, 1)}
+    with open(args.report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from retrieval import EmbeddingIndex
+
+parser = argparse.ArgumentParser(description="Inspect, delete from and compact an append-only embedding store")
+parser.add_argument('--store-dir', type=str, required=True)
+parser.add_argument('--delete-vids', type=str, default='', help='file with one removed vid per line')
+parser.add_argument('--compact', action='store_true')
+parser.add_argument('--output-json', type=str, default='', help='write the live vid -> embedding map')
+parser.add_argument('--output-npz', type=str, default='', help='write the live vids + float16 matrix')
+
+MANIFEST = 'manifest.json'
+
+
+class EmbeddingStore:
+    """Append-only float16 embeddings of one checkpoint (set), stored as numbered segments.
+
+    An add segment is <name>.vids.npy + <name>.emb.npy, a delete segment (tombstones) only has the vids.
+    manifest.json lists the segments in order and is replaced atomically, so readers always see whole segments.
+    The newest segment mentioning a vid decides whether it is live. compact() rewrites the live rows of the
+    current segments as one add segment carrying the seq of the last one it merged; segments appended meanwhile
+    stay after it. Segment seqs only grow, which is what DeltaIndex.sync relies on. Files are never rewritten
+    in place, so memory mapped readers stay valid. One writer process per store, any number of reader processes:
+    readers reload manifest.json whenever it changed, and the files of compacted segments are only deleted
+    retain_seconds after the compaction, so a reader that loaded the old manifest can still read them.
+    """
+
+    def __init__(self, store_dir, key=None, retain_seconds=600):
+        self.store_dir = store_dir
+        self.retain_seconds = retain_seconds
+        self.lock = threading.Lock()
+        self.compactor, self.stop_event = None, threading.Event()
+        self.manifest_file = os.path.join(store_dir, MANIFEST)
+        self.manifest_mtime = None
+        if os.path.exists(self.manifest_file):
+            self._reload_manifest()
+            if key is not None and self.manifest['key'] != key:
+                raise ValueError(f'{store_dir} holds embeddings of {self.manifest["key"]}, not {key}')
+        else:
+            os.makedirs(store_dir, exist_ok=True)
+            self.manifest = {'key': key, 'next_seq': 0, 'segments': [], 'retired': []}
+            self._write_manifest()
+
+    def _reload_manifest(self, force=False):
+        """Re-read manifest.json if another process (the writer) replaced it since it was last read."""
+        mtime = os.stat(self.manifest_file).st_mtime_ns
+        if force or mtime != self.manifest_mtime:
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            self.manifest.setdefault('retired', [])
+            self.manifest_mtime = mtime
+
+    def _path(self, segment, suffix):
+        return os.path.join(self.store_dir, f'{segment["name"]}.{suffix}.npy')
+
+    def _write_manifest(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+        self.manifest_mtime = os.stat(self.manifest_file).st_mtime_ns
+
+    def _write_segment(self, kind, vids, embeddings=None, seq=None):
+        with self.lock:
+            name = f'seg-{self.manifest["next_seq"]:06d}'
+            if seq is None:
+                seq = self.manifest['next_seq']
+            else:
+                name += f'-compact-{seq:06d}'
+            self.manifest['next_seq'] += 1
+        segment = {'seq': seq, 'kind': kind, 'size': len(vids), 'name': name}
+        np.save(self._path(segment, 'vids'), np.asarray(vids).astype(str))
+        if embeddings is not None:
+            np.save(self._path(segment, 'emb'), np.asarray(embeddings, dtype=np.float16))
+        return segment
+
+    def append(self, vids, embeddings):
+        if not len(vids):
+            return
+        segment = self._write_segment('add', vids, embeddings)
+        with self.lock:
+            self.manifest['segments'].append(segment)
+            self._write_manifest()
+
+    def delete(self, vids):
+        if not len(vids):
+            return
+        segment = self._write_segment('delete', vids)
+        with self.lock:
+            self.manifest['segments'].append(segment)
+            self._write_manifest()
+
+    def segments(self, after_seq=-1, segments=None):
+        """(segment, vids, embeddings or None) of the segments newer than after_seq, embeddings memory mapped."""
+        with self.lock:
+            for attempt in range(2):
+                if segments is None:
+                    # a reader long past retain_seconds finds the merged files gone, the new manifest lists the
+                    # compacted segment instead
+                    self._reload_manifest(force=attempt > 0)
+                try:
+                    loaded = []
+                    for segment in self.manifest['segments'] if segments is None else segments:
+                        if segment['seq'] <= after_seq:
+                            continue
+                        vids = np.load(self._path(segment, 'vids'))
+                        embeddings = (np.load(self._path(segment, 'emb'), mmap_mode='r')
+                                      if segment['kind'] == 'add' else None)
+                        loaded.append((segment, vids, embeddings))
+                    return loaded
+                except FileNotFoundError:
+                    if segments is not None or attempt > 0:
+                        raise
+
+    def snapshot(self, segments=None):
+        """Live vids and their float16 embeddings (of the given segments, default all)."""
+        rows = {}
+        for segment, vids, embeddings in self.segments(segments=segments):
+            for row, vid in enumerate(vids):
+                if segment['kind'] == 'add':
+                    rows.pop(vid, None)
+                    rows[vid] = (embeddings, row)
+                else:
+                    rows.pop(vid, None)
+        if not rows:
+            return np.zeros([0], dtype=str), np.zeros([0, 0], dtype=np.float16)
+        return np.array(list(rows)), np.stack([embeddings[row] for embeddings, row in rows.values()])
+
+    def compact(self):
+        with self.lock:
+            merged = list(self.manifest['segments'])
+        if len(merged) <= 1 and all(s['kind'] == 'add' for s in merged):
+            return
+        vids, embeddings = self.snapshot(merged)
+        segment = self._write_segment('add', vids, embeddings, seq=merged[-1]['seq'])
+        with self.lock:
+            # segments appended while merging stay after the compacted one
+            self.manifest['segments'] = [segment] + self.manifest['segments'][len(merged):]
+            self.manifest['retired'] += [dict(old, retired_at=time.time()) for old in merged]
+            self._write_manifest()
+        self.remove_retired()
+        logging.info(f'Compacted {len(merged)} segments of {self.store_dir} into {len(vids)} live embeddings')
+
+    def remove_retired(self):
+        """Delete the files of segments compacted more than retain_seconds ago."""
+        with self.lock:
+            now = time.time()
+            expired = [old for old in self.manifest['retired'] if now - old['retired_at'] >= self.retain_seconds]
+            if not expired:
+                return
+            self.manifest['retired'] = [old for old in self.manifest['retired'] if old not in expired]
+            self._write_manifest()
+            for old in expired:
+                for suffix in ('vids', 'emb'):
+                    if os.path.exists(self._path(old, suffix)):
+                        os.remove(self._path(old, suffix))
+
+    def start_compaction(self, max_segments=8, interval=60):
+        """Compact in a background thread whenever more than max_segments segments have piled up."""
+
+        def compact_loop():
+            while True:
+                try:
+                    if len(self.manifest['segments']) > max_segments:
+                        self.compact()
+                    else:
+                        self.remove_retired()
+                except Exception:
+                    logging.exception(f'Compacting {self.store_dir} failed')
+                if self.stop_event.wait(interval):
+                    break
+
+        self.compactor = threading.Thread(target=compact_loop, daemon=True)
+        self.compactor.start()
+
+    def close(self):
+        if self.compactor is not None:
+            self.stop_event.set()
+            self.compactor.join()
+
+
+class DeltaIndex:
+    """A search index over a store snapshot plus the changes appended to the store since.
+
+    base is an index of the snapshot with search(queries, k) -> (scores, vids), e.g. ivfpq.IVFPQIndex, built
+    from the store segments up to base_seq; without one the snapshot is searched exactly. Vids added since go
+    to a small exact delta index, base entries of vids deleted or re-added since are hidden from the results.
+    Rebuild the base once the delta has grown large (compacting the store first).
+    """
+
+    def __init__(self, store, base=None, base_seq=None, **kwargs):
+        self.store = store
+        self.kwargs = kwargs
+        if base is None:
+            # the segments of one manifest version, the writer may append or compact meanwhile
+            with store.lock:
+                store._reload_manifest()
+                segments = list(store.manifest['segments'])
+            base_seq = max([s['seq'] for s in segments], default=-1)
+            vids, embeddings = store.snapshot(segments)
+            base = ExactVidIndex(vids, embeddings, **kwargs) if len(vids) else None
+        self.base, self.applied_seq = base, base_seq
+        self.base_vids = set(np.asarray(base.vids).astype(str)) if base is not None else set()
+        self.hidden = set()
+        self.delta_rows = {}
+        self.delta = None
+
+    def sync(self):
+        """Apply the store segments appended since the last sync."""
+        changed = False
+        for segment, vids, embeddings in self.store.segments(after_seq=self.applied_seq):
+            for row, vid in enumerate(vids.astype(str)):
+                if vid in self.base_vids:
+                    self.hidden.add(vid)
+                if segment['kind'] == 'add':
+                    self.delta_rows[vid] = np.asarray(embeddings[row])
+                else:
+                    self.delta_rows.pop(vid, None)
+            self.applied_seq = segment['seq']
+            changed = True
+        if changed:
+            self.delta = ExactVidIndex(np.array(list(self.delta_rows)), np.stack(list(self.delta_rows.values())),
+                                       **self.kwargs) if self.delta_rows else None
+
+    def search(self, queries, k):
+        """Merged (scores, vids) of every query over the base and the delta, best first."""
+        queries = np.atleast_2d(queries)
+        parts = []
+        if self.base is not None:
+            parts.append(self.base.search(queries, k + len(self.hidden)) + (self.hidden,))
+        if self.delta is not None:
+            parts.append(self.delta.search(queries, k) + (set(),))
+        results_scores, results_vids = [], []
+        for i in range(len(queries)):
+            hits = sorted(((float(score), str(vid)) for scores, vids, hidden in parts
+                           for score, vid in zip(scores[i], vids[i]) if vid != '' and str(vid) not in hidden),
+                          reverse=True)[:k]
+            results_scores.append([h[0] for h in hits])
+            results_vids.append([h[1] for h in hits])
+        return results_scores, results_vids
+
+
+class ExactVidIndex(EmbeddingIndex):
+    """EmbeddingIndex.search returning vids, the interface DeltaIndex expects of its base."""
+
+    def search(self, queries, k):
+        scores, indices = super().search(queries, k)
+        return scores, self.vids[indices]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    store = EmbeddingStore(args.store_dir)
+    if args.delete_vids:
+        with open(args.delete_vids) as f:
+            vids = [line.strip() for line in f if line.strip()]
+        store.delete(vids)
+        logging.info(f'Tombstoned {len(vids)} vids')
+    if args.compact:
+        store.compact()
+    vids, embeddings = store.snapshot()
+    logging.info(f'{store.manifest["key"]}: {len(vids)} live embeddings in {len(store.manifest["segments"])} segments')
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump({vid: embedding.tolist() for vid, embedding in zip(vids, embeddings)}, f)
+    if args.output_npz:
+        np.savez(args.output_npz, vids=vids, embeddings=embeddings)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import tensorflow as tf
 from config_pair import parser
 from data_helper_pair import FeatureParser
 from model_pair import MultiModal
+from util import require_full_frames
 import numpy as np
 from scipy.stats import spearmanr
 
@@ -22,7 +23,8 @@ def val_step_1(inputs, model):
 def main(args):
     files = args.val_record_pattern
     feature_parser = FeatureParser(args)
-    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size)
+    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size, cache=True)
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     checkpoint = tf.train.Checkpoint(model=model)
     checkpoint.restore(args.ckpt_file).expect_partial()
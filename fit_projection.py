@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from util import test_spearmanr
+
+parser = argparse.ArgumentParser(description="Fit a PCA / whitening projection of the ensemble embeddings")
+parser.add_argument('--embedding-json', type=str, default='result.json', help='vid -> embedding, e.g. ensemble output')
+parser.add_argument('--annotation-file', type=str, default='data/pairwise/label.tsv',
+                    help='pairs to report spearman on, empty skips the report')
+parser.add_argument('--dims', type=str, default='64,128', help='comma separated reduced dimensions to report')
+parser.add_argument('--eps', type=float, default=1e-6, help='added to the eigenvalues before whitening')
+parser.add_argument('--projection-file', type=str, default='projection.npz')
+parser.add_argument('--report-file', type=str, default='projection_report.md')
+parser.add_argument('--output-dim', type=int, default=0, help='also write the projected embeddings, 0 is off')
+parser.add_argument('--output-method', type=str, default='pca', help='prefix & pca & whiten')
+parser.add_argument('--output-file', type=str, default='result_reduced.npz', help='vids + float16 embeddings')
+
+
+def fit(embeddings):
+    """Mean, principal directions (rows, by decreasing variance) and their variances."""
+    mean = embeddings.mean(axis=0)
+    _, singular_values, components = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return mean, components, singular_values ** 2 / (len(embeddings) - 1)
+
+
+def project(embeddings, projection, dim, method):
+    if method == 'prefix':
+        # Matryoshka trained embeddings (--matryoshka-dims) keep their leading dimensions
+        return embeddings[:, :dim]
+    reduced = (embeddings - projection['mean']) @ projection['components'][:dim].T
+    if method == 'whiten':
+        reduced /= np.sqrt(projection['variances'][:dim] + projection['eps'])
+    return reduced
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.embedding_json) as f:
+        vid_embedding = json.load(f)
+    vids = list(vid_embedding)
+    embeddings = np.array([vid_embedding[vid] for vid in vids], dtype=np.float64)
+    print(f'{len(vids)} embeddings of dim {embeddings.shape[1]}')
+
+    mean, components, variances = fit(embeddings)
+    np.savez(args.projection_file, mean=mean, components=components, variances=variances, eps=args.eps)
+    projection = dict(np.load(args.projection_file))
+    explained = np.cumsum(variances) / variances.sum()
+    print(f'Saved {args.projection_file}')
+
+    if args.annotation_file:
+        full_dim = embeddings.shape[1]
+        rows = [('full', full_dim, test_spearmanr(vid_embedding, args.annotation_file))]
+        for dim in sorted(int(d) for d in args.dims.split(',') if d):
+            for method in ('prefix', 'pca', 'whiten'):
+                reduced = project(embeddings, projection, dim, method)
+                spearman = test_spearmanr(dict(zip(vids, reduced)), args.annotation_file)
+                rows.append((method, dim, spearman))
+        lines = ['| method | dim | explained var | spearman | delta | bytes / vid (fp16) |', '|---|---|---|---|---|---|']
+        for method, dim, spearman in rows:
+            variance = '-' if method == 'prefix' else f'{explained[dim - 1]:.3f}'
+            lines.append(f'| {method} | {dim} | {variance} | {spearman:.4f} | {spearman - rows[0][2]:+.4f} | {dim * 2} |')
+        with open(args.report_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(os.path.splitext(args.report_file)[0] + '.json', 'w') as f:
+            json.dump([{'method': m, 'dim': d, 'spearman': float(s)} for m, d, s in rows], f, indent=2)
+        print('\n'.join(lines))
+
+    if args.output_dim:
+        reduced = project(embeddings, projection, args.output_dim, args.output_method)
+        np.savez(args.output_file, vids=np.array(vids), embeddings=reduced.astype(np.float16))
+        print(f'Wrote {len(vids)} x {args.output_dim} {args.output_method} embeddings to {args.output_file}')
+
+
+if __name__ == '__main__':
+    main()
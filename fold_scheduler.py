@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import queue
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description="Run the k-fold pair finetuning of one model family in parallel")
+
+parser.add_argument('--train-script', type=str, default='train_pair_mix.py', help='family training script')
+parser.add_argument('--fold-pattern', type=str, default='data/pairwise/*val', help='one directory per fold')
+parser.add_argument('--savedmodel-path', type=str, default='save/10fold/10fold_{}_mix',
+                    help='{} is replaced by the fold number (1-based)')
+parser.add_argument('--folds', type=str, default='', help='comma separated fold numbers, empty means all')
+parser.add_argument('--num-jobs', default=0, type=int, help='concurrent fold jobs, 0 means one per fold')
+parser.add_argument('--gpus', type=str, default='', help='comma separated GPU ids assigned round-robin to jobs')
+parser.add_argument('--intra-op-threads', default=0, type=int, help='0 means all cores pinned to the job')
+parser.add_argument('--inter-op-threads', default=2, type=int)
+parser.add_argument('--summary-file', type=str, default='', help='defaults to <savedmodel dir>/summary.md')
+parser.add_argument('train_args', nargs=argparse.REMAINDER, help='passed through to the training script')
+
+RESULT_FILE = 'fold_result.json'
+SPEARMAN_PATTERN = re.compile(r'step: (\d+),.*spearmanr (\S+)')
+
+
+def find_folds(fold_pattern):
+    """Fold dirs are named <start>-<end>val, fold 1 is the one starting at 0 (see run_10fold.sh)."""
+    fold_dirs = [d for d in glob.glob(fold_pattern) if os.path.isdir(d)]
+    fold_dirs.sort(key=lambda d: int(os.path.basename(d).split('-')[0]))
+    return {i + 1: d for i, d in enumerate(fold_dirs)}
+
+
+def is_complete(savedmodel_path):
+    # written only when the training script exits cleanly, with or without a kept checkpoint
+    return os.path.exists(os.path.join(savedmodel_path, RESULT_FILE))
+
+
+def kept_ckpts(savedmodel_path):
+    # index written by util.AsyncCheckpointSaver, best checkpoint first
+    ckpt_index = os.path.join(savedmodel_path, 'best_ckpts.json')
+    if not os.path.exists(ckpt_index):
+        return []
+    with open(ckpt_index) as f:
+        return [c for c in json.load(f) if os.path.exists(c['file'] + '.index')]
+
+
+def best_ckpt(savedmodel_path):
+    kept = kept_ckpts(savedmodel_path)
+    return kept[0]['file'] if kept else None
+
+
+def resume_state(savedmodel_path):
+    """The latest train state (util.TrainState: weights, optimizer slots, step and input position) an interrupted
+    run of the fold saved, the training script restores it with --resume-training."""
+    state_file = os.path.join(savedmodel_path, 'train_state', 'checkpoint')
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        match = re.search(r'^model_checkpoint_path: "(.*)"$', f.read(), re.M)
+    return match.group(1) if match else None
+
+
+def parse_spearman(log_file):
+    scores = []
+    with open(log_file, encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            match = SPEARMAN_PATTERN.search(line)
+            if match:
+                scores.append((int(match.group(1)), float(match.group(2))))
+    return scores
+
+
+def split_cores(num_jobs):
+    cores = sorted(os.sched_getaffinity(0))
+    per_job = max(len(cores) // num_jobs, 1)
+    return [cores[(i * per_job) % len(cores):(i * per_job) % len(cores) + per_job] for i in range(num_jobs)]
+
+
+def run_fold(args, fold, fold_dir, slots, core_groups, gpus):
+    slot = slots.get()
+    try:
+        cores = core_groups[slot]
+        savedmodel_path = args.savedmodel_path.format(fold)
+        os.makedirs(savedmodel_path, exist_ok=True)
+        cmd = [sys.executable, args.train_script,
+               '--savedmodel-path', savedmodel_path,
+               '--train-record-pattern', os.path.join(fold_dir, 'train.tfrecord'),
+               '--val-record-pattern', os.path.join(fold_dir, 'val.tfrecord'),
+               '--fold', str(fold - 1),
+               '--intra-op-threads', str(args.intra_op_threads or len(cores)),
+               '--inter-op-threads', str(args.inter_op_threads)] + args.train_args
+        state = resume_state(savedmodel_path)
+        if state:
+            # after the passed through args, so it wins over theirs
+            cmd += ['--resume-training', '1']
+            logging.info(f'fold{fold} resumes from {state}')
+        env = dict(os.environ, TF_FORCE_GPU_ALLOW_GROWTH='true', OMP_NUM_THREADS=str(len(cores)))
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[slot % len(gpus)]
+        logging.info(f'fold{fold}! {os.path.basename(fold_dir)} on cores {cores[0]}-{cores[-1]}')
+
+        start = time.time()
+        log_file = os.path.join(savedmodel_path, 'train.log')
+        with open(log_file, 'a' if state else 'w') as log:
+            returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env,
+                                         preexec_fn=lambda: os.sched_setaffinity(0, cores))
+        wall_time = time.time() - start
+
+        scores = parse_spearman(log_file)
+        result = {'fold': fold, 'fold_dir': fold_dir, 'returncode': returncode, 'wall_time': wall_time,
+                  'ckpt': best_ckpt(savedmodel_path),
+                  'best_step': max(scores, key=lambda s: s[1])[0] if scores else None,
+                  'best_spearman': max(s[1] for s in scores) if scores else None,
+                  'last_spearman': scores[-1][1] if scores else None}
+        if returncode == 0:
+            with open(os.path.join(savedmodel_path, RESULT_FILE), 'w') as f:
+                json.dump(result, f, indent=2)
+        else:
+            logging.error(f'fold{fold} failed with code {returncode}, see {log_file}')
+        return result
+    finally:
+        slots.put(slot)
+
+
+def write_summary(results, summary_file):
+    lines = ['| fold | best step | best spearman | last spearman | wall time (min) | status |',
+             '|---|---|---|---|---|---|']
+    for r in sorted(results, key=lambda r: r['fold']):
+        fmt = lambda x: 'x' if x is None else f'{x:.4f}'
+        lines.append(f"| {r['fold']} | {r['best_step']} | {fmt(r['best_spearman'])} | {fmt(r['last_spearman'])} | "
+                     f"{r['wall_time'] / 60:.1f} | {'ok' if r['returncode'] == 0 else 'failed'} |")
+    with open(summary_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    if args.train_args and args.train_args[0] == '--':
+        args.train_args = args.train_args[1:]
+
+    folds = find_folds(args.fold_pattern)
+    if args.folds:
+        folds = {i: folds[i] for i in map(int, args.folds.split(','))}
+
+    results, todo = [], {}
+    for fold, fold_dir in folds.items():
+        savedmodel_path = args.savedmodel_path.format(fold)
+        if is_complete(savedmodel_path):
+            logging.info(f'fold{fold} already finished, skip')
+            with open(os.path.join(savedmodel_path, RESULT_FILE)) as f:
+                results.append(json.load(f))
+        else:
+            todo[fold] = fold_dir
+
+    num_jobs = min(args.num_jobs or len(todo), len(todo)) or 1
+    core_groups = split_cores(num_jobs)
+    gpus = [g for g in args.gpus.split(',') if g]
+    slots = queue.Queue()
+    for slot in range(num_jobs):
+        slots.put(slot)
+
+    with ThreadPoolExecutor(max_workers=num_jobs) as executor:
+        futures = [executor.submit(run_fold, args, fold, fold_dir, slots, core_groups, gpus)
+                   for fold, fold_dir in todo.items()]
+        results += [future.result() for future in futures]
+
+    summary_file = args.summary_file or os.path.join(os.path.dirname(args.savedmodel_path.format(0)), 'summary.md')
+    write_summary(results, summary_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@ from util import *
 import numpy as np
 import tensorflow as tf
 from sklearn.preprocessing import MultiLabelBinarizer
-from tensorflow.python.data.ops.dataset_ops import AUTOTUNE
 from transformers import BertTokenizer
 
 
@@ -89,10 +88,7 @@ class FeatureParser:
                 'input_ids_2': input_ids_2, 'mask_2': mask_2, 'frames_2': frames_2, 'num_frames_2': num_frames_2,
                 'vid_2': features['id_2'], 'labels_2': labels_2, 'sim': features['sim']}
 
-    def create_dataset(self, files, training, batch_size):
-        if training:
-            np.random.shuffle(files)
-        dataset = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE)
+    def create_dataset(self, files, training, batch_size, cache=False):
         feature_map = {'id_1': tf.io.FixedLenFeature([], tf.string),
                        'title_1': tf.io.FixedLenFeature([], tf.string),
                        # 'asr_text': tf.io.FixedLenFeature([], tf.string),
@@ -107,13 +103,7 @@ class FeatureParser:
                        'category_id_2': tf.io.FixedLenFeature([], tf.int64),
                        'sim': tf.io.FixedLenFeature([], tf.float32)
                        }
-        dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map), num_parallel_calls=AUTOTUNE)
-        if training:
-            dataset = dataset.shuffle(buffer_size=batch_size * 10)
-        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
-        dataset = dataset.batch(batch_size, drop_remainder=training)
-        dataset = dataset.prefetch(buffer_size=AUTOTUNE)
-        return dataset
+        return build_dataset(self.args, files, feature_map, self.parse, training, batch_size, batch_size * 10, cache=cache)
 
 
 def create_datasets(args):
@@ -122,6 +112,6 @@ def create_datasets(args):
 
     parser = FeatureParser(args)
     train_dataset = parser.create_dataset(train_files, training=True, batch_size=args.batch_size)
-    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size)
+    val_dataset = parser.create_dataset(val_files, training=False, batch_size=args.val_batch_size, cache=True)
 
     return train_dataset, val_dataset
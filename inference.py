@@ -7,13 +7,15 @@ import tensorflow as tf
 from config import parser
 from data_helper import FeatureParser
 from model import MultiModal
+from util import require_full_frames
 
 
 def main():
     args = parser.parse_args()
     feature_parser = FeatureParser(args)
     files = args.test_a_file
-    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size)
+    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size, cache=True)
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     checkpoint = tf.train.Checkpoint(model=model)
     checkpoint.restore(args.ckpt_file)
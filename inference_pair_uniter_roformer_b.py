@@ -5,6 +5,8 @@ import numpy as np
 import tensorflow as tf
 
 from config_pair import parser
+from util import resolve_ckpt, set_inference_depth, write_embedding_matrix, require_full_frames
+from embedding_store import EmbeddingStore
 from data_helper_roformer import FeatureParser
 from cqrmodel import Uniter_roformer as MultiModal
 
@@ -13,11 +15,23 @@ def main():
     args = parser.parse_args()
     feature_parser = FeatureParser(args)
     files = args.test_b_file
-    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size)
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     checkpoint = tf.train.Checkpoint(model=model)
-    checkpoint.restore(args.ckpt_file).expect_partial()
-    print(f"Restored from {args.ckpt_file}")
+    ckpt_file = resolve_ckpt(args.ckpt_file)
+    checkpoint.restore(ckpt_file).expect_partial()
+    print(f"Restored from {ckpt_file}")
+    if args.num_layers_infer:
+        set_inference_depth(model.bert, args.num_layers_infer)
+    store, skip_vids = None, None
+    if args.embedding_store:
+        # one store per checkpoint (and inference depth / pruning), only vids it does not hold yet are encoded
+        store = EmbeddingStore(args.embedding_store, key=[ckpt_file, args.num_layers_infer, args.prune_spec])
+        skip_vids, _ = store.snapshot()
+        store.start_compaction(args.store_max_segments)
+        print(f"{len(skip_vids)} vids already in {args.embedding_store}")
+    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.test_batch_size,
+                                            skip_vids=skip_vids, cache=True)
 
     vid_embedding = {}
     for batch in dataset:
@@ -26,10 +40,18 @@ def main():
         embeddings = embeddings.numpy().astype(np.float16)
         for vid, embedding in zip(vids, embeddings):
             vid_embedding[vid] = embedding.tolist()
+    if store is not None:
+        store.append(list(vid_embedding), [vid_embedding[vid] for vid in vid_embedding])
+        store.close()
+        vids, embeddings = store.snapshot()
+        print(f"{len(vid_embedding)} vids encoded, {len(vids)} in the store")
+        vid_embedding = {vid: embedding.tolist() for vid, embedding in zip(vids, embeddings)}
     with open(args.output_json, 'w') as f:
         json.dump(vid_embedding, f)
     with ZipFile(args.output_zip, 'w', compression=ZIP_DEFLATED) as zip_file:
         zip_file.write(args.output_json)
+    if args.output_npz:
+        write_embedding_matrix(args.output_npz, vid_embedding)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from retrieval import EmbeddingIndex, l2_normalize, load_embeddings, top_k
+
+parser = argparse.ArgumentParser(description="Build an IVF-PQ index of video embeddings and report its recall")
+parser.add_argument('--embedding-file', type=str, default='result.npz', help='.npz or .json, see retrieval.py')
+parser.add_argument('--index-dir', type=str, default='ivfpq_index')
+parser.add_argument('--nlist', type=int, default=1024, help='coarse k-means clusters')
+parser.add_argument('--m', type=int, default=32, help='PQ sub-quantizers, must divide the embedding dim')
+parser.add_argument('--train-size', type=int, default=100000, help='embeddings sampled to train the quantizers')
+parser.add_argument('--kmeans-iters', type=int, default=20)
+parser.add_argument('--nprobe', type=str, default='8,16,32', help='comma separated lists probed per query')
+parser.add_argument('--top-k', type=int, default=10)
+parser.add_argument('--num-queries', type=int, default=1000, help='indexed embeddings queried for recall')
+parser.add_argument('--seed', type=int, default=2021)
+
+
+def kmeans(x, k, iters, rng, block_size=65536):
+    """Lloyd's k-means (euclidean), assignments computed in blocks; empty clusters are re-seeded."""
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_nearest(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_nearest(x, centroids, block_size=65536):
+    half_norms = 0.5 * np.sum(centroids ** 2, axis=1)
+    return np.concatenate([np.argmax(x[i:i + block_size] @ centroids.T - half_norms, axis=1)
+                           for i in range(0, len(x), block_size)])
+
+
+class IVFPQIndex:
+    """Inverted file over a coarse k-means quantizer with product-quantized residuals, for cosine search.
+
+    Embeddings are L2-normalized; each is stored as its list (coarse centroid) and m uint8 codes of its residual.
+    The inner product with a query is q . centroid + sum_j lut[j, code_j], where lut[j] holds q_j . codeword for
+    the 256 codewords of sub-space j, so a query costs one [m, 256] table plus a gather per probed row.
+    save() writes one .npy per array with the rows sorted by list, load() maps them read-only.
+    """
+
+    def __init__(self, nlist=1024, m=32):
+        self.nlist, self.m = nlist, m
+        self.centroids, self.codebooks = None, None
+        self.codes = np.zeros([0, m], dtype=np.uint8)
+        self.lists = np.zeros([0], dtype=np.int32)
+        self.vids = np.zeros([0], dtype=str)
+        self.offsets = np.zeros([nlist + 1], dtype=np.int64)
+
+    def train(self, x, iters=20, seed=2021):
+        if x.shape[1] % self.m:
+            raise ValueError(f'{self.m} sub-quantizers do not divide dim {x.shape[1]}')
+        rng = np.random.default_rng(seed)
+        x = l2_normalize(x)
+        self.centroids = kmeans(x, self.nlist, iters, rng)
+        residuals = x - self.centroids[assign_nearest(x, self.centroids)]
+        sub_dim = x.shape[1] // self.m
+        self.codebooks = np.stack([kmeans(residuals[:, j * sub_dim:(j + 1) * sub_dim], 256, iters, rng)
+                                   for j in range(self.m)])
+
+    def encode(self, x):
+        x = l2_normalize(x)
+        lists = assign_nearest(x, self.centroids)
+        residuals = x - self.centroids[lists]
+        sub_dim = self.codebooks.shape[2]
+        codes = np.stack([assign_nearest(residuals[:, j * sub_dim:(j + 1) * sub_dim], self.codebooks[j])
+                          for j in range(self.m)], axis=1)
+        return lists.astype(np.int32), codes.astype(np.uint8)
+
+    def add(self, vids, x, block_size=65536):
+        encoded = [self.encode(x[i:i + block_size]) for i in range(0, len(x), block_size)]
+        lists, codes = np.concatenate([e[0] for e in encoded]), np.concatenate([e[1] for e in encoded])
+        lists = np.concatenate([self.lists, lists])
+        order = np.argsort(lists, kind='stable')
+        self.lists = lists[order]
+        self.codes = np.concatenate([self.codes, codes])[order]
+        self.vids = np.concatenate([self.vids, np.asarray(vids).astype(str)])[order]
+        self.offsets = np.searchsorted(self.lists, np.arange(self.nlist + 1)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def search(self, queries, k, nprobe=16):
+        """Approximate cosine scores and vids of the k nearest embeddings of every query, best first."""
+        queries = l2_normalize(np.atleast_2d(queries))
+        sub_dim = self.codebooks.shape[2]
+        probes = top_k(queries @ self.centroids.T, nprobe)
+        all_scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+        all_vids = np.full([len(queries), k], '', dtype=self.vids.dtype)
+        for i, query in enumerate(queries):
+            lut = np.einsum('jd,jcd->jc', query.reshape(self.m, sub_dim), self.codebooks)
+            rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes[i]])
+            if not len(rows):
+                continue
+            codes = np.asarray(self.codes[rows])
+            scores = (query @ self.centroids[np.asarray(self.lists[rows])].T
+                      + lut[np.arange(self.m), codes].sum(axis=1))
+            best = top_k(scores[None], k)[0]
+            all_scores[i, :len(best)] = scores[best]
+            all_vids[i, :len(best)] = self.vids[rows[best]]
+        return all_scores, all_vids
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.centroids, self.codebooks, self.codes, self.lists, self.offsets))
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ('centroids', 'codebooks', 'codes', 'lists', 'vids', 'offsets'):
+            np.save(os.path.join(index_dir, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump({'nlist': self.nlist, 'm': self.m, 'size': len(self)}, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls(meta['nlist'], meta['m'])
+        for name in ('centroids', 'codebooks', 'offsets'):
+            setattr(index, name, np.load(os.path.join(index_dir, f'{name}.npy')))
+        for name in ('codes', 'lists', 'vids'):
+            setattr(index, name, np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode=mmap_mode))
+        return index
+
+
+def main():
+    args = parser.parse_args()
+    vids, embeddings = load_embeddings(args.embedding_file)
+    rng = np.random.default_rng(args.seed)
+    print(f'{len(vids)} embeddings of dim {embeddings.shape[1]}')
+
+    start = time.perf_counter()
+    index = IVFPQIndex(args.nlist, args.m)
+    sample = rng.choice(len(embeddings), min(args.train_size, len(embeddings)), replace=False)
+    index.train(embeddings[sample], args.kmeans_iters, args.seed)
+    index.add(vids, embeddings)
+    index.save(args.index_dir)
+    print(f'Built and saved {args.index_dir} in {time.perf_counter() - start:.1f}s')
+
+    index = IVFPQIndex.load(args.index_dir)
+    queries = embeddings[rng.choice(len(embeddings), min(args.num_queries, len(embeddings)), replace=False)]
+    exact = EmbeddingIndex(vids, embeddings)
+    _, expected = exact.search(queries, args.top_k)
+    expected_vids = exact.vids[expected]
+
+    raw_bytes = embeddings.shape[0] * embeddings.shape[1] * 2
+    print(f'memory: {index.nbytes() / 2 ** 20:.1f} MB (+ vids) vs {raw_bytes / 2 ** 20:.1f} MB float16, '
+          f'{raw_bytes / index.nbytes():.1f}x smaller')
+    print(f'| nprobe | recall@{args.top_k} | ms / query |')
+    print('|---|---|---|')
+    for nprobe in map(int, args.nprobe.split(',')):
+        start = time.perf_counter()
+        _, found = index.search(queries, args.top_k, nprobe)
+        elapsed = time.perf_counter() - start
+        recall = np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(found, expected_vids)])
+        print(f'| {nprobe} | {recall:.4f} | {elapsed / len(queries) * 1000:.2f} |')
+
+
+if __name__ == '__main__':
+    main()
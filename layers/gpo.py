@@ -2,9 +2,11 @@
     Implementation of the Generalized Pooling Operator (GPO) for aggregating single-modality features.
 """
 
-import tensorflow as tf
+import hashlib
 import math
 
+import tensorflow as tf
+
 
 def positional_encoding_1d(d_model, length):
     """
@@ -15,17 +17,13 @@ def positional_encoding_1d(d_model, length):
     if d_model % 2 != 0:
         raise ValueError("Cannot use sin/cos positional encoding with "
                          "odd dim (got dim={:d})".format(d_model))
-    pe = tf.zeros(shape=[length, d_model])
-    position = tf.expand_dims(tf.range(0, length, 1), axis=1)
+    position = tf.cast(tf.expand_dims(tf.range(0, length, 1), axis=1), tf.float32)
     div_term = tf.math.exp((tf.range(0, d_model, 2, dtype=tf.float32) *
                             -(math.log(10000.0) / d_model)))
 
-    pe_unstack = tf.unstack(pe, axis=-1)
-    sin_values = tf.math.sin(tf.cast(position, tf.float32) * div_term)
-    cos_values = tf.math.cos(tf.cast(position, tf.float32) * div_term)
-    pe_unstack[0::2] = tf.unstack(sin_values, axis=-1)
-    pe_unstack[1::2] = tf.unstack(cos_values, axis=-1)
-    pe = tf.stack(pe_unstack, axis=-1)
+    # interleave so that even dims hold sin and odd dims hold cos
+    pe = tf.stack([tf.math.sin(position * div_term), tf.math.cos(position * div_term)], axis=-1)
+    pe = tf.reshape(pe, [length, d_model])
     return pe
 
 
@@ -39,67 +37,83 @@ class GPO(tf.keras.layers.Layer):
         self.gru = tf.keras.layers.GRU(d_hidden, return_sequences=True)
         self.bi_gru = tf.keras.layers.Bidirectional(self.gru, merge_mode='concat')
         self.linear = tf.keras.layers.Dense(1, use_bias=False)
+        self.table, self.table_key = None, None
 
-    def __call__(self, features, lengths):
+    def __call__(self, features, lengths, training=None):
         """
         :param features: features with shape B x K x D
-        :param lengths: B x 1, specify the length of each data sample.
+        :param lengths: B or B x 1, specify the length of each data sample.
+        :param training: pooling weights are recomputed on every training call, cached otherwise
         :return: pooled feature with shape B x D
         """
+        num_positions = features.shape[1]
+        lengths = tf.reshape(lengths, [-1])
         # chunk the features to remove all zero padding dimensions
         max_len = tf.keras.backend.max(lengths)
-        max_len = tf.math.minimum(max_len, features.shape[1])
+        max_len = tf.math.minimum(max_len, num_positions)
         features = features[:, :max_len, :]
 
-        pool_weights, mask = self.compute_pool_weights(lengths, max_len)
-        
-        neg_const = tf.ones(shape=[features.shape[0], max_len, features.shape[-1]])
-        neg_const *= -10000
-        zero_const = tf.zeros(shape=[features.shape[0], max_len, features.shape[-1]])
+        pool_weights, mask = self.compute_pool_weights(lengths, max_len, num_positions, training)
 
-        expanded_mask = tf.tile(tf.expand_dims(tf.math.logical_not(mask), -1), [1, 1, features.shape[-1]])
-        sorted_features = tf.where(expanded_mask, neg_const, features)
+        expanded_mask = tf.expand_dims(tf.math.logical_not(mask), -1)
+        sorted_features = tf.where(expanded_mask, -10000., features)
         sorted_features = tf.sort(sorted_features, axis=1, direction='DESCENDING')
-        #tf.print('mask', expanded_mask.shape, tf.math.reduce_sum(tf.cast(expanded_mask[0, :, 0], tf.int32), axis=0), tf.math.reduce_sum(tf.cast(expanded_mask[1, :, 0], tf.int32), axis=0))
-        sorted_features = tf.where(expanded_mask, zero_const, sorted_features)
-        #tf.print('sorted', sorted_features[0])
-        #tf.print('pooling coe', pool_weights[0])
+        sorted_features = tf.where(expanded_mask, 0., sorted_features)
 
         pooled_features = tf.math.reduce_sum(sorted_features * pool_weights, axis=1)
         return pooled_features, pool_weights
 
-    def compute_pool_weights(self, lengths, max_len): 
-        pe_max_len = self.get_pe(max_len)
-        pes = tf.tile(tf.expand_dims(pe_max_len, axis=0), [lengths.shape[0], 1, 1])
-        mask = tf.tile(tf.expand_dims(tf.range(0, max_len, 1), axis=0), [lengths.shape[0], 1])
-        mask = (mask < tf.expand_dims(lengths, axis=-1))
-        expanded_mask = tf.tile(tf.expand_dims(tf.math.logical_not(mask), -1), [1, 1, pes.shape[-1]])
-        #tf.print('mask', expanded_mask.shape, tf.math.reduce_sum(tf.cast(expanded_mask[0, :, 0], tf.int32), axis=0), tf.math.reduce_sum(tf.cast(expanded_mask[1, :, 0], tf.int32), axis=0))
-        pes = tf.where(expanded_mask, tf.zeros(shape=[pes.shape[0], max_len, pes.shape[-1]]), pes)
+    def compute_pool_weights(self, lengths, max_len, num_positions, training=None):
+        """Looks the weights of every sample up in the table of all lengths 1..num_positions. Scores of
+        padded positions are -10000 before the softmax, so their weights are exactly 0 and a row cut to
+        max_len is the same as running the BiGRU on max_len positions."""
+        table = self.get_pool_weight_table(num_positions, training)
+        mask = tf.sequence_mask(lengths, max_len)
+        weights = tf.gather(table, tf.clip_by_value(lengths, 1, num_positions) - 1)[:, :max_len]
+        # empty samples get the uniform softmax of all -10000 scores
+        weights = tf.where(tf.expand_dims(lengths > 0, -1), weights, 1. / tf.cast(max_len, tf.float32))
+        return tf.expand_dims(weights, -1), mask
+
+    def compute_pool_weight_table(self, num_positions):
+        """
+        :param num_positions: the longest length
+        :return: num_positions x num_positions pooling weights, row i is for samples of length i + 1
+        """
+        mask = tf.sequence_mask(tf.range(1, num_positions + 1), num_positions)
+        pes = tf.tile(tf.expand_dims(self.get_pe(num_positions), axis=0), [num_positions, 1, 1])
+        pes = tf.where(tf.expand_dims(mask, -1), pes, 0.)
 
-        #tf.print('pes', pes[0], pes[0].shape)
         out_emb = self.bi_gru(pes, mask=mask)
-        scores = self.linear(out_emb)
-
-        neg_const = tf.ones(shape=[pes.shape[0], max_len, 1])
-        neg_const *= -10000
-        expanded_mask = tf.expand_dims(tf.math.logical_not(mask), -1)
-        scores = tf.where(expanded_mask, neg_const, scores)
-        weights = tf.keras.activations.softmax(scores / 0.1, axis=1)
-        return weights, mask
+        scores = self.linear(out_emb)[:, :, 0]
+        scores = tf.where(mask, scores, -10000.)
+        return tf.keras.activations.softmax(scores / 0.1, axis=1)
+
+    def get_pool_weight_table(self, num_positions, training):
+        if training or not tf.executing_eagerly():
+            return self.compute_pool_weight_table(num_positions)
+        # weights change on every optimizer step and on checkpoint restore
+        if self.table_key != (num_positions, self._weights_fingerprint()):
+            self.table = self.compute_pool_weight_table(num_positions)
+            self.table_key = (num_positions, self._weights_fingerprint())
+        return self.table
+
+    def _weights_fingerprint(self):
+        h = hashlib.blake2b(digest_size=16)
+        for w in self.bi_gru.weights + self.linear.weights:
+            h.update(w.numpy().tobytes())
+        return h.digest()
 
     def get_pe(self, length):
         """
 
-        :param length: the length of the sequence
+        :param length: the length of the sequence (python int)
         :return: the positional encoding of the given length
         """
-        if length.ref() in self.pe_database:
-            return self.pe_database[length.ref()]
-        else:
-            pe = positional_encoding_1d(self.d_pe, length)
-            self.pe_database[length.ref()] = pe
-            return pe
+        if length not in self.pe_database:
+            # built eagerly, so the cached table is a constant every later trace can use
+            with tf.init_scope():
+                self.pe_database[length] = positional_encoding_1d(self.d_pe, length).numpy()
+        return tf.constant(self.pe_database[length])
 
 
 if __name__ == '__main__':
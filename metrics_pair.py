@@ -76,3 +76,36 @@ class Recorder_3:
     def log(self, epoch, num_step, prefix='', suffix=''):
         loss,loss0,loss1, loss2 = self._results()
         logging.info(prefix + self.pattern.format(epoch, num_step, loss,loss0,loss1,loss2) + suffix)
+
+class StepTimeRecorder:
+    def __init__(self):
+        self.data = tf.keras.metrics.Mean()
+        self.forward = tf.keras.metrics.Mean()
+        self.backward = tf.keras.metrics.Mean()
+        self.optimizer = tf.keras.metrics.Mean()
+
+        self.pattern = 'Epoch: {}, step: {}, data: {:.1f}ms, forward: {:.1f}ms, backward: {:.1f}ms, optimizer: {:.1f}ms'
+
+    def record(self, data_time, forward_time, backward_time, optimizer_time):
+        # seconds in, milliseconds out
+        self.data.update_state(data_time * 1000)
+        self.forward.update_state(forward_time * 1000)
+        self.backward.update_state(backward_time * 1000)
+        self.optimizer.update_state(optimizer_time * 1000)
+
+    def reset(self):
+        self.data.reset_states()
+        self.forward.reset_states()
+        self.backward.reset_states()
+        self.optimizer.reset_states()
+
+    def _results(self):
+        data = self.data.result().numpy()
+        forward = self.forward.result().numpy()
+        backward = self.backward.result().numpy()
+        optimizer = self.optimizer.result().numpy()
+        return [data, forward, backward, optimizer]
+
+    def log(self, epoch, num_step, prefix='', suffix=''):
+        data, forward, backward, optimizer = self._results()
+        logging.info(prefix + self.pattern.format(epoch, num_step, data, forward, backward, optimizer) + suffix)
@@ -0,0 +1,144 @@
+import glob
+import importlib
+import json
+import logging
+import os
+import struct
+from pprint import pprint
+
+import numpy as np
+import tensorflow as tf
+
+from cqrconfig import parser
+from retrieval import EmbeddingIndex
+from util import HARD_NEGATIVE_GROUPS, require_full_frames, resolve_ckpt
+
+parser.add_argument('--family', type=str, default='mix', help='mix & mix_roformer')
+parser.add_argument('--mined-step', type=int, default=0, help='training step of the checkpoint, also varies the grouping')
+
+# pretraining model module, model class, pointwise data helper and index of the embedding in the model outputs
+FAMILIES = {'mix': ('cqrmodel_mix', 'MultiModal_mix', 'data_helper', 3),
+            'mix_roformer': ('cqrmodel_mix_roformer', 'MultiModal_mix', 'data_helper_roformer', 3)}
+
+RECORD_INDEX = 'record_index.json'
+
+
+def scan_records(path):
+    """[vid, offset, length] of the serialized example of every record of a TFRecord file.
+    A record is uint64 length, uint32 crc, the example and its uint32 crc."""
+    records = []
+    offset = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                break
+            length = struct.unpack('<Q', header[:8])[0]
+            example = tf.train.Example.FromString(f.read(length))
+            f.seek(4, os.SEEK_CUR)
+            vid = example.features.feature['id'].bytes_list.value[0].decode('utf-8')
+            records.append([vid, offset + 12, length])
+            offset += 12 + length + 4
+    return records
+
+
+def index_records(files, index_file):
+    """Record positions of every file, rescanned only for files whose size or mtime changed."""
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    updated = {}
+    for path in files:
+        stat = os.stat(path)
+        entry = index.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'records': scan_records(path)}
+            logging.info(f'Indexed {len(entry["records"])} records of {path}')
+        updated[path] = entry
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(updated, f)
+    os.replace(index_file + '.tmp', index_file)
+    return updated
+
+
+def embed(args, family):
+    module, class_name, data_helper, output_index = FAMILIES[family]
+    feature_parser = importlib.import_module(data_helper).FeatureParser(args)
+    model_class = getattr(importlib.import_module(module), class_name)
+    require_full_frames(args, model_class)
+    model = model_class(args)
+    ckpt_file = resolve_ckpt(args.ckpt_file)
+    tf.train.Checkpoint(model=model).restore(ckpt_file).expect_partial()
+    logging.info(f'Restored from {ckpt_file}')
+    files = sorted(glob.glob(args.train_record_pattern))
+    # every refresh embeds the same records again
+    dataset = feature_parser.create_dataset(files, training=False, batch_size=args.val_batch_size, cache=True)
+
+    @tf.function
+    def embed_step(inputs):
+        return model(inputs, training=False)[output_index]
+
+    vids, embeddings = [], []
+    for batch in dataset:
+        vids.extend(batch['vid'].numpy().astype(str))
+        embeddings.append(embed_step(batch).numpy().astype(np.float16))
+    return ckpt_file, np.array(vids), np.concatenate(embeddings)
+
+
+def group_neighbours(vids, negatives, group_size, seed):
+    """Greedy groups of group_size videos: every video not grouped yet, in random order, starts a group with its
+    nearest ungrouped hard negatives. Videos whose negatives are all taken end up in smaller groups."""
+    grouped = set()
+    groups = []
+    for vid in np.random.RandomState(seed).permutation(vids):
+        if vid in grouped:
+            continue
+        group = [vid] + [n for n, _ in negatives.get(vid, []) if n not in grouped][:group_size - 1]
+        grouped.update(group)
+        groups.append(group)
+    return groups
+
+
+def write_groups(groups_file, groups, index):
+    """One line per group, one tab separated 'offset length footer path' per record (util.hard_negative_records)."""
+    positions = {}
+    for path, entry in index.items():
+        for vid, offset, length in entry['records']:
+            footer = entry['size'] - offset - length
+            positions.setdefault(vid, []).append(f'{offset} {length} {footer} {path}')
+    with open(groups_file + '.tmp', 'w') as f:
+        for group in groups:
+            f.write('\t'.join(p for vid in group for p in positions[vid]) + '\n')
+    os.replace(groups_file + '.tmp', groups_file)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    pprint(vars(args))
+    os.makedirs(args.hard_negative_dir, exist_ok=True)
+
+    files = sorted(glob.glob(args.train_record_pattern))
+    index = index_records(files, os.path.join(args.hard_negative_dir, RECORD_INDEX))
+    ckpt_file, vids, embeddings = embed(args, args.family)
+
+    # the nearest neighbours are mostly re-uploads of the same video, not negatives
+    neighbours = EmbeddingIndex(vids, embeddings).search_vids(
+        list(vids), args.hard_negative_skip_top + args.num_hard_negatives)
+    negatives = {vid: hits[args.hard_negative_skip_top:] for vid, hits in neighbours.items()}
+    groups = group_neighbours(vids, negatives, args.hard_negative_group_size, args.seed + args.mined_step)
+
+    negatives_file = os.path.join(args.hard_negative_dir, 'hard_negatives.json')
+    with open(negatives_file + '.tmp', 'w') as f:
+        json.dump({'ckpt': ckpt_file, 'step': args.mined_step, 'negatives': negatives}, f)
+    os.replace(negatives_file + '.tmp', negatives_file)
+    write_groups(os.path.join(args.hard_negative_dir, HARD_NEGATIVE_GROUPS), groups, index)
+    logging.info(f'Mined {args.num_hard_negatives} hard negatives of {len(vids)} videos with {ckpt_file}, '
+                 f'{len(groups)} groups')
+
+
+if __name__ == '__main__':
+    main()
@@ -161,6 +161,7 @@ def shape_list(tensor):
 
 
 class BERTforMaskedLM(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bert = TFBertModel.from_pretrained(config.bert_dir)
@@ -1,7 +1,8 @@
 import tensorflow as tf
 from tensorflow.python.keras.models import Model
 from transformers import TFBertModel, create_optimizer
-from cqrmodel import NextSoftDBoF
+from cqrmodel import NextSoftDBoF, packed_frames
+from util import bottom_hidden_states, freeze_bottom, frozen_top, prune_spec_kwargs
 
 
 class NeXtVLAD(tf.keras.layers.Layer):
@@ -34,17 +35,15 @@ class NeXtVLAD(tf.keras.layers.Layer):
         image_embeddings, mask = inputs
         _, num_segments, _ = image_embeddings.shape
         if mask is not None:  # in case num of images is less than num_segments
-            images_mask = tf.sequence_mask(mask, maxlen=num_segments)
-            images_mask = tf.cast(tf.expand_dims(images_mask, -1), tf.float32)
-            image_embeddings = tf.multiply(image_embeddings, images_mask)
-        inputs = self.expand_dense(image_embeddings)
-        attention = self.attention_dense(inputs)
+            inputs, attention, activation = packed_frames(self, image_embeddings, mask)
+        else:
+            inputs = self.expand_dense(image_embeddings)
+            attention = self.attention_dense(inputs)
+            reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
+            activation = self.cluster_dense1(reshaped_input)
+            activation = self.activation_bn(activation) # MODIFY HERE
 
         attention = tf.reshape(attention, [-1, num_segments * self.groups, 1])
-        reshaped_input = tf.reshape(inputs, [-1, self.expansion * self.feature_size])
-
-        activation = self.cluster_dense1(reshaped_input)
-        activation = self.activation_bn(activation) # MODIFY HERE
         activation = tf.reshape(activation, [-1, num_segments * self.groups, self.cluster_size])
         activation = tf.nn.softmax(activation, axis=-1)  # shape: batch_size * (max_frame*groups) * cluster_size
         activation = tf.multiply(activation, attention)  # shape: batch_size * (max_frame*groups) * cluster_size
@@ -101,7 +100,7 @@ class ConcatDenseSE(tf.keras.layers.Layer):
 class MultiModal(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -158,7 +157,7 @@ class MultiModal(Model):
 class MultiModal_mix2(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
         self.nextvlad_2 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
@@ -258,7 +257,10 @@ class MultiModal_mix2(Model):
 class MultiModal_mix(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
+        self.freeze_layers = config.freeze_layers
+        if self.freeze_layers:
+            freeze_bottom(self.bert, self.freeze_layers)
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -292,7 +294,11 @@ class MultiModal_mix(Model):
         self.bert_variables_1, self.num_bert_1, self.normal_variables_1, self.all_variables_1 = None, None, None, None
 
     def call(self, inputs, **kwargs):
-        bert_embedding_1 = self.bert([inputs['input_ids_1'], inputs['mask_1']])[1]
+        if 'hidden_1' in inputs:
+            bert_embedding_1 = frozen_top(self.bert, self.freeze_layers, inputs['hidden_1'], inputs['mask_1'],
+                                          kwargs.get('training'))[1]
+        else:
+            bert_embedding_1 = self.bert([inputs['input_ids_1'], inputs['mask_1']])[1]
         bert_embedding_1 = self.bert_map(bert_embedding_1)
         # frt_mean
         frt_mean_1 = tf.concat([tf.reduce_mean(inputs['frames_1'], axis=1),bert_embedding_1], axis=1) 
@@ -344,7 +350,11 @@ class MultiModal_mix(Model):
 
 
         # pair 2
-        bert_embedding_2 = self.bert([inputs['input_ids_2'], inputs['mask_2']])[1]
+        if 'hidden_2' in inputs:
+            bert_embedding_2 = frozen_top(self.bert, self.freeze_layers, inputs['hidden_2'], inputs['mask_2'],
+                                          kwargs.get('training'))[1]
+        else:
+            bert_embedding_2 = self.bert([inputs['input_ids_2'], inputs['mask_2']])[1]
         bert_embedding_2 = self.bert_map(bert_embedding_2)
         # frt_mean
         frt_mean_2 = tf.concat([tf.reduce_mean(inputs['frames_2'], axis=1),bert_embedding_2], axis=1) 
@@ -396,6 +406,11 @@ class MultiModal_mix(Model):
         # regularization_loss = (regularization_loss_2 + regularization_loss_1)/2
         return mix_embedding_1, mix_embedding_2, pred_1, pred_2, aux_preds_1, aux_preds_2#, regularization_loss
 
+    def frozen_hidden(self, inputs, side):
+        """Output of the frozen bottom layers for one side of a pair batch, see util.HiddenStateCache."""
+        return bottom_hidden_states(self.bert, self.freeze_layers,
+                                    [inputs[f'input_ids_{side}'], inputs[f'mask_{side}']])
+
     def get_variables(self):
         if not self.all_variables_1:  # is None, not initialized
             self.bert_variables_1 = self.bert.trainable_variables
@@ -419,7 +434,7 @@ class MultiModal_mix(Model):
 class MultiModal_mix5(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -614,7 +629,7 @@ class MultiModal_mix5(Model):
 class MultiModal_mix_1024(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -792,7 +807,7 @@ class MultiModal_mix_1024(Model):
 class MultiModal_mix_nextsoft(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextsoftdbof_1 = NextSoftDBoF(config.frame_embedding_size,config.vlad_cluster_size,
                                 dropout=config.dropout,output_size=config.vlad_hidden_size,groups=config.vlad_groups)
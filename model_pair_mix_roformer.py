@@ -1,6 +1,7 @@
 import tensorflow as tf
 from tensorflow.python.keras.models import Model
 from transformers import TFRoFormerModel, create_optimizer
+from util import prune_spec_kwargs
 
 
 class NeXtVLAD(tf.keras.layers.Layer):
@@ -100,7 +101,7 @@ class ConcatDenseSE(tf.keras.layers.Layer):
 class MultiModal(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir)
+        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
@@ -157,7 +158,7 @@ class MultiModal(Model):
 class MultiModal_mix2(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir)
+        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
         self.nextvlad_2 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
@@ -257,7 +258,7 @@ class MultiModal_mix2(Model):
 class MultiModal_mix(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir)
+        self.bert = TFRoFormerModel.from_pretrained(config.bert_dir, **prune_spec_kwargs(config, heads=False))
         self.bert_map = tf.keras.layers.Dense(1024, activation ='relu')
         self.nextvlad_1 = NeXtVLAD(config.frame_embedding_size, config.vlad_cluster_size,
                                  output_size=config.vlad_hidden_size, dropout=config.dropout)
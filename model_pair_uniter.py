@@ -5,12 +5,16 @@ from cqrmodel import SoftDBoF, NextSoftDBoF
 from transformers.models.bert.modeling_tf_bert import TFBertMLMHead
 from bert import TFBertModel_MM, shape_list
 from roformer import TFRoFormerModel_MM, TFRoFormerMLMHead
-from cqrmodel import NeXtVLAD
+from cqrmodel import NeXtVLAD, masked_mean
+from util import bottom_hidden_states, freeze_bottom, frozen_top, prune_spec_kwargs
 
 class MultiModal_Uniter(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir, xla_attention=config.xla_attention,
+                                                  early_exit_heads=config.early_exit_heads,
+                                                  **prune_spec_kwargs(config))
         # tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -25,6 +29,11 @@ class MultiModal_Uniter(Model):
         self.frame_map = tf.keras.layers.Dense(768, activation ='relu')
         self.fc = tf.keras.layers.Dense(config.hidden_size)
         self.pooling = config.uniter_pooling
+        self.freeze_layers = config.freeze_layers
+        if self.freeze_layers:
+            # the frame projection only feeds the frozen layers, its output is cached with them
+            freeze_bottom(self.bert, self.freeze_layers)
+            self.frame_map.trainable = False
 
         self.bert_optimizer_1, self.bert_lr_1 = create_optimizer(init_lr=config.bert_lr,
                                                              num_train_steps=config.bert_total_steps,
@@ -37,18 +46,24 @@ class MultiModal_Uniter(Model):
     def call(self, inputs, training, **kwargs):
         image_embedding_1 = inputs['frames_1']
         _, num_segments_1, _ = image_embedding_1.shape
-        image_embedding_1 = self.frame_map(image_embedding_1) # b,32,768
         frame_num_1 = tf.reshape(inputs['num_frames_1'], [-1])
         images_mask_1 = tf.sequence_mask(frame_num_1, maxlen=num_segments_1)
         images_mask_1 = tf.cast(images_mask_1, tf.int32)
-        # _, seq_len = inputs['input_ids'].shape
-        bert_output_1 = self.bert(input_ids=inputs['input_ids_1'], attention_mask=inputs['mask_1'], frame_features=image_embedding_1, frame_attention_mask=images_mask_1) # inputs have random mask
-        sequence_output_1 = bert_output_1[0]
+        if 'hidden_1' in inputs:
+            all_mask_1 = tf.concat([tf.cast(inputs['mask_1'], tf.int32), images_mask_1], 1)
+            sequence_output_1 = frozen_top(self.bert, self.freeze_layers, inputs['hidden_1'], all_mask_1, training)[0]
+        else:
+            image_embedding_1 = self.frame_map(image_embedding_1) # b,32,768
+            # _, seq_len = inputs['input_ids'].shape
+            bert_output_1 = self.bert(input_ids=inputs['input_ids_1'], attention_mask=inputs['mask_1'], frame_features=image_embedding_1, frame_attention_mask=images_mask_1) # inputs have random mask
+            sequence_output_1 = bert_output_1[0]
         sequence_output_1 = self.fc(sequence_output_1)
         if self.pooling == 'cls':
             bert_embedding_1 = sequence_output_1[:,0]
         elif self.pooling == 'mean':
             bert_embedding_1 = tf.reduce_mean(sequence_output_1, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_1 = masked_mean(sequence_output_1, inputs['mask_1'], images_mask_1)
         elif self.pooling == 'max':
             text_mask_1 = 1-tf.cast(inputs['mask_1'], tf.int32)
             neg_mask_1 = tf.concat([text_mask_1, 1-images_mask_1], 1)
@@ -61,18 +76,24 @@ class MultiModal_Uniter(Model):
         # 2
         image_embedding_2 = inputs['frames_2']
         _, num_segments_2, _ = image_embedding_2.shape
-        image_embedding_2 = self.frame_map(image_embedding_2) # b,32,768
         frame_num_2 = tf.reshape(inputs['num_frames_2'], [-1])
         images_mask_2 = tf.sequence_mask(frame_num_2, maxlen=num_segments_2)
         images_mask_2 = tf.cast(images_mask_2, tf.int32)
-        # _, seq_len = inputs['input_ids'].shape
-        bert_output_2 = self.bert(input_ids=inputs['input_ids_2'], attention_mask=inputs['mask_2'], frame_features=image_embedding_2, frame_attention_mask=images_mask_2) # inputs have random mask
-        sequence_output_2 = bert_output_2[0]
+        if 'hidden_2' in inputs:
+            all_mask_2 = tf.concat([tf.cast(inputs['mask_2'], tf.int32), images_mask_2], 1)
+            sequence_output_2 = frozen_top(self.bert, self.freeze_layers, inputs['hidden_2'], all_mask_2, training)[0]
+        else:
+            image_embedding_2 = self.frame_map(image_embedding_2) # b,32,768
+            # _, seq_len = inputs['input_ids'].shape
+            bert_output_2 = self.bert(input_ids=inputs['input_ids_2'], attention_mask=inputs['mask_2'], frame_features=image_embedding_2, frame_attention_mask=images_mask_2) # inputs have random mask
+            sequence_output_2 = bert_output_2[0]
         sequence_output_2 = self.fc(sequence_output_2)
         if self.pooling == 'cls':
             bert_embedding_2 = sequence_output_2[:,0]
         elif self.pooling == 'mean':
             bert_embedding_2 = tf.reduce_mean(sequence_output_2, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_2 = masked_mean(sequence_output_2, inputs['mask_2'], images_mask_2)
         elif self.pooling == 'max':
             text_mask_2 = 1-tf.cast(inputs['mask_2'], tf.int32)
             neg_mask_2 = tf.concat([text_mask_2, 1-images_mask_2], 1)
@@ -83,6 +104,14 @@ class MultiModal_Uniter(Model):
 
         return bert_embedding_1, bert_embedding_2, predictions_1, predictions_2
 
+    def frozen_hidden(self, inputs, side):
+        """Output of the frozen bottom layers for one side of a pair batch, see util.HiddenStateCache."""
+        frames = inputs[f'frames_{side}']
+        images_mask = tf.sequence_mask(tf.reshape(inputs[f'num_frames_{side}'], [-1]), maxlen=frames.shape[1])
+        return bottom_hidden_states(self.bert, self.freeze_layers, input_ids=inputs[f'input_ids_{side}'],
+                                    attention_mask=inputs[f'mask_{side}'], frame_features=self.frame_map(frames),
+                                    frame_attention_mask=tf.cast(images_mask, tf.int32))
+
     def get_variables(self):
         if not self.all_variables_1:  # is None, not initialized
             self.bert_variables_1 = self.bert.trainable_variables
@@ -100,9 +129,12 @@ class MultiModal_Uniter(Model):
 
 
 class MultiModal_Uniter_mlm(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir, xla_attention=config.xla_attention,
+                                                  early_exit_heads=config.early_exit_heads,
+                                                  **prune_spec_kwargs(config))
         # tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -140,6 +172,8 @@ class MultiModal_Uniter_mlm(Model):
             bert_embedding_1 = sequence_output_1[:,0]
         elif self.pooling == 'mean':
             bert_embedding_1 = tf.reduce_mean(sequence_output_1, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_1 = masked_mean(sequence_output_1, inputs['mask_1'], images_mask_1)
         elif self.pooling == 'max':
             text_mask_1 = 1-tf.cast(inputs['mask_1'], tf.int32)
             neg_mask_1 = tf.concat([text_mask_1, 1-images_mask_1], 1)
@@ -164,6 +198,8 @@ class MultiModal_Uniter_mlm(Model):
             bert_embedding_2 = sequence_output_2[:,0]
         elif self.pooling == 'mean':
             bert_embedding_2 = tf.reduce_mean(sequence_output_2, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_2 = masked_mean(sequence_output_2, inputs['mask_2'], images_mask_2)
         elif self.pooling == 'max':
             text_mask_2 = 1-tf.cast(inputs['mask_2'], tf.int32)
             neg_mask_2 = tf.concat([text_mask_2, 1-images_mask_2], 1)
@@ -193,7 +229,9 @@ class MultiModal_Uniter_mlm(Model):
 class MultiModal_Uniter_vlad(Model):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFBertModel_MM.from_pretrained(config.bert_dir, xla_attention=config.xla_attention,
+                                                  early_exit_heads=config.early_exit_heads,
+                                                  **prune_spec_kwargs(config))
         # tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -268,9 +306,11 @@ class MultiModal_Uniter_vlad(Model):
 
 
 class MultiModal_Uniter_roformer(Model):
+    masks_padding = True  # see util.require_full_frames
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bert = TFRoFormerModel_MM.from_pretrained(config.bert_dir)
+        self.bert = TFRoFormerModel_MM.from_pretrained(config.bert_dir, early_exit_heads=config.early_exit_heads,
+                                                       **prune_spec_kwargs(config))
         # tf.print(self.bert)
         # mlm head
         bert_config = self.bert.config
@@ -309,6 +349,8 @@ class MultiModal_Uniter_roformer(Model):
             bert_embedding_1 = sequence_output_1[:,0]
         elif self.pooling == 'mean':
             bert_embedding_1 = tf.reduce_mean(sequence_output_1, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_1 = masked_mean(sequence_output_1, inputs['mask_1'], images_mask_1)
         elif self.pooling == 'max':
             text_mask_1 = 1-tf.cast(inputs['mask_1'], tf.int32)
             neg_mask_1 = tf.concat([text_mask_1, 1-images_mask_1], 1)
@@ -333,6 +375,8 @@ class MultiModal_Uniter_roformer(Model):
             bert_embedding_2 = sequence_output_2[:,0]
         elif self.pooling == 'mean':
             bert_embedding_2 = tf.reduce_mean(sequence_output_2, 1)
+        elif self.pooling == 'masked_mean':
+            bert_embedding_2 = masked_mean(sequence_output_2, inputs['mask_2'], images_mask_2)
         elif self.pooling == 'max':
             text_mask_2 = 1-tf.cast(inputs['mask_2'], tf.int32)
             neg_mask_2 = tf.concat([text_mask_2, 1-images_mask_2], 1)
@@ -104,6 +104,22 @@ def get_initializer(initializer_range: float = 0.02) -> tf.initializers.Truncate
     return tf.keras.initializers.TruncatedNormal(stddev=initializer_range)
 
 
+# weights a model holds fused that h5 files store per part, concatenated along the last axis
+FUSED_WEIGHT_PATTERN = re.compile(r"^(.*)/qkv/(kernel|bias):0$")
+FUSED_WEIGHT_PARTS = ("query", "key", "value")
+
+
+def fused_weight_value(name, saved_weights):
+    """The value of the fused weight name (bert.TFBertSelfAttention qkv) from its saved parts, None if it has none."""
+    match = FUSED_WEIGHT_PATTERN.match(name)
+    if match is None:
+        return None, []
+    names = [f"{match.group(1)}/{part}/{match.group(2)}:0" for part in FUSED_WEIGHT_PARTS]
+    if not all(part_name in saved_weights for part_name in names):
+        return None, []
+    return np.concatenate([saved_weights[part_name] for part_name in names], axis=-1), names
+
+
 def load_tf_weights(model, resolved_archive_file, ignore_mismatched_sizes=False, _prefix=None):
     """
     Detect missing and unexpected layers and load the TF weights accordingly to their names and shapes.
@@ -181,6 +197,12 @@ def load_tf_weights(model, resolved_archive_file, ignore_mismatched_sizes=False,
                     # Add the updated name to the final list for computing missing/unexpected values
                     symbolic_weights_names.add(symbolic_weight_name)
 
+                    if saved_weight_value is None:
+                        saved_weight_value, part_names = fused_weight_value(symbolic_weight_name, saved_weights)
+                        if saved_weight_value is not None:
+                            symbolic_weights_names.discard(symbolic_weight_name)
+                            symbolic_weights_names.update(part_names)
+
                     # If the current weight is found
                     if saved_weight_value is not None:
                         # Check if the shape of the current weight and the one from the H5 file are different
@@ -0,0 +1,228 @@
+import fcntl
+import glob
+import importlib
+import json
+import logging
+import os
+import random
+
+import numpy as np
+import tensorflow as tf
+
+from util import file_digest
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# per video columns of the table, as the pair batches name them (+ _1 / _2)
+FIELDS = ('vid', 'input_ids', 'mask', 'frames', 'num_frames', 'labels')
+DTYPES = (tf.string, tf.int32, tf.int32, tf.float16, tf.int32, tf.int8)
+
+
+class VideoTable:
+    """Parsed per-video tensors of every video the pairs refer to, one .npy per column in table_dir.
+
+    Titles are tokenized and frames sampled once at build time, so the columns depend on the tokenizer and the
+    sizes in key; a table built with another key is rebuilt. frames.npy ([videos, max_frames, dim] float16)
+    is written through a memory map and read through one with mmap, the other columns are small and loaded.
+    build() holds an exclusive lock on table_dir, so folds sharing it build the table once.
+    """
+
+    def __init__(self, table_dir, key, mmap=True):
+        self.table_dir = table_dir
+        self.key = key
+        self.mmap = mmap
+        self.columns, self.row_of = None, None
+        self.meta_file = os.path.join(table_dir, 'meta.json')
+        meta = self._read_meta()
+        if meta is not None and meta['key'] == key:
+            self._load(meta['num_videos'])
+        elif meta is not None:
+            logging.info(f'Video table {table_dir} was built for {meta["key"]}, rebuilding')
+
+    def _read_meta(self):
+        if not os.path.exists(self.meta_file):
+            return None
+        with open(self.meta_file) as f:
+            return json.load(f)
+
+    def _path(self, name):
+        return os.path.join(self.table_dir, f'{name}.npy')
+
+    def _load(self, num_videos):
+        self.columns = {name: np.load(self._path(name), mmap_mode='r' if self.mmap and name == 'frames' else None)
+                        for name in FIELDS}
+        self.columns = {name: column[:num_videos] for name, column in self.columns.items()}
+        self.row_of = {vid.decode('utf-8'): i for i, vid in enumerate(self.columns['vid'])}
+
+    def build(self, files, feature_parser, batch_size):
+        """Parse every video of the pointwise records in files once; later duplicates of a vid are skipped."""
+        os.makedirs(self.table_dir, exist_ok=True)
+        with open(os.path.join(self.table_dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another fold may have built it while this one waited
+            meta = self._read_meta()
+            if meta is not None and meta['key'] == self.key:
+                num_videos = meta['num_videos']
+            else:
+                num_videos = self._build(files, feature_parser, batch_size)
+        self._load(num_videos)
+
+    def _build(self, files, feature_parser, batch_size):
+        if os.path.exists(self.meta_file):
+            # readers must not pair the old meta with the new columns
+            os.remove(self.meta_file)
+        num_records = sum(1 for _ in tf.data.TFRecordDataset(files))
+        columns = {}
+        num_videos, seen = 0, set()
+        for batch in feature_parser.create_video_dataset(files, batch_size):
+            keep = []
+            for i, vid in enumerate(batch['vid'].numpy()):
+                if vid not in seen:
+                    seen.add(vid)
+                    keep.append(i)
+            for name in FIELDS:
+                values = batch[name].numpy()[keep]
+                if name not in columns:
+                    shape, dtype = (num_records,) + values.shape[1:], values.dtype
+                    if name == 'vid':
+                        dtype = 'S64'
+                    elif name == 'frames':
+                        dtype = np.float16
+                    columns[name] = np.lib.format.open_memmap(self._path(name) + '.tmp', 'w+', dtype, shape)
+                columns[name][num_videos:num_videos + len(keep)] = values
+            num_videos += len(keep)
+        for name in FIELDS:
+            columns[name].flush()
+            del columns[name]
+            os.replace(self._path(name) + '.tmp', self._path(name))
+        tmp_file = self.meta_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'key': self.key, 'num_videos': num_videos}, f)
+        os.replace(tmp_file, self.meta_file)
+        logging.info(f'Built video table {self.table_dir} of {num_videos} videos')
+        return num_videos
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def rows(self, vids):
+        return np.array([self.row_of[vid] for vid in vids], dtype=np.int64)
+
+    def _gather(self, rows):
+        # sorted reads are sequential on the memory map
+        order = np.argsort(rows)
+        inverse = np.argsort(order)
+        return tuple(np.asarray(self.columns[name][rows[order]])[inverse] for name in FIELDS)
+
+    def side(self, rows, side):
+        """Batch columns of the given table rows, named <field>_<side> like the parsed pair records."""
+        values = tf.numpy_function(self._gather, [rows], list(DTYPES))
+        batch = {}
+        for name, value in zip(FIELDS, values):
+            value.set_shape((None,) + self.columns[name].shape[1:])
+            if name == 'frames':
+                value = tf.cast(value, tf.float32)
+            batch[f'{name}_{side}'] = value
+        return batch
+
+
+def read_pairs(pair_file):
+    with open(pair_file) as f:
+        return [(id_1, id_2, float(sim)) for id_1, id_2, sim in (line.strip().split('\t') for line in f if line.strip())]
+
+
+def fold_val_mask(num_pairs, fold, fold_size, seed):
+    """The val pairs of a fold exactly as write_tfrecord.py split label.tsv: pairs shuffled with random.seed(seed),
+    fold i holds positions [i * fold_size, (i + 1) * fold_size) of the shuffled order. The same Mersenne Twister
+    in a random.Random of its own, so the global random state stays untouched."""
+    order = list(range(num_pairs))
+    random.Random(seed).shuffle(order)
+    mask = np.zeros(num_pairs, dtype=bool)
+    mask[order[fold * fold_size:(fold + 1) * fold_size]] = True
+    return mask
+
+
+def fold_pairs(args, table):
+    """Train and val pairs of --fold; --extra-pair-files add (augmented) train pairs without new records."""
+    pairs = read_pairs(args.annotation_file)
+    val_mask = fold_val_mask(len(pairs), args.fold, args.fold_size, args.fold_seed)
+    train_pairs = [pair for pair, val in zip(pairs, val_mask) if not val]
+    val_pairs = [pair for pair, val in zip(pairs, val_mask) if val]
+    for pair_file in filter(None, args.extra_pair_files.split(',')):
+        extra = read_pairs(pair_file)
+        known = [pair for pair in extra if pair[0] in table.row_of and pair[1] in table.row_of]
+        logging.info(f'{len(known)} extra train pairs from {pair_file}, {len(extra) - len(known)} with unknown videos')
+        train_pairs += known
+    return train_pairs, val_pairs
+
+
+def create_table_datasets(args, feature_parser):
+    """Train and val pair datasets of --fold, batches gathered from the video table by an index of
+    (row_1, row_2, sim); the train pairs are reshuffled every epoch."""
+    if args.bucket_boundaries:
+        raise ValueError('--pair-table-dir batches full length videos, drop --bucket-boundaries')
+    table = video_table(args, feature_parser)
+    train_pairs, val_pairs = fold_pairs(args, table)
+    logging.info(f'Fold {args.fold}: {len(train_pairs)} train / {len(val_pairs)} val pairs over {len(table)} videos')
+    train_dataset = pair_dataset(table, train_pairs, args.batch_size, training=True, seed=args.seed)
+    val_dataset = pair_dataset(table, val_pairs, args.val_batch_size, training=False)
+    return train_dataset, val_dataset
+
+
+def create_table_cache_dataset(args, feature_parser):
+    """The train pairs of --fold once, unshuffled, to fill util.HiddenStateCache."""
+    table = video_table(args, feature_parser)
+    train_pairs, _ = fold_pairs(args, table)
+    return pair_dataset(table, train_pairs, args.val_batch_size, training=False)
+
+
+def video_table(args, feature_parser):
+    files = sorted(glob.glob(args.pair_video_pattern))
+    key = [type(feature_parser.tokenizer).__name__, args.bert_dir, args.bert_seq_length, args.max_frames,
+           args.frame_embedding_size, file_digest(args.multi_label_file), files]
+    table = VideoTable(args.pair_table_dir, key, mmap=bool(args.pair_table_mmap))
+    if table.columns is None:
+        table.build(files, feature_parser, args.val_batch_size)
+    return table
+
+
+def pair_dataset(table, pairs, batch_size, training, seed=None):
+    rows_1 = table.rows([pair[0] for pair in pairs])
+    rows_2 = table.rows([pair[1] for pair in pairs])
+    sims = np.array([pair[2] for pair in pairs], dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((rows_1, rows_2, sims))
+    if training:
+        dataset = dataset.shuffle(len(pairs), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=training)
+
+    def gather(row_1, row_2, sim):
+        batch = {'sim': sim}
+        batch.update(table.side(row_1, 1))
+        batch.update(table.side(row_2, 2))
+        return batch
+
+    dataset = dataset.map(gather, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    if training:
+        # the table gathers are pure, a util.TrainState saves the train iterator without them
+        options = tf.data.Options()
+        options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+        dataset = dataset.with_options(options)
+    return dataset
+
+
+def main():
+    """Build the table once up front, e.g. before fold_scheduler.py starts folds sharing it."""
+    from config_pair import parser
+    parser.add_argument('--data-helper', type=str, default='data_helper_pair',
+                        help='data_helper_pair_roformer for the roformer families')
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    feature_parser = importlib.import_module(args.data_helper).FeatureParser(args)
+    table = video_table(args, feature_parser)
+    print(f'{len(table)} videos in {args.pair_table_dir}')
+
+
+if __name__ == '__main__':
+    main()
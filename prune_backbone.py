@@ -0,0 +1,245 @@
+import copy
+import importlib
+import json
+import logging
+import os
+import re
+from pprint import pprint
+
+import numpy as np
+import tensorflow as tf
+
+from calibrate_depth import FAMILIES, evaluate
+from config_pair import parser
+from util import backbone_encoder, resolve_ckpt, set_threading, require_full_frames
+
+parser.add_argument('--family', type=str, default='uniter', help='mix & mix_roformer & uniter & uniter_roformer')
+parser.add_argument('--head-sparsity', type=str, default='0.25,0.5',
+                    help='comma separated fractions of attention heads to remove (uniter families only)')
+parser.add_argument('--layer-drops', type=str, default='2,4', help='comma separated numbers of layers to remove')
+parser.add_argument('--importance-batches', type=int, default=200, help='train batches used to score heads and layers')
+parser.add_argument('--prune-finetune-steps', type=int, default=1000, help='pair finetuning steps after pruning')
+parser.add_argument('--prune-dir', type=str, default='', help='defaults to <ckpt dir>/pruned')
+
+LAYER_PATTERN = re.compile(r'/layer_\._(\d+)/')
+
+
+def pair_loss(args, outputs, label_sims):
+    """MSE + KL of the pair similarity, the part of compute_loss_1 every family shares."""
+    final_embedding_1 = tf.math.l2_normalize(outputs[0], axis=1)
+    final_embedding_2 = tf.math.l2_normalize(outputs[1], axis=1)
+    sim = tf.reduce_sum(final_embedding_1 * final_embedding_2, axis=1)
+    loss_0 = tf.reduce_sum(tf.square(sim - label_sims))
+    loss_1 = tf.keras.losses.KLDivergence()(label_sims, sim)
+    return loss_0 + args.kl_weight * loss_1
+
+
+def ffn_output(layer):
+    return layer.roformer_output if hasattr(layer, 'roformer_output') else layer.bert_output
+
+
+def importance_scores(args, model, train_dataset):
+    """First order Taylor importance |sum(W * dL/dW)| of every head (its rows of the attention output projection)
+    and of every layer (attention + FFN output projections), summed over args.importance_batches."""
+    encoder = backbone_encoder(model.bert)
+    config = model.bert.config
+    head_size = config.hidden_size // config.num_attention_heads
+    attn_kernels = [layer.attention.dense_output.dense.kernel for layer in encoder.layer]
+    ffn_kernels = [ffn_output(layer).dense.kernel for layer in encoder.layer]
+
+    @tf.function
+    def score_step(inputs):
+        with tf.GradientTape() as tape:
+            loss = pair_loss(args, model(inputs, training=False), inputs['sim'])
+        grads = tape.gradient(loss, attn_kernels + ffn_kernels)
+        head_scores = tf.stack([tf.abs(tf.reduce_sum(tf.reshape(w * g, [-1, head_size, config.hidden_size]), [1, 2]))
+                                for w, g in zip(attn_kernels, grads[:len(attn_kernels)])])
+        ffn_scores = tf.stack([tf.abs(tf.reduce_sum(w * g)) for w, g in zip(ffn_kernels, grads[len(attn_kernels):])])
+        return head_scores, ffn_scores
+
+    head_scores = np.zeros([config.num_hidden_layers, config.num_attention_heads])
+    ffn_scores = np.zeros([config.num_hidden_layers])
+    for step, batch in enumerate(train_dataset.take(args.importance_batches), start=1):
+        heads, ffn = score_step(batch)
+        head_scores += heads.numpy()
+        ffn_scores += ffn.numpy()
+        if step % args.print_freq == 0:
+            logging.info(f'importance step {step}')
+    return head_scores, head_scores.sum(1) + ffn_scores
+
+
+def head_prune_spec(head_scores, sparsity):
+    """Remove the globally lowest scoring heads (scores l2 normalized per layer), keeping one head per layer."""
+    num_layers, num_heads = head_scores.shape
+    scores = head_scores / (np.linalg.norm(head_scores, axis=1, keepdims=True) + 1e-12)
+    pruned = {l: [] for l in range(num_layers)}
+    num_prune = int(round(sparsity * num_layers * num_heads))
+    for flat in np.argsort(scores, axis=None):
+        if num_prune == 0:
+            break
+        l, h = divmod(int(flat), num_heads)
+        if len(pruned[l]) < num_heads - 1:
+            pruned[l].append(h)
+            num_prune -= 1
+    return {'kept_layers': list(range(num_layers)), 'num_hidden_layers': num_layers,
+            'pruned_heads': {l: sorted(h) for l, h in pruned.items() if h}}
+
+
+def layer_prune_spec(layer_scores, num_drop):
+    kept = sorted(np.argsort(layer_scores)[num_drop:].tolist())
+    return {'kept_layers': kept, 'num_hidden_layers': len(kept), 'pruned_heads': {}}
+
+
+def split_by_layer(variables):
+    """Variables outside the encoder layers in order, and the variables of every layer in order."""
+    outside, layers = [], {}
+    for v in variables:
+        match = LAYER_PATTERN.search(v.name)
+        if match:
+            layers.setdefault(int(match.group(1)), []).append(v)
+        else:
+            outside.append(v)
+    return outside, [layers[i] for i in sorted(layers)]
+
+
+def copy_pruned_weights(model, pruned_model, spec, num_heads, head_size):
+    """Both models are built from the same class, so their variables line up in order; kept layers are remapped and
+    the Q/K/V columns (of the three kernels or the fused one) / attention output rows of the removed heads are
+    sliced away."""
+    outside, layers = split_by_layer(model.variables)
+    pruned_outside, pruned_layers = split_by_layer(pruned_model.variables)
+    for src, dst in zip(outside, pruned_outside):
+        dst.assign(src)
+    for new_idx, old_idx in enumerate(spec['kept_layers']):
+        pruned_heads = set(spec['pruned_heads'].get(new_idx, []))
+        keep = np.concatenate([np.arange(h * head_size, (h + 1) * head_size)
+                               for h in range(num_heads) if h not in pruned_heads])
+        for src, dst in zip(layers[old_idx], pruned_layers[new_idx]):
+            value = src.numpy()
+            if re.search(r'attention/self/(query|key|value)/(kernel|bias)', src.name):
+                value = value[..., keep]
+            elif re.search(r'attention/self/qkv/(kernel|bias)', src.name):
+                # query | key | value column blocks of the fused projection (bert.py)
+                value = value[..., np.concatenate([keep + i * num_heads * head_size for i in range(3)])]
+            elif re.search(r'attention/output/dense/kernel', src.name):
+                value = value[keep]
+            dst.assign(value)
+
+
+def finetune(args, model, train_dataset):
+
+    @tf.function
+    def train_step(inputs):
+        with tf.GradientTape() as tape:
+            loss = pair_loss(args, model(inputs, training=True), inputs['sim'])
+        model.optimize(tape.gradient(loss, model.get_variables()))
+        return loss
+
+    for step, batch in enumerate(train_dataset.take(args.prune_finetune_steps), start=1):
+        loss = train_step(batch)
+        if step % args.print_freq == 0:
+            logging.info(f'finetune step {step}: loss {loss.numpy():.4f}')
+
+
+def encoder_gflops(config, spec, seq_len):
+    """Backbone multiply-adds x 2 of one pair (two encoder passes), attention scores included."""
+    head_size = config.hidden_size // config.num_attention_heads
+    flops = 0
+    for new_idx in range(spec['num_hidden_layers']):
+        inner = (config.num_attention_heads - len(spec['pruned_heads'].get(new_idx, []))) * head_size
+        flops += 2 * seq_len * config.hidden_size * inner * 4  # q, k, v and attention output projections
+        flops += 2 * seq_len * seq_len * inner * 2  # q k^T and probs v
+        flops += 2 * seq_len * config.hidden_size * config.intermediate_size * 2
+    return 2 * flops / 1e9
+
+
+def write_report(rows, report_file):
+    dense_ms = rows[0]['ms_per_batch']
+    lines = ['| variant | layers | heads | GFLOPs / pair | spearman | ms / batch | speedup |',
+             '|---|---|---|---|---|---|---|']
+    for r in rows:
+        lines.append(f"| {r['variant']} | {r['num_layers']} | {r['num_heads']} | {r['gflops']:.2f} | "
+                     f"{r['spearman']:.4f} | {r['ms_per_batch']:.1f} | {dense_ms / r['ms_per_batch']:.2f}x |")
+    with open(report_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(os.path.splitext(report_file)[0] + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    print('\n'.join(lines))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = parser.parse_args()
+    set_threading(args)
+    pprint(vars(args))
+    if args.prune_spec or args.early_exit_heads:
+        raise ValueError('prune a dense checkpoint without exit heads')
+
+    module_name, class_name, data_helper_name = FAMILIES[args.family]
+    MultiModal = getattr(importlib.import_module(module_name), class_name)
+    require_full_frames(args, MultiModal)
+    create_datasets = importlib.import_module(data_helper_name).create_datasets
+    train_dataset, val_dataset = create_datasets(args)
+    val_batch = next(iter(val_dataset))
+    seq_len = val_batch['input_ids_1'].shape[1]
+    if args.family.startswith('uniter'):
+        seq_len += val_batch['frames_1'].shape[1]
+
+    model = MultiModal(args)
+    ckpt_file = resolve_ckpt(args.ckpt_file)
+    tf.train.Checkpoint(model=model).restore(ckpt_file).expect_partial()
+    logging.info(f'Restored from {ckpt_file}')
+    model(val_batch, training=False)
+    config = model.bert.config
+    head_size = config.hidden_size // config.num_attention_heads
+
+    head_scores, layer_scores = importance_scores(args, model, train_dataset)
+    logging.info(f'layer importance: {np.round(layer_scores, 4).tolist()}')
+
+    dense_spec = {'kept_layers': list(range(config.num_hidden_layers)),
+                  'num_hidden_layers': config.num_hidden_layers, 'pruned_heads': {}}
+    specs = [(f'layers-{n}', layer_prune_spec(layer_scores, int(n))) for n in args.layer_drops.split(',') if n]
+    head_sparsity = [float(s) for s in args.head_sparsity.split(',') if s]
+    if head_sparsity and args.family.startswith('mix'):
+        logging.warning(f'{args.family} uses the stock transformers attention, only dropping layers')
+    elif head_sparsity:
+        specs = [(f'heads-{s:g}', head_prune_spec(head_scores, s)) for s in head_sparsity] + specs
+
+    spearman, ms_per_batch = evaluate(model, val_dataset)
+    rows = [{'variant': 'dense', 'num_layers': config.num_hidden_layers,
+             'num_heads': config.num_hidden_layers * config.num_attention_heads,
+             'gflops': encoder_gflops(config, dense_spec, seq_len),
+             'spearman': float(spearman), 'ms_per_batch': float(ms_per_batch)}]
+
+    prune_dir = args.prune_dir or os.path.join(os.path.dirname(ckpt_file), 'pruned')
+    for variant, spec in specs:
+        out_dir = os.path.join(prune_dir, variant)
+        os.makedirs(out_dir, exist_ok=True)
+        spec_file = os.path.join(out_dir, 'prune_spec.json')
+        with open(spec_file, 'w') as f:
+            json.dump(dict(spec, source_ckpt=ckpt_file), f, indent=2)
+
+        pruned_args = copy.copy(args)
+        pruned_args.prune_spec = spec_file
+        pruned_model = MultiModal(pruned_args)
+        pruned_model(val_batch, training=False)
+        copy_pruned_weights(model, pruned_model, spec, config.num_attention_heads, head_size)
+        finetune(args, pruned_model, train_dataset)
+
+        pruned_ckpt = tf.train.Checkpoint(model=pruned_model).write(os.path.join(out_dir, 'ckpt-pruned'))
+        logging.info(f'{variant}: saved {pruned_ckpt}, load it with --prune-spec {spec_file}')
+        spearman, ms_per_batch = evaluate(pruned_model, val_dataset)
+        rows.append({'variant': variant, 'num_layers': spec['num_hidden_layers'],
+                     'num_heads': spec['num_hidden_layers'] * config.num_attention_heads
+                                  - sum(len(h) for h in spec['pruned_heads'].values()),
+                     'gflops': encoder_gflops(config, spec, seq_len),
+                     'spearman': float(spearman), 'ms_per_batch': float(ms_per_batch)})
+        logging.info(f"{variant}: spearmanr {spearman:.4f}, {ms_per_batch:.1f} ms / batch")
+
+    write_report(rows, os.path.join(prune_dir, 'prune_report.md'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Top-k most similar videos by cosine similarity of their embeddings")
+parser.add_argument('--embedding-file', type=str, default='result.npz',
+                    help='.npz from --output-npz / fit_projection.py, or a vid -> embedding .json')
+parser.add_argument('--query-vids', type=str, default='', help='file with one vid per line, empty queries every vid')
+parser.add_argument('--top-k', type=int, default=20)
+parser.add_argument('--block-size', type=int, default=16384, help='database rows scored at once per thread')
+parser.add_argument('--query-batch-size', type=int, default=1024)
+parser.add_argument('--num-threads', type=int, default=0, help='0 means one per core')
+parser.add_argument('--output-json', type=str, default='topk.json', help='vid -> [[vid, score], ...]')
+
+
+def load_embeddings(embedding_file):
+    """vids and float16 embedding matrix of an .npz (util.write_embedding_matrix) or an inference / ensemble .json."""
+    if embedding_file.endswith('.json'):
+        with open(embedding_file) as f:
+            vid_embedding = json.load(f)
+        vids = list(vid_embedding)
+        return np.array(vids), np.array([vid_embedding[vid] for vid in vids], dtype=np.float16)
+    data = np.load(embedding_file)
+    return data['vids'], data['embeddings'].astype(np.float16, copy=False)
+
+
+def l2_normalize(embeddings):
+    embeddings = embeddings.astype(np.float32)
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(scores, k):
+    """Indices of the k largest scores of every row, best first."""
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+class EmbeddingIndex:
+    """Exact cosine top-k over an L2-normalized float16 embedding matrix.
+
+    Queries are scored against blocks of block_size rows (cast to float32 one block at a time, so memory per
+    thread is bounded by query_batch_size x block_size scores); every block keeps its own top-k with
+    argpartition and the candidates of all blocks are merged. Blocks run on a thread pool, numpy releases
+    the GIL inside the matmul.
+    """
+
+    def __init__(self, vids, embeddings, block_size=16384, query_batch_size=1024, num_threads=0):
+        self.vids = np.asarray(vids)
+        self.embeddings = np.empty(embeddings.shape, dtype=np.float16)
+        for start in range(0, len(embeddings), block_size):
+            self.embeddings[start:start + block_size] = l2_normalize(embeddings[start:start + block_size])
+        self.row_of = {vid: i for i, vid in enumerate(self.vids)}
+        self.block_size = block_size
+        self.query_batch_size = query_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=num_threads or os.cpu_count())
+
+    @classmethod
+    def load(cls, embedding_file, **kwargs):
+        return cls(*load_embeddings(embedding_file), **kwargs)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def _search_block(self, queries, start, k):
+        block = self.embeddings[start:start + self.block_size].astype(np.float32)
+        scores = queries @ block.T
+        indices = top_k(scores, k)
+        return np.take_along_axis(scores, indices, axis=1), indices + start
+
+    def _search_batch(self, queries, k):
+        starts = range(0, len(self.embeddings), self.block_size)
+        results = list(self.executor.map(lambda start: self._search_block(queries, start, k), starts))
+        scores = np.concatenate([r[0] for r in results], axis=1)
+        indices = np.concatenate([r[1] for r in results], axis=1)
+        best = top_k(scores, k)
+        return np.take_along_axis(scores, best, axis=1), np.take_along_axis(indices, best, axis=1)
+
+    def search(self, queries, k):
+        """Cosine scores and row indices of the k nearest rows of every query, best first."""
+        queries = l2_normalize(np.atleast_2d(queries))
+        results = [self._search_batch(queries[i:i + self.query_batch_size], k)
+                   for i in range(0, len(queries), self.query_batch_size)]
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def search_vids(self, query_vids, k, exclude_self=True):
+        """{query vid: [(vid, score), ...]} of indexed vids, the query itself left out."""
+        rows = [self.row_of[vid] for vid in query_vids]
+        scores, indices = self.search(self.embeddings[rows], k + exclude_self)
+        results = {}
+        for vid, row, row_scores, row_indices in zip(query_vids, rows, scores, indices):
+            hits = [(str(self.vids[i]), float(s)) for s, i in zip(row_scores, row_indices) if not exclude_self or i != row]
+            results[vid] = hits[:k]
+        return results
+
+
+def main():
+    args = parser.parse_args()
+    index = EmbeddingIndex.load(args.embedding_file, block_size=args.block_size,
+                                query_batch_size=args.query_batch_size, num_threads=args.num_threads)
+    if args.query_vids:
+        with open(args.query_vids) as f:
+            query_vids = [line.strip() for line in f if line.strip()]
+    else:
+        query_vids = [str(vid) for vid in index.vids]
+    print(f'{len(index)} indexed embeddings, {len(query_vids)} queries')
+    with open(args.output_json, 'w') as f:
+        json.dump(index.search_vids(query_vids, args.top_k), f)
+
+
+if __name__ == '__main__':
+    main()
@@ -129,6 +129,17 @@ class TFRoFormerSinusoidalPositionalEmbedding(tf.keras.layers.Layer):
         positions = tf.range(past_key_values_length, seq_len + past_key_values_length, delta=1, name="range")
         return tf.gather(self.weight, positions)
 
+    def rotary_tables(self, seq_len: int):
+        """
+        Interleaved rotation tables for the first seq_len positions, computed once per forward and shared by all
+        layers: cos_pos [1, 1, seq_len, dim // 2, 2] holds (cos θi, cos θi) and sin_pos holds (-sin θi, sin θi), the sign
+        of rotate_half folded in.
+        """
+        sin, cos = tf.split(self.weight[:seq_len], num_or_size_splits=2, axis=-1)
+        cos_pos = tf.stack([cos, cos], axis=-1)[None, None]
+        sin_pos = tf.stack([-sin, sin], axis=-1)[None, None]
+        return sin_pos, cos_pos
+
 
 class TFRoFormerEmbeddings(tf.keras.layers.Layer):
     """Construct the embeddings from word, position and token_type embeddings."""
@@ -194,7 +205,7 @@ class TFRoFormerEmbeddings(tf.keras.layers.Layer):
 
 
 class TFRoFormerSelfAttention(tf.keras.layers.Layer):
-    def __init__(self, config: RoFormerConfig, **kwargs):
+    def __init__(self, config: RoFormerConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
         if config.hidden_size % config.num_attention_heads != 0:
@@ -203,7 +214,9 @@ class TFRoFormerSelfAttention(tf.keras.layers.Layer):
                 f"of attention heads ({config.num_attention_heads})"
             )
 
-        self.num_attention_heads = config.num_attention_heads
+        # heads listed in config.pruned_heads (written by prune_backbone.py) are not built
+        pruned_heads = getattr(config, "pruned_heads", {}).get(layer_idx, [])
+        self.num_attention_heads = config.num_attention_heads - len(pruned_heads)
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
         self.sqrt_att_head_size = math.sqrt(self.attention_head_size)
@@ -285,28 +298,16 @@ class TFRoFormerSelfAttention(tf.keras.layers.Layer):
     @staticmethod
     def apply_rotary_position_embeddings(sinusoidal_pos, query_layer, key_layer, value_layer=None):
         # https://kexue.fm/archives/8265
-        # sin [batch_size, num_heads, sequence_length, embed_size_per_head//2]
-        # cos [batch_size, num_heads, sequence_length, embed_size_per_head//2]
-        sin, cos = tf.split(sinusoidal_pos, num_or_size_splits=2, axis=-1)
-        # sin [θ0,θ1,θ2......θd/2-1]-> sin_pos [θ0,θ0,θ1,θ1,θ2,θ2......θd/2-1,θd/2-1]
-        # cos [θ0,θ1,θ2......θd/2-1]-> cos_pos [θ0,θ0,θ1,θ1,θ2,θ2......θd/2-1,θd/2-1]
-        sin_pos = tf.repeat(sin, 2, axis=-1)
-        cos_pos = tf.repeat(cos, 2, axis=-1)
-        # rotate_half_query_layer [-q1,q0,-q3,q2......,-qd-1,qd-2]
-        rotate_half_query_layer = tf.stack([-query_layer[..., 1::2], query_layer[..., ::2]], axis=-1)
-        rotate_half_query_layer = tf.reshape(rotate_half_query_layer, shape_list(query_layer))
-        query_layer = query_layer * cos_pos + rotate_half_query_layer * sin_pos
-        # rotate_half_key_layer [-k1,k0,-k3,k2......,-kd-1,kd-2]
-        rotate_half_key_layer = tf.stack([-key_layer[..., 1::2], key_layer[..., ::2]], axis=-1)
-        rotate_half_key_layer = tf.reshape(rotate_half_key_layer, shape_list(key_layer))
-        key_layer = key_layer * cos_pos + rotate_half_key_layer * sin_pos
-        if value_layer is not None:
-            # rotate_half_value_layer [-v1,v0,-v3,v2......,-vd-1,vd-2]
-            rotate_half_value_layer = tf.stack([-value_layer[..., 1::2], value_layer[..., ::2]], axis=-1)
-            rotate_half_value_layer = tf.reshape(rotate_half_value_layer, shape_list(value_layer))
-            value_layer = value_layer * cos_pos + rotate_half_value_layer * sin_pos
-            return query_layer, key_layer, value_layer
-        return query_layer, key_layer
+        # sinusoidal_pos: (sin_pos, cos_pos) from TFRoFormerSinusoidalPositionalEmbedding.rotary_tables
+        # x * cos_pos + rotate_half(x) * sin_pos with rotate_half(x) = [-x1,x0,-x3,x2......,-xd-1,xd-2], done on
+        # q, k (and v) stacked together so that every layer applies the rotation once
+        sin_pos, cos_pos = sinusoidal_pos
+        layers = [query_layer, key_layer] if value_layer is None else [query_layer, key_layer, value_layer]
+        shape = shape_list(query_layer)
+        # [2 or 3, batch_size, num_heads, sequence_length, embed_size_per_head//2, 2]
+        pairs = tf.reshape(tf.stack(layers), [len(layers)] + shape[:-1] + [shape[-1] // 2, 2])
+        pairs = pairs * cos_pos + tf.reverse(pairs, axis=[-1]) * sin_pos
+        return tuple(tf.unstack(tf.reshape(pairs, [len(layers)] + shape)))
 
 
 # Copied from transformers.models.bert.modeling_tf_bert.TFBertSelfOutput with Bert->RoFormer
@@ -329,10 +330,10 @@ class TFRoFormerSelfOutput(tf.keras.layers.Layer):
 
 
 class TFRoFormerAttention(tf.keras.layers.Layer):
-    def __init__(self, config: RoFormerConfig, **kwargs):
+    def __init__(self, config: RoFormerConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
-        self.self_attention = TFRoFormerSelfAttention(config, name="self")
+        self.self_attention = TFRoFormerSelfAttention(config, layer_idx=layer_idx, name="self")
         self.dense_output = TFRoFormerSelfOutput(config, name="output")
 
     def prune_heads(self, heads):
@@ -404,10 +405,10 @@ class TFRoFormerOutput(tf.keras.layers.Layer):
 
 
 class TFRoFormerLayer(tf.keras.layers.Layer):
-    def __init__(self, config: RoFormerConfig, **kwargs):
+    def __init__(self, config: RoFormerConfig, layer_idx: int = 0, **kwargs):
         super().__init__(**kwargs)
 
-        self.attention = TFRoFormerAttention(config, name="attention")
+        self.attention = TFRoFormerAttention(config, layer_idx=layer_idx, name="attention")
         self.intermediate = TFRoFormerIntermediate(config, name="intermediate")
         self.roformer_output = TFRoFormerOutput(config, name="output")
 
@@ -446,7 +447,18 @@ class TFRoFormerEncoder(tf.keras.layers.Layer):
             config.hidden_size // config.num_attention_heads,
             name="embed_positions",
         )
-        self.layer = [TFRoFormerLayer(config, name=f"layer_._{i}") for i in range(config.num_hidden_layers)]
+        self.layer = [TFRoFormerLayer(config, layer_idx=i, name=f"layer_._{i}") for i in range(config.num_hidden_layers)]
+        # inference depth, 0 runs every layer; set through util.set_inference_depth
+        self.num_layers_infer = 0
+        # residual heads mapping the output of layer i + 1 towards the last layer, zero-initialized so that
+        # an untrained head is plain truncation; trained by calibrate_depth.py
+        self.exit_heads = None
+        if getattr(config, "early_exit_heads", False):
+            self.exit_heads = [
+                tf.keras.layers.Dense(config.hidden_size, kernel_initializer="zeros", name=f"exit_head_._{i}")
+                for i in range(config.num_hidden_layers - 1)
+            ]
+        self.distill_exit_heads = False
 
     def call(
         self,
@@ -461,10 +473,20 @@ class TFRoFormerEncoder(tf.keras.layers.Layer):
         all_hidden_states = () if output_hidden_states else None
         all_attentions = () if output_attentions else None
 
-        # [sequence_length, embed_size_per_head] -> [batch_size, num_heads, sequence_length, embed_size_per_head]
-        sinusoidal_pos = self.embed_positions(shape_list(hidden_states)[:-1])[None, None, :, :]
+        if not self.embed_positions.built:
+            self.embed_positions(shape_list(hidden_states)[:-1])
+        # rotation tables of this sequence length, shared by all layers
+        sinusoidal_pos = self.embed_positions.rotary_tables(shape_list(hidden_states)[1])
 
-        for i, layer_module in enumerate(self.layer):
+        num_layers = len(self.layer)
+        if self.num_layers_infer and not training:
+            num_layers = min(self.num_layers_infer, num_layers)
+        distill = self.distill_exit_heads and self.exit_heads is not None and num_layers == len(self.layer)
+        exits = []
+
+        for i, layer_module in enumerate(self.layer[:num_layers]):
+            if distill and i > 0:
+                exits.append(hidden_states)
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -481,6 +503,15 @@ class TFRoFormerEncoder(tf.keras.layers.Layer):
             if output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
 
+        if distill:
+            # every head learns to predict the (frozen) last layer from its exit
+            target = tf.stop_gradient(hidden_states)
+            for i, exit_states in enumerate(exits):
+                exit_states = tf.stop_gradient(exit_states)
+                self.add_loss(tf.reduce_mean(tf.square(exit_states + self.exit_heads[i](exit_states) - target)))
+        elif self.exit_heads is not None and num_layers < len(self.layer):
+            hidden_states = hidden_states + self.exit_heads[num_layers - 1](hidden_states)
+
         # Add last layer
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
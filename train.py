@@ -8,13 +8,14 @@ from config import parser
 from data_helper import create_datasets
 from metrics import Recorder
 from model import MultiModal
-from util import test_spearmanr
+from util import test_spearmanr, require_full_frames
 
 
 def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
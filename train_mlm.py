@@ -3,18 +3,23 @@ import os
 from pprint import pprint
 
 import tensorflow as tf
+from transformers import BertTokenizer
 
+from augment import BatchAugmenter
 from config import parser
 from data_helper_mlm import create_datasets
 from metrics import Recorder
 from model_mlm import BERTforMaskedLM
-from util import test_spearmanr
+from util import test_spearmanr, require_full_frames
 
 
 def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
+    # mlm masking and the --aug-* augmentation run on the batches in the steps
+    augmenter = BatchAugmenter(args, BertTokenizer.from_pretrained(args.bert_dir))
     # 2. build model
+    require_full_frames(args, BERTforMaskedLM)
     model = BERTforMaskedLM(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step=tf.Variable(0))
@@ -31,6 +36,7 @@ def train(args):
     # 5. define train and valid step function
     @tf.function
     def train_step(inputs):
+        inputs = augmenter(augmenter.mask_batch(inputs))
         labels = inputs['mask_labels']
         with tf.GradientTape() as tape:
             predictions, loss = model(inputs, training=True)
@@ -41,6 +47,7 @@ def train(args):
 
     @tf.function
     def val_step(inputs):
+        inputs = augmenter.mask_batch(inputs)
         vids = inputs['vid']
         labels = inputs['mask_labels']
         predictions, loss = model(inputs, training=False)
@@ -1,15 +1,19 @@
 import logging
 import os
+import time
 from pprint import pprint
 
 import tensorflow as tf
+from transformers import BertTokenizer
 
+from augment import BatchAugmenter
 from config_pair import parser
-from data_helper_pair import create_datasets
+from data_helper_pair import create_cache_dataset, create_datasets
 from metrics_pair import Recorder
 from model_pair_mix import MultiModal_mix as MultiModal
 import numpy as np
 from scipy.stats import spearmanr
+from util import set_threading, StepProfiler, AsyncCheckpointSaver, EvalSchedule, HiddenStateCache, matryoshka_dims, nested_pair_loss, TrainState, require_full_frames
 from cqrtrain import contrastive_loss
 
 
@@ -22,44 +26,70 @@ def train(args):
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     print(train_dataset)
+    # --aug-* augmentation of the train batches, in the train step
+    augmenter = BatchAugmenter(args, BertTokenizer.from_pretrained(args.bert_dir))
+    if args.freeze_layers and (args.aug_frame_dropout or args.aug_frame_jitter or args.aug_token_mask):
+        raise ValueError('--freeze-layers caches the hidden states of unaugmented videos, only --aug-swap-sides applies')
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step_1=tf.Variable(0))
-    checkpoint_manager = tf.train.CheckpointManager(checkpoint, args.savedmodel_path, args.max_to_keep)
+    def build_shadow():
+        shadow = MultiModal(args)
+        shadow(next(iter(val_dataset)), training=False)
+        return shadow
+    checkpoint_saver = AsyncCheckpointSaver(model, build_shadow, args.savedmodel_path, args.max_to_keep,
+                                            args.save_min_spearman, resume=bool(args.resume_training))
     restored_ckpt = tf.train.latest_checkpoint(args.pretrain_model_dir)
     checkpoint.restore(restored_ckpt).expect_partial()
     if restored_ckpt:
         logging.info("Restored from {}".format(restored_ckpt))
     else:
         logging.info("Initializing from scratch.")
+    if args.freeze_layers:
+        # the frozen bottom layers run once per train video, every step starts from their cached output
+        hidden_cache = HiddenStateCache(args.hidden_cache_dir or os.path.join(args.savedmodel_path, 'hidden_cache'),
+                                        key=[args.bert_dir, restored_ckpt, args.prune_spec, args.freeze_layers,
+                                             args.bert_seq_length, args.max_frames, type(model).__name__])
+        hidden_cache.build(create_cache_dataset(args), model.frozen_hidden)
+        train_dataset = hidden_cache.attach(train_dataset)
     # 4. create loss_object and recorders
     loss_object = MSE
     loss_kl = tf.keras.losses.KLDivergence()
+    nested_dims = matryoshka_dims(args)
     loss_object_tag = tf.keras.losses.BinaryCrossentropy(reduction=tf.keras.losses.Reduction.NONE)
     train_recorder, val_recorder = Recorder(), Recorder()
 
     # 5. define train and valid step_1 function
-    @tf.function
-    def train_step_1(inputs):
+    def compute_loss_1(inputs, training):
+        if training and augmenter.active:
+            inputs = augmenter(inputs)
         label_sims = inputs['sim']
         labels_1 = inputs['labels_1']
         labels_2 = inputs['labels_2']
+        final_embedding_1, final_embedding_2, predictions_1, predictions_2, aux_preds_1, aux_preds_2 = model(inputs, training=training)
+        final_embedding_1 = tf.math.l2_normalize(final_embedding_1, axis=1)
+        final_embedding_2 = tf.math.l2_normalize(final_embedding_2, axis=1)
+        sim = tf.reduce_sum(final_embedding_1 * final_embedding_2, axis=1)
+        loss_0 = loss_object(sim, label_sims)
+        #loss_1 = contrastive_loss(vision_embedding, bert_embedding) * 5.0
+        predictions = tf.concat([predictions_1, predictions_2], 0)
+        labels = tf.concat([labels_1, labels_2], 0)
+        loss_1 = loss_kl(label_sims, sim) 
+        loss_tag = loss_object_tag(labels, predictions) * labels.shape[-1]  # convert mean back to sum
+        # for i in range(3):
+        #     aux_pred = tf.concat([aux_preds_1[i], aux_preds_2[i]], 0)
+        #     loss_tag += loss_object_tag(labels, aux_pred) * labels.shape[-1]
+        loss = loss_0 + args.kl_weight*loss_1 + loss_tag#/4 + regularization_loss * 10
+        if nested_dims:
+            loss += nested_pair_loss(final_embedding_1, final_embedding_2, label_sims, nested_dims, args.kl_weight)
+        return loss, loss_0, loss_1
+
+    @tf.function
+    def train_step_1(inputs):
         with tf.GradientTape() as tape:
-            final_embedding_1, final_embedding_2, predictions_1, predictions_2, aux_preds_1, aux_preds_2 = model(inputs, training=True)
-            final_embedding_1 = tf.math.l2_normalize(final_embedding_1, axis=1)
-            final_embedding_2 = tf.math.l2_normalize(final_embedding_2, axis=1)
-            sim = tf.reduce_sum(final_embedding_1 * final_embedding_2, axis=1)
-            loss_0 = loss_object(sim, label_sims)
-            #loss_1 = contrastive_loss(vision_embedding, bert_embedding) * 5.0
-            predictions = tf.concat([predictions_1, predictions_2], 0)
-            labels = tf.concat([labels_1, labels_2], 0)
-            loss_1 = loss_kl(label_sims, sim) 
-            loss_tag = loss_object_tag(labels, predictions) * labels.shape[-1]  # convert mean back to sum
-            # for i in range(3):
-            #     aux_pred = tf.concat([aux_preds_1[i], aux_preds_2[i]], 0)
-            #     loss_tag += loss_object_tag(labels, aux_pred) * labels.shape[-1]
-            loss = loss_0 + args.kl_weight*loss_1 + loss_tag#/4 + regularization_loss * 10
+            loss, loss_0, loss_1 = compute_loss_1(inputs, training=True)
         gradients = tape.gradient(loss, model.get_variables())
         model.optimize(gradients)
         train_recorder.record(loss, loss_0, loss_1)
@@ -87,10 +117,18 @@ def train(args):
         loss = loss_0 + args.kl_weight*loss_1 + loss_tag#/4 + regularization_loss * 10
         val_recorder.record(loss, loss_0, loss_1)
         return vids_1, sim, label_sims
+    step_profiler = StepProfiler(args, model, compute_loss_1, train_recorder)
+    eval_schedule = EvalSchedule(args.eval_freq, args.min_eval_freq, args.eval_tighten_delta, args.early_stop_patience)
     # import pdb;pdb.set_trace()
     # 6. training
-    for epoch in range(args.start_epoch, args.epochs):
-        for train_batch in train_dataset:
+    # weights, optimizer slots and step every --save-state-freq steps, restored with --resume-training
+    train_state = TrainState(args, model, checkpoint.step_1, train_dataset)
+    if args.resume_training:
+        eval_schedule.resume(int(checkpoint.step_1.numpy()), checkpoint_saver.kept)
+    data_start = time.perf_counter()
+    for epoch in train_state.epochs(args.epochs):
+        for train_batch in train_state.iterator:
+            data_time = time.perf_counter() - data_start
 
             checkpoint.step_1.assign_add(1)
             step_1 = checkpoint.step_1.numpy()
@@ -114,14 +152,21 @@ def train(args):
 
             # tf.print(args.total_steps)
             if step_1 > args.total_steps:
+                # this step does not train, the weights are those of the previous one
+                checkpoint.step_1.assign_add(-1)
+                step_1 -= 1
                 break
-            train_step_1(train_batch)
+            if step_profiler.active(step_1):
+                step_profiler.train_step(epoch, step_1, train_batch, data_time)
+            else:
+                train_step_1(train_batch)
+            train_state.maybe_save(step_1)
             if step_1 % args.print_freq == 0:
                 train_recorder.log(epoch, step_1)
                 train_recorder.reset()
 
             # 7. validation
-            if step_1 % args.eval_freq == 0:
+            if eval_schedule.should_eval(step_1):
                 vids_ = []
                 sims_ = []
                 label_sims_ = []
@@ -137,25 +182,33 @@ def train(args):
                 val_recorder.log(epoch, step_1, prefix='Validation result is: ', suffix=f', spearmanr {spearman:.4f}')
                 val_recorder.reset()
 
-                # 9. save checkpoints
-                if spearman > 0.45:
-                    checkpoint_manager.save(checkpoint_number=step_1)
-    # last step
-    vids_ = []
-    sims_ = []
-    label_sims_ = []
-    for val_batch in val_dataset:
-        vids, sims, label_sims = val_step_1(val_batch)
-        for vid, sim, label_sim in zip(vids.numpy(), sims.numpy(), label_sims.numpy()):
-            vids_.append(vid.decode('utf-8'))
-            sims_.append(sim)
-            label_sims_.append(label_sim)
-    vids_, sims_, label_sims_ = np.array(vids_), np.array(sims_), np.array(label_sims_)
-    # 8. test spearman correlation
-    spearman = spearmanr(sims_, label_sims_)[0]
-    val_recorder.log(epoch, step_1, prefix='Validation result is: ', suffix=f', spearmanr {spearman:.4f}')
-    val_recorder.reset()
-    checkpoint_manager.save(checkpoint_number=step_1)
+                # 9. save checkpoints, kept by spearman and written in the background
+                checkpoint_saver.save(step_1, spearman)
+                if eval_schedule.update(step_1, spearman):
+                    break
+            data_start = time.perf_counter()
+        if eval_schedule.stopped:
+            break
+    # last step, unless it was just evaluated (early stop, or --total-steps on an eval step)
+    if eval_schedule.last_step != step_1:
+        vids_ = []
+        sims_ = []
+        label_sims_ = []
+        for val_batch in val_dataset:
+            vids, sims, label_sims = val_step_1(val_batch)
+            for vid, sim, label_sim in zip(vids.numpy(), sims.numpy(), label_sims.numpy()):
+                vids_.append(vid.decode('utf-8'))
+                sims_.append(sim)
+                label_sims_.append(label_sim)
+        vids_, sims_, label_sims_ = np.array(vids_), np.array(sims_), np.array(label_sims_)
+        # 8. test spearman correlation
+        spearman = spearmanr(sims_, label_sims_)[0]
+        val_recorder.log(epoch, step_1, prefix='Validation result is: ', suffix=f', spearmanr {spearman:.4f}')
+        val_recorder.reset()
+        checkpoint_saver.save(step_1, spearman)
+        eval_schedule.record(step_1, spearman)
+    checkpoint_saver.close()
+    logging.info(f'Best spearmanr {eval_schedule.best_score:.4f} at step {eval_schedule.best_step}')
 
 
 def main():
@@ -163,6 +216,7 @@ def main():
                         format='%(asctime)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
     args = parser.parse_args()
+    set_threading(args)
 
     if not os.path.exists(args.savedmodel_path):
         os.makedirs(args.savedmodel_path)
@@ -13,6 +13,7 @@ import numpy as np
 from scipy.stats import spearmanr
 from cqrtrain import contrastive_loss
 from fast_soft_sort.tf_ops import soft_rank, soft_sort
+from util import reject_freeze_layers, require_full_frames
 
 
 def MSE(sim, label):
@@ -35,10 +36,12 @@ def spearmanr_loss(pred, target):
     return tf.reduce_sum(pred * target)
 
 def train(args):
+    reject_freeze_layers(args)
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     print(train_dataset)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step_1=tf.Variable(0))
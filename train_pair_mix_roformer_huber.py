@@ -11,6 +11,7 @@ from model_pair_mix_roformer import MultiModal_mix as MultiModal
 import numpy as np
 from scipy.stats import spearmanr
 from cqrtrain import contrastive_loss
+from util import reject_freeze_layers, require_full_frames
 
 
 def MSE(sim, label):
@@ -27,10 +28,12 @@ def KL(sim, label):
     return tf.keras.losses.KLDivergence()(label, sim)
 
 def train(args):
+    reject_freeze_layers(args)
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     print(train_dataset)
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step_1=tf.Variable(0))
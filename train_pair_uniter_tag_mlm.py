@@ -3,7 +3,9 @@ import os
 from pprint import pprint
 
 import tensorflow as tf
+from transformers import BertTokenizer
 
+from augment import BatchAugmenter
 from config_pair import parser
 from data_helper_pair_mask import create_datasets
 from metrics_pair import Recorder_3
@@ -11,6 +13,7 @@ from model_pair_uniter import MultiModal_Uniter_mlm as MultiModal
 import numpy as np
 from scipy.stats import spearmanr
 from cqrtrain_mlm_mm import contrastive_loss, compute_loss, shape_list
+from util import reject_freeze_layers, require_full_frames
 
 
 def MSE(sim, label):
@@ -19,10 +22,14 @@ def KL(sim, label):
     return tf.keras.losses.KLDivergence()(label, sim)
 
 def train(args):
+    reject_freeze_layers(args)
     # 1. create dataset and set num_labels to args
     train_dataset, val_dataset = create_datasets(args)
     print(train_dataset)
+    # mlm masking and the --aug-* augmentation run on the train batches in the step, val titles stay unmasked
+    augmenter = BatchAugmenter(args, BertTokenizer.from_pretrained(args.bert_dir))
     # 2. build model
+    require_full_frames(args, MultiModal)
     model = MultiModal(args)
     # 3. save checkpoints
     checkpoint = tf.train.Checkpoint(model=model, step_1=tf.Variable(0))
@@ -42,6 +49,7 @@ def train(args):
     # 5. define train and valid step_1 function
     @tf.function
     def train_step_1(inputs):
+        inputs = augmenter(augmenter.mask_batch(inputs))
         label_sims = inputs['sim']
         labels_1 = inputs['labels_1']
         labels_2 = inputs['labels_2']
@@ -1,6 +1,24 @@
+import atexit
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
 import scipy
+import tensorflow as tf
 from sklearn.metrics.pairwise import cosine_similarity
 
+from metrics_pair import StepTimeRecorder
+
 
 def test_spearmanr(vid_embedding, annotation_file):
     relevances, similarities = [], []
@@ -20,3 +38,710 @@ def test_spearmanr(vid_embedding, annotation_file):
 
     spearmanr = scipy.stats.spearmanr(similarities, relevances).correlation
     return spearmanr
+
+
+def set_threading(args):
+    # 0 keeps the TF default, fold_scheduler.py sets both to match the cores a job is pinned to
+    tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+
+def set_seed(args):
+    np.random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+
+
+def bucket_by_length(dataset, bucket_boundaries, batch_size, max_seq_length, max_frames, drop_remainder):
+    """Batch parsed examples of similar length (title tokens + num_frames, the longer side for pairs)
+    together, then cut every input_ids*/mask* tensor of the batch to min(boundary, max_seq_length)
+    and every frames* tensor to min(boundary, max_frames). Everything cut off is padding of the batch,
+    so models see at most len(boundaries) + 1 sequence shapes instead of one fully padded shape."""
+    boundaries = sorted(int(b) for b in bucket_boundaries.split(','))
+    keys = list(dataset.element_spec)
+    sides = [k[len('num_frames'):] for k in keys if k.startswith('num_frames')]
+    text_keys = [k for k in keys if k.startswith(('input_ids', 'mask'))]
+    frame_keys = [k for k in keys if k.startswith('frames')]
+    text_lengths = tf.constant([min(b, max_seq_length) for b in boundaries] + [max_seq_length], tf.int32)
+    frame_lengths = tf.constant([min(b, max_frames) for b in boundaries] + [max_frames], tf.int32)
+
+    def bucket_id(example):
+        lengths = [tf.reduce_sum(example['mask' + side]) + example['num_frames' + side][0] for side in sides]
+        length = tf.reduce_max(tf.stack(lengths))
+        return tf.reduce_sum(tf.cast(length > tf.constant(boundaries), tf.int64))
+
+    def cut(bucket, batch):
+        batch = dict(batch)
+        for k in text_keys:
+            batch[k] = batch[k][:, :text_lengths[bucket]]
+        for k in frame_keys:
+            batch[k] = batch[k][:, :frame_lengths[bucket]]
+        return batch
+
+    def batch_bucket(bucket, window):
+        return window.batch(batch_size, drop_remainder=drop_remainder).map(lambda batch: cut(bucket, batch))
+
+    return dataset.apply(tf.data.experimental.group_by_window(bucket_id, batch_bucket, window_size=batch_size))
+
+
+def require_full_frames(args, model_class):
+    """Called once by every entry point on the model class it picked. NeXtVLAD / NextSoftDBoF and the frame mean of
+    the mix models run over all max_frames frame slots, the padding included, so frames cut by --bucket-boundaries
+    change their output; only the classes with masks_padding (the uniter models) pool with the masks."""
+    if getattr(args, 'bucket_boundaries', '') and not getattr(model_class, 'masks_padding', False):
+        raise ValueError(f'{model_class.__name__} averages padded frames, --bucket-boundaries would change its '
+                         f'output; bucket only the uniter families')
+
+
+def reject_freeze_layers(args):
+    """For the pair trainers without freeze_bottom and a HiddenStateCache, which would train the whole backbone."""
+    if args.freeze_layers:
+        raise ValueError(f'{os.path.basename(sys.argv[0])} trains the whole backbone, --freeze-layers is only '
+                         f'supported by train_pair_mix(_asl).py and train_pair_uniter_tag(_asl).py')
+
+
+def build_dataset(args, files, feature_map, parse, training, batch_size, shuffle_buffer, bucket_lengths=None,
+                  records=None, record_filter=None, distributed=False, cache=False):
+    """The TFRecord input pipeline of every data helper, deterministic for a given --seed.
+
+    Files are sorted, sharded (--num-shards / --shard-index, by file when there are enough files, else by
+    record) and, for training, reshuffled every epoch with a seeded order; --cycle-length files are read
+    interleaved --block-length records at a time, in a fixed order. Train records go through a seeded shuffle
+    buffer that is reshuffled every epoch too, so a run replays exactly and artifacts can be keyed by the seed.
+    records replaces the file reading with a dataset of serialized examples that is already sharded and in training
+    order (util.hard_negative_records), record_filter drops parsed records before the costly parse, bucket_lengths
+    (max title length, max frames) enables --bucket-boundaries and distributed runs everything up to the batches
+    in the tf.data service workers, each with its own unseeded order. With cache (the val / test datasets) the
+    records are cached parsed under --dataset-cache-dir (dataset_cache_prefix), so only the first pass over them
+    parses and tokenizes; filtered passes (e.g. skipping the vids of an embedding store) are not cached."""
+    seed = None if distributed else args.seed
+    if records is not None:
+        dataset = records
+    else:
+        files = sorted([files] if isinstance(files, str) else files)
+        shard_files = len(files) >= args.num_shards
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        if shard_files:
+            dataset = dataset.shard(args.num_shards, args.shard_index)
+        if training:
+            dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=args.cycle_length,
+                                     block_length=args.block_length,
+                                     num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=True)
+        if not shard_files:
+            dataset = dataset.shard(args.num_shards, args.shard_index)
+    dataset = dataset.map(lambda x: tf.io.parse_single_example(x, feature_map),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if record_filter is not None:
+        dataset = dataset.filter(record_filter)
+    if training and records is None:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if cache and not training and record_filter is None and args.dataset_cache_dir:
+        dataset = dataset.cache(dataset_cache_prefix(args, files, parse))
+    if bucket_lengths is not None and args.bucket_boundaries:
+        dataset = bucket_by_length(dataset, args.bucket_boundaries, batch_size, *bucket_lengths,
+                                   drop_remainder=training)
+    else:
+        dataset = dataset.batch(batch_size, drop_remainder=training)
+    if distributed:
+        # the trainer only receives ready batches, TF 2.3 supports parallel epochs only
+        dataset = dataset.apply(tf.data.experimental.service.distribute('parallel_epochs', args.data_service_address))
+    dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+    if training:
+        # the py_functions are pure, their state does not need to be in iterator checkpoints
+        options = tf.data.Options()
+        options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+        dataset = dataset.with_options(options)
+    return dataset
+
+
+def file_digest(path):
+    # cache keys depend on what a file holds, not on where it is
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def process_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def dataset_cache_prefix(args, files, parse):
+    """File prefix for Dataset.cache of the parsed records of files, one directory per key of everything the
+    parsed tensors depend on: the data helper, tokenizer, lengths, label file, shard and the files themselves.
+
+    A pass over the dataset writes the cache under tmp-<pid>/ of this process and TF finalizes it (cache.index)
+    only once the pass has read every record, a partial pass leaves nothing behind. Finished caches of any
+    process are published as ready/ by hard links, so concurrent evals and inference processes never share a
+    cache being written, and every later process reads ready/ instead of the records. The tmp-<pid>/ and
+    staging-<pid>/ dirs of processes that are gone are removed, published files live on in ready/.
+    """
+    key = [parse.__module__, args.bert_dir, args.bert_seq_length, args.max_frames, args.frame_embedding_size,
+           file_digest(args.multi_label_file), args.num_labels, args.num_shards, args.shard_index, args.cycle_length,
+           args.block_length, [[f, os.path.getsize(f), os.path.getmtime(f)] for f in sorted(files)]]
+    cache_dir = os.path.join(args.dataset_cache_dir, hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:16])
+    ready = os.path.join(cache_dir, 'ready')
+    for tmp in sorted(glob.glob(os.path.join(cache_dir, 'tmp-*'))):
+        if os.path.exists(ready):
+            break
+        if not os.path.exists(os.path.join(tmp, 'cache.index')):
+            continue
+        staging = os.path.join(cache_dir, f'staging-{os.getpid()}')
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for name in os.listdir(tmp):
+            if not name.endswith('.lockfile'):
+                os.link(os.path.join(tmp, name), os.path.join(staging, name))
+        try:
+            os.rename(staging, ready)
+            logging.info(f'Published dataset cache {tmp} as {ready}')
+        except OSError:
+            # another process published one first
+            shutil.rmtree(staging, ignore_errors=True)
+    for stale in glob.glob(os.path.join(cache_dir, 'tmp-*')) + glob.glob(os.path.join(cache_dir, 'staging-*')):
+        if not process_alive(int(stale.rsplit('-', 1)[1])):
+            shutil.rmtree(stale, ignore_errors=True)
+    if os.path.exists(ready):
+        logging.info(f'Reading {len(files)} record files parsed from {ready}')
+        return os.path.join(ready, 'cache')
+    tmp = os.path.join(cache_dir, f'tmp-{os.getpid()}')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with open(os.path.join(cache_dir, 'key.json'), 'w') as f:
+        json.dump(key, f)
+    logging.info(f'Caching {len(files)} record files parsed to {tmp}')
+    return os.path.join(tmp, 'cache')
+
+
+class TrainState:
+    """Model and optimizer variables, step, epoch and the position of the training input iterator,
+    saved together every --save-state-freq steps to <savedmodel-path>/train_state.
+
+    With --resume-training a restarted job restores all of it and continues from the next batch of the
+    same (seeded) input order instead of replaying the epoch from its start.
+    """
+
+    def __init__(self, args, model, step, dataset):
+        self.dataset = dataset
+        self.save_freq = args.save_state_freq
+        self.epoch = tf.Variable(args.start_epoch)
+        self.iterator = iter(dataset)
+        # the position of a tf.data service iterator cannot be saved, a resumed run restarts its epoch
+        self.save_iterator = not getattr(args, 'data_service_address', '')
+        self.checkpoint = tf.train.Checkpoint(model=model, step=step, epoch=self.epoch)
+        if self.save_iterator:
+            self.checkpoint.iterator = self.iterator
+        self.manager = tf.train.CheckpointManager(self.checkpoint, os.path.join(args.savedmodel_path, 'train_state'),
+                                                  max_to_keep=1)
+        if args.resume_training and self.manager.latest_checkpoint:
+            self.checkpoint.restore(self.manager.latest_checkpoint)
+            logging.info(f'Resumed from {self.manager.latest_checkpoint}, epoch {self.epoch.numpy()}, '
+                         f'step {step.numpy()}')
+
+    def epochs(self, num_epochs):
+        while self.epoch.numpy() < num_epochs:
+            yield int(self.epoch.numpy())
+            self.epoch.assign_add(1)
+            self.iterator = iter(self.dataset)
+            if self.save_iterator:
+                self.checkpoint.iterator = self.iterator
+
+    def maybe_save(self, step):
+        if self.save_freq and step % self.save_freq == 0:
+            self.manager.save(checkpoint_number=step)
+
+
+class StepProfiler:
+    """Runs the steps in --profile-steps a:b (inclusive) split into forward / backward / optimizer calls,
+    times each of them plus the wait for the input batch, and records a tf.profiler trace of the window.
+    Step a traces the three functions and is neither timed nor traced, the mean covers steps a+1 to b.
+    The extra forward pass also updates the BatchNorm moving statistics, so keep the window short."""
+
+    def __init__(self, args, model, compute_loss, train_recorder):
+        self.start, self.stop = 0, -1
+        if args.profile_steps:
+            self.start, self.stop = map(int, args.profile_steps.split(':'))
+            if self.stop <= self.start:
+                raise ValueError(f'--profile-steps {args.profile_steps}: step {self.start} only warms up, '
+                                 f'profile at least one more step')
+        self.logdir = os.path.join(args.savedmodel_path, 'profile')
+        self.model = model
+        self.train_recorder = train_recorder
+        self.step_recorder, self.time_recorder = StepTimeRecorder(), StepTimeRecorder()
+
+        @tf.function
+        def forward(inputs):
+            return compute_loss(inputs, training=True)[0]
+
+        @tf.function
+        def backward(inputs):
+            with tf.GradientTape() as tape:
+                loss, loss_0, loss_1 = compute_loss(inputs, training=True)
+            gradients = tape.gradient(loss, model.get_variables())
+            # global norm depends on every gradient, fetching it waits for the whole backward pass
+            grad_norm = tf.linalg.global_norm([g for g in gradients if g is not None])
+            return (loss, loss_0, loss_1), gradients, grad_norm
+
+        self.forward, self.backward = forward, backward
+        self.optimize = tf.function(model.optimize)
+
+    def active(self, step):
+        return self.start <= step <= self.stop
+
+    def train_step(self, epoch, step, inputs, data_time):
+        if step == self.start:
+            # the first call of each function is mostly tracing and compiling
+            self.forward(inputs)
+            losses, gradients, _ = self.backward(inputs)
+            self.optimize(gradients)
+            self.train_recorder.record(*losses)
+            logging.info(f'Step {step} traced the profiled functions, timing steps {step + 1}-{self.stop}')
+            return
+        if step == self.start + 1:
+            tf.profiler.experimental.start(self.logdir)
+        with tf.profiler.experimental.Trace('train', step_num=step, _r=1):
+            start = time.perf_counter()
+            self.forward(inputs).numpy()
+            forward_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            losses, gradients, grad_norm = self.backward(inputs)
+            grad_norm.numpy()
+            backward_time = time.perf_counter() - start - forward_time
+
+            start = time.perf_counter()
+            self.optimize(gradients)
+            self.model.optimizer_1.iterations.numpy()
+            optimizer_time = time.perf_counter() - start
+        self.train_recorder.record(*losses)
+
+        for recorder in (self.step_recorder, self.time_recorder):
+            recorder.record(data_time, forward_time, backward_time, optimizer_time)
+        self.step_recorder.log(epoch, step, prefix='Step time: ')
+        self.step_recorder.reset()
+        if step == self.stop:
+            tf.profiler.experimental.stop()
+            self.time_recorder.log(epoch, step, prefix=f'Mean step time of steps {self.start + 1}-{self.stop}: ',
+                                   suffix=f', trace saved to {self.logdir}')
+            self.time_recorder.reset()
+
+
+class EvalSchedule:
+    """Adaptive evaluation cadence plus patience-based early stopping on the validation spearman.
+
+    Evaluates every `eval_freq` steps while the score still climbs by more than `tighten_delta`; once the
+    gain drops below that (the curve flattens near its peak) the interval is halved down to `min_eval_freq`.
+    Training stops when the best score is `patience` steps old (0 disables early stopping).
+    """
+
+    def __init__(self, eval_freq, min_eval_freq=0, tighten_delta=0.0, patience=0):
+        self.interval = eval_freq
+        self.min_interval = min_eval_freq or eval_freq
+        self.tighten_delta = tighten_delta
+        self.patience = patience
+        self.next_eval = eval_freq
+        self.best_score, self.best_step = -float('inf'), 0
+        self.last_step = None  # of the latest eval
+        self.stopped = False
+
+    def should_eval(self, step):
+        return step >= self.next_eval
+
+    def resume(self, step, kept):
+        """Continue a run resumed at step, the scores of its kept checkpoints are the best so far."""
+        self.next_eval = step + self.interval
+        self.best_step = step
+        for ckpt in kept:
+            self.record(ckpt['step'], ckpt['spearman'])
+
+    def record(self, step, score):
+        if score > self.best_score:
+            self.best_score, self.best_step = score, step
+
+    def update(self, step, score):
+        self.last_step = step
+        if score - self.best_score <= self.tighten_delta:
+            self.interval = max(self.interval // 2, self.min_interval)
+        self.record(step, score)
+        self.next_eval = step + self.interval
+        if self.patience and step - self.best_step >= self.patience:
+            self.stopped = True
+            logging.info(f'Early stopping at step {step}, best spearmanr {self.best_score:.4f} at step {self.best_step}')
+        return self.stopped
+
+
+CKPT_INDEX = 'best_ckpts.json'
+
+
+class AsyncCheckpointSaver:
+    """Keeps the `max_to_keep` checkpoints with the highest validation spearman.
+
+    save() only copies the model variables into a shadow model on CPU; the checkpoint file is written
+    by a background thread so training continues right away. The kept checkpoints are listed, best
+    first, in <directory>/best_ckpts.json which the inference scripts read through `resolve_ckpt`.
+    The checkpoints hold the weights only, resuming a run needs its TrainState. A resumed run keeps ranking
+    the checkpoints already listed there, a new run replaces the index of an earlier run in the directory.
+    """
+
+    def __init__(self, model, build_shadow, directory, max_to_keep=1, min_score=-1.0, resume=False):
+        self.model = model
+        self.build_shadow = build_shadow
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        self.min_score = min_score
+        self.shadow, self.shadow_checkpoint, self.pairs = None, None, None
+        self.kept = []  # [{'step', 'spearman', 'file'}], best first
+        index_file = os.path.join(directory, CKPT_INDEX)
+        if resume and os.path.exists(index_file):
+            with open(index_file) as f:
+                self.kept = [c for c in json.load(f) if os.path.exists(c['file'] + '.index')]
+        elif os.path.exists(index_file):
+            logging.info(f'Replacing the checkpoint index {index_file} of an earlier run')
+            self._write_index()
+        self.jobs = queue.Queue(maxsize=1)
+        self.worker = threading.Thread(target=self._write_loop, daemon=True)
+        self.worker.start()
+
+    def _snapshot(self, step):
+        if self.shadow is None:
+            with tf.device('/cpu:0'):
+                self.shadow = self.build_shadow()
+                self.shadow_checkpoint = tf.train.Checkpoint(model=self.shadow, step_1=tf.Variable(0))
+            self.pairs = list(zip(self.shadow.variables, self.model.variables))
+            assert all(s.shape == v.shape for s, v in self.pairs), 'shadow model does not mirror the model'
+        for shadow_variable, variable in self.pairs:
+            shadow_variable.assign(variable)
+        self.shadow_checkpoint.step_1.assign(step)
+
+    def save(self, step, score):
+        step = int(step)
+        if score <= self.min_score or np.isnan(score):
+            return
+        # the shadow holds a single snapshot, wait until the previous one is on disk
+        self.jobs.join()
+        if len(self.kept) >= self.max_to_keep and score <= self.kept[-1]['spearman']:
+            return
+        self._snapshot(step)
+        self.jobs.put((step, float(score)))
+
+    def _write_loop(self):
+        while True:
+            step, score = self.jobs.get()
+            try:
+                file = self.shadow_checkpoint.write(os.path.join(self.directory, f'ckpt-{step}'))
+                # a step saved again replaces its entry, both would name the same files
+                self.kept = [c for c in self.kept if c['step'] != step]
+                self.kept.append({'step': step, 'spearman': score, 'file': file})
+                self.kept.sort(key=lambda c: c['spearman'], reverse=True)
+                for evicted in self.kept[self.max_to_keep:]:
+                    for path in glob.glob(evicted['file'] + '.*'):
+                        os.remove(path)
+                self.kept = self.kept[:self.max_to_keep]
+                self._write_index()
+                logging.info(f'Saved {file} (spearmanr {score:.4f})')
+            except Exception:
+                logging.exception(f'Saving checkpoint of step {step} failed')
+            finally:
+                self.jobs.task_done()
+
+    def _write_index(self):
+        with open(os.path.join(self.directory, CKPT_INDEX), 'w') as f:
+            json.dump(self.kept, f, indent=2)
+
+    def close(self):
+        self.jobs.join()
+
+
+DATA_SERVICE = []  # keeps the in-process dispatchers alive
+
+
+def start_data_service(args, data_helper):
+    """Start a tf.data service dispatcher in this process plus --data-service-workers local worker processes
+    (data_service_worker.py, on CPU) and point args.data_service_address at it, so that the train pipeline of
+    data_helper runs in the workers. Workers on other hosts join with data_service_worker.py as well."""
+    dispatcher = tf.data.experimental.service.DispatchServer(port=args.data_service_port)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_service_worker.py')
+    # the workers build the pipeline from the same flags, see data_service_worker.py
+    command = [sys.executable, script] + sys.argv[1:] + ['--data-helper', data_helper,
+                                                         '--data-service-address', dispatcher.target]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    workers = [subprocess.Popen(command, env=env) for _ in range(args.data_service_workers)]
+
+    def stop_workers():
+        for worker in workers:
+            worker.terminate()
+
+    atexit.register(stop_workers)
+    DATA_SERVICE.append(dispatcher)
+    args.data_service_address = dispatcher.target
+    logging.info(f'tf.data service dispatcher at {dispatcher.target} with {len(workers)} local workers')
+
+
+def resolve_ckpt(ckpt_file, rank=0):
+    """A checkpoint directory written by AsyncCheckpointSaver resolves to its rank-th best checkpoint."""
+    if not os.path.isdir(ckpt_file):
+        return ckpt_file
+    with open(os.path.join(ckpt_file, CKPT_INDEX)) as f:
+        kept = json.load(f)
+    return kept[rank]['file']
+
+
+def backbone_encoder(bert):
+    """The transformer encoder of a TFBertModel(_MM) / TFRoFormerModel(_MM) backbone."""
+    main_layer = bert.roformer if hasattr(bert, 'roformer') else bert.bert
+    return main_layer.encoder
+
+
+def set_inference_depth(bert, num_layers):
+    """Run only the first num_layers layers of the backbone at inference, 0 runs all of them.
+
+    The encoders in bert.py / roformer.py read num_layers_infer (and apply their exit head if they have one);
+    the stock transformers encoders of the Mix families get their layer list cut, the full list is kept aside."""
+    encoder = backbone_encoder(bert)
+    if hasattr(encoder, 'num_layers_infer'):
+        encoder.num_layers_infer = num_layers
+        return
+    if '_all_layers' not in encoder.__dict__:
+        encoder.__dict__['_all_layers'] = list(encoder.layer)
+    encoder.layer = encoder.__dict__['_all_layers'][:num_layers or None]
+
+
+def prune_spec_kwargs(config, heads=True):
+    """from_pretrained kwargs building a backbone with the layers / heads removed by prune_backbone.py.
+
+    The spec (prune_spec.json next to the pruned checkpoint) holds num_hidden_layers and pruned_heads
+    ({layer: [heads]}, after renumbering the kept layers). Pretrained weights of pruned attention kernels do not
+    fit and are skipped, the pruned checkpoint restores them. The stock transformers encoders of the Mix
+    families (heads=False) can only drop layers."""
+    if not config.prune_spec:
+        return {}
+    with open(config.prune_spec) as f:
+        spec = json.load(f)
+    kwargs = {'num_hidden_layers': spec['num_hidden_layers']}
+    if spec['pruned_heads']:
+        if not heads:
+            raise ValueError(f'{config.prune_spec} prunes heads, this backbone only supports dropping layers')
+        kwargs.update(pruned_heads={int(k): v for k, v in spec['pruned_heads'].items()},
+                      ignore_mismatched_sizes=True)
+    return kwargs
+
+
+def freeze_bottom(bert, num_layers):
+    """Stop training the embeddings and the first num_layers layers of a TFBertModel / TFBertModel_MM backbone."""
+    main_layer = bert.bert
+    if getattr(main_layer.encoder, 'exit_heads', None) is not None:
+        raise ValueError('frozen layers are cached without exit heads, drop --early-exit-heads')
+    main_layer.embeddings.trainable = False
+    for layer in main_layer.encoder.layer[:num_layers]:
+        layer.trainable = False
+
+
+def bottom_hidden_states(bert, num_layers, *args, **kwargs):
+    """Output of the embeddings + first num_layers layers, the inputs are those of the backbone's own call."""
+    set_inference_depth(bert, num_layers)
+    try:
+        return bert(*args, training=False, **kwargs)[0]
+    finally:
+        set_inference_depth(bert, 0)
+
+
+def frozen_top(bert, num_layers, hidden_states, mask, training=False):
+    """Sequence and pooled output of the layers above the frozen bottom, starting from its cached output.
+    mask covers every position of hidden_states (title tokens, then frames for TFBertModel_MM)."""
+    main_layer = bert.bert
+    hidden_states = tf.cast(hidden_states, tf.float32)
+    attention_mask = (1. - tf.cast(mask[:, None, None, :], tf.float32)) * -10000.
+    for layer in main_layer.encoder.layer[num_layers:]:
+        hidden_states = layer(hidden_states, attention_mask, None, False, training=training)[0]
+    return hidden_states, main_layer.pooler(hidden_states)
+
+
+class HiddenStateCache:
+    """float16 on-disk cache of the frozen bottom layers' output of every train video, keyed by vid.
+
+    <cache_dir>/hidden.f16 holds the rows ([seq_len, hidden_size] each) and index.json the vid of every row plus
+    the key (checkpoint, frozen layers, shapes) they were computed with. Rows are only appended, so folds sharing
+    a cache dir encode just their new videos; a different key starts the cache over. build() holds an exclusive
+    lock on the dir, so folds started in parallel by fold_scheduler.py append one after the other.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.data_file = os.path.join(cache_dir, 'hidden.f16')
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.rows, self.shape, self.hidden = {}, None, None
+
+    def _load_index(self):
+        self.rows, self.shape = {}, None
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file) as f:
+            index = json.load(f)
+        if index['key'] == self.key:
+            self.rows = {vid: i for i, vid in enumerate(index['vids'])}
+            self.shape = tuple(index['shape'])
+        else:
+            logging.info(f'Hidden state cache {self.cache_dir} was built for {index["key"]}, rebuilding')
+
+    def build(self, dataset, encode):
+        """Encode the videos of dataset missing from the cache; encode(batch, side) returns the bottom output of
+        side 1 / 2 of a pair batch."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another fold may have appended since, and rows a crashed build wrote after the last index are dropped
+            self._load_index()
+            row_bytes = int(np.prod(self.shape)) * 2 if self.shape is not None else 0
+            with open(self.data_file, 'ab') as f:
+                f.truncate(len(self.rows) * row_bytes)
+            num_cached = len(self.rows)
+            with open(self.data_file, 'ab') as f:
+                for batch in dataset:
+                    for side in (1, 2):
+                        new = {}
+                        for i, vid in enumerate(batch[f'vid_{side}'].numpy()):
+                            vid = vid.decode('utf-8')
+                            if vid not in self.rows and vid not in new:
+                                new[vid] = i
+                        if not new:
+                            continue
+                        sub_batch = {k: tf.gather(v, list(new.values())) for k, v in batch.items()}
+                        hidden = encode(sub_batch, side).numpy().astype(np.float16)
+                        self.shape = hidden.shape[1:]
+                        f.write(hidden.tobytes())
+                        for vid in new:
+                            self.rows[vid] = len(self.rows)
+            if self.shape is None:
+                raise ValueError(f'No videos to cache in {self.cache_dir}, the dataset is empty')
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'key': self.key, 'shape': list(self.shape), 'vids': list(self.rows)}, f)
+            os.replace(tmp_file, self.index_file)
+        logging.info(f'Hidden state cache {self.cache_dir}: {len(self.rows)} videos, {len(self.rows) - num_cached} new')
+        self.hidden = np.memmap(self.data_file, dtype=np.float16, mode='r', shape=(len(self.rows),) + self.shape)
+
+    def lookup(self, vids):
+        return np.asarray(self.hidden[[self.rows[vid.decode('utf-8')] for vid in vids]])
+
+    def attach(self, dataset):
+        """Add hidden_1 / hidden_2 to every batch of a pair dataset."""
+
+        def add_hidden(batch):
+            batch = dict(batch)
+            for side in (1, 2):
+                hidden = tf.numpy_function(self.lookup, [batch[f'vid_{side}']], tf.float16)
+                hidden.set_shape((None,) + self.shape)
+                batch[f'hidden_{side}'] = hidden
+            return batch
+
+        return dataset.map(add_hidden, num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(
+            tf.data.experimental.AUTOTUNE)
+
+
+def matryoshka_dims(args):
+    """Embedding prefixes trained alongside the full embedding, smallest first."""
+    return sorted(int(d) for d in args.matryoshka_dims.split(',') if d and int(d) < args.hidden_size)
+
+
+def nested_pair_loss(embedding_1, embedding_2, label_sims, dims, kl_weight):
+    """The pair loss (MSE + kl_weight * KL of the cosine similarity) of every leading-dims prefix of the
+    embeddings, so that truncated embeddings stay usable on their own (Matryoshka representation learning)."""
+    loss_kl = tf.keras.losses.KLDivergence()
+    loss = 0.
+    for dim in dims:
+        prefix_1 = tf.math.l2_normalize(embedding_1[:, :dim], axis=1)
+        prefix_2 = tf.math.l2_normalize(embedding_2[:, :dim], axis=1)
+        sim = tf.reduce_sum(prefix_1 * prefix_2, axis=1)
+        loss += tf.reduce_sum(tf.square(sim - label_sims)) + kl_weight * loss_kl(label_sims, sim)
+    return loss
+
+
+def write_embedding_matrix(output_file, vid_embedding):
+    """vids and their embeddings as one float16 matrix (np.savez), the input of retrieval.py / ivfpq.py."""
+    vids = list(vid_embedding)
+    embeddings = np.array([vid_embedding[vid] for vid in vids], dtype=np.float16)
+    np.savez(output_file, vids=np.array(vids), embeddings=embeddings)
+
+
+HARD_NEGATIVE_GROUPS = 'groups.tsv'
+
+
+def hard_negative_records(hard_negative_dir, seed, num_shards=1, shard_index=0, shuffle_buffer=65536):
+    """Serialized train examples in groups of each other's nearest neighbours (mine_hard_negatives.py), so that
+    consecutive examples, and with them the in-batch negatives of contrastive_loss, are hard.
+
+    The groups are sharded (--num-shards / --shard-index, in file order, so every worker keeps whole groups and no
+    two share one) and shuffled, the examples of a group stay together. groups.tsv is read whenever an iterator is
+    created, so every epoch batches by the latest mined groups without rebuilding the pipeline. Examples are read
+    by byte range with FixedLengthRecordDataset, which keeps the iterator checkpointable."""
+    groups_file = os.path.join(hard_negative_dir, HARD_NEGATIVE_GROUPS)
+
+    def read_groups(path):
+        return tf.data.Dataset.from_tensor_slices(tf.strings.split(tf.strings.strip(tf.io.read_file(path)), '\n'))
+
+    def read_record(position):
+        fields = tf.strings.split(position, ' ', maxsplit=3)
+        offset, length, footer = [tf.strings.to_number(fields[i], tf.int64) for i in range(3)]
+        return tf.data.FixedLengthRecordDataset(fields[3], length, header_bytes=offset, footer_bytes=footer)
+
+    dataset = tf.data.Dataset.from_tensors(groups_file).flat_map(read_groups)
+    dataset = dataset.shard(num_shards, shard_index)
+    dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.flat_map(lambda group: tf.data.Dataset.from_tensor_slices(tf.strings.split(group, '\t')))
+    # one record per position, deterministic interleave keeps them in order while reading 16 at a time
+    return dataset.interleave(read_record, cycle_length=16, block_length=1,
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=True)
+
+
+class HardNegativeRefresher:
+    """Re-mines --hard-negative-dir with the model being trained every --hard-negative-refresh-steps steps.
+
+    The weights are written to <dir>/ckpt-mine and mine_hard_negatives.py runs on them in a subprocess (on
+    --hard-negative-gpus), so training only waits for the write. A refresh due while the previous run is still
+    going is skipped. Without mined groups yet, the first run happens up front with the restored weights."""
+
+    def __init__(self, args, family, model):
+        self.args = args
+        self.family = family
+        self.checkpoint = tf.train.Checkpoint(model=model)
+        self.process = None
+        if args.hard_negative_dir and not os.path.exists(os.path.join(args.hard_negative_dir, HARD_NEGATIVE_GROUPS)):
+            logging.info(f'No hard negatives in {args.hard_negative_dir} yet, mining them before training')
+            if self.start(0).wait():
+                raise RuntimeError(f'Mining hard negatives failed, see {args.hard_negative_dir}/mine.log')
+
+    def start(self, step):
+        os.makedirs(self.args.hard_negative_dir, exist_ok=True)
+        ckpt_file = self.checkpoint.write(os.path.join(self.args.hard_negative_dir, 'ckpt-mine'))
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mine_hard_negatives.py')
+        # the training flags (data, backbone, sizes) plus the checkpoint to mine with, later flags win
+        command = [sys.executable, script] + sys.argv[1:] + ['--family', self.family, '--ckpt-file', ckpt_file,
+                                                             '--mined-step', str(step)]
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=self.args.hard_negative_gpus)
+        with open(os.path.join(self.args.hard_negative_dir, 'mine.log'), 'a') as log:
+            self.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        logging.info(f'Mining hard negatives with the weights of step {step}')
+        return self.process
+
+    def maybe_refresh(self, step):
+        if not self.args.hard_negative_dir or not self.args.hard_negative_refresh_steps:
+            return
+        if step % self.args.hard_negative_refresh_steps:
+            return
+        if self.process is not None and self.process.poll() is None:
+            logging.info(f'Hard negative mining of an earlier step still running, skipping step {step}')
+            return
+        self.start(step)
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()